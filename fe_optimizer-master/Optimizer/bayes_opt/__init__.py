@@ -1,10 +1,14 @@
 from .bayesian_optimization import BayesianOptimization, Events, DiscreteBayesianOptimization
 from .util import UtilityFunction
+from .parallel_opt import AcquisitionExecutor
+from .constraints import Constraint
 from .logger import ScreenLogger, JSONLogger
 
 __all__ = [
     "BayesianOptimization",
     "UtilityFunction",
+    "AcquisitionExecutor",
+    "Constraint",
     "Events",
     "ScreenLogger",
     "JSONLogger",
@@ -9,18 +9,21 @@ from multiprocessing import Pool
 import pandas
 
 from .target_space import TargetSpace, DiscreteSpace, PartnerSpace
+from .constraints import ConstraintSet, Constraint, FEASIBILITY_TOL
 from .event import Events, DEFAULT_EVENTS
 from .logger import _get_default_logger, _get_discrete_logger
-from .util import UtilityFunction, acq_max, ensure_rng, get_rnd_quantities, get_rng_complement, get_rnd_quantities_alt
+from .util import UtilityFunction, acq_max, ensure_rng, get_rnd_quantities_many
 from .parallel_opt import disc_acq_max, disc_acq_KMBBO
 from .parallel_opt import disc_constrained_acq_max, disc_constrained_acq_KMBBO
-from .parallel_opt import disc_capitalist_max
+from .parallel_opt import disc_capitalist_max, AcquisitionExecutor
+from .hyperparameters import fit_restarts
 
 from sklearn.gaussian_process.kernels import Matern, WhiteKernel, ConstantKernel
 from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.base import clone
+from scipy.linalg import cholesky, cho_solve, solve_triangular
 
 import pandas as pd
-import re
 
 
 class Queue:
@@ -103,6 +106,8 @@ class BayesianOptimization(Observable):
         # array constraints correspond to point in array row
         self._key_constraints = constraints
         self._array_constraints = self.array_like_constraints()
+        # Parsed once into a vectorised evaluator
+        self._constraint_set = self._compile_constraints()
         super(BayesianOptimization, self).__init__(events=DEFAULT_EVENTS)
 
     @property
@@ -121,6 +126,19 @@ class BayesianOptimization(Observable):
     def constraints(self):
         return self._array_constraints
 
+    @property
+    def constraint_set(self):
+        # Models pickled before constraints were compiled are parsed on first use
+        if getattr(self, '_constraint_set', None) is None:
+            self._constraint_set = self._compile_constraints()
+        return self._constraint_set
+
+    def _compile_constraints(self):
+        # Structured constraints are compiled directly, string constraints through their array form
+        constraints = [c if isinstance(c, Constraint) else a
+                       for c, a in zip(self._key_constraints, self._array_constraints)]
+        return ConstraintSet(constraints, self._space.dim, keys=self._space.keys)
+
     @property
     def verbose(self):
         return self._verbose
@@ -130,6 +148,12 @@ class BayesianOptimization(Observable):
         self._space.register(params, target)
         self.dispatch(Events.OPTMIZATION_STEP)
 
+    def register_many(self, params, targets):
+        """Expect block of observations with known targets, e.g. a completed plate"""
+        self._space.register_many(params, targets)
+        if len(self._space) > 0:
+            self.dispatch(Events.OPTMIZATION_STEP)
+
     def probe(self, params, lazy=True):
         """Probe target of x"""
         if isinstance(params, list):
@@ -233,11 +257,14 @@ class BayesianOptimization(Observable):
         This allows direct evaluation in the acquisition function.
         Parameters
         ----------
-        constraints: list of string constraints
+        constraints: list of string constraints or Constraint objects
         '''
         keys = self.space.keys
         array_like = []
         for constraint in self._key_constraints:
+            if isinstance(constraint, Constraint):
+                array_like.append(constraint.array_string(keys))
+                continue
             tmp = constraint
             for idx, key in enumerate(keys):
                 # tmp = tmp.replace(key,'x[0][{}]'.format(idx))
@@ -248,15 +275,9 @@ class BayesianOptimization(Observable):
     def get_constraint_dict(self):
         '''
         Develops inequality constraints ONLY. (>=0)
+        Each dict carries the analytic Jacobian of its constraint for SLSQP.
         '''
-        dicts = []
-        funcs = []
-        for idx, constraint in enumerate(self.constraints):
-            st = "def f_{}(x): return pd.eval({})\nfuncs.append(f_{})".format(idx, constraint, idx)
-            exec(st)
-            dicts.append({'type': 'ineq',
-                          'fun': funcs[idx]})
-        return dicts
+        return self.constraint_set.scipy_constraints()
 
     def output_space(self, path):
         """
@@ -280,6 +301,8 @@ class DiscreteBayesianOptimization(BayesianOptimization):
     When using the open form optimizer (i.e. writing loops manually) the suggested parameters handled as lists of dicts. 
     
     '''
+    GP_REFIT_EVERY = 5  # Incremental GP updates between hyperparameter re-optimisations
+    GP_LML_DRIFT = 0.05  # Change in log marginal likelihood per point that forces a re-optimisation
 
     def __init__(self, f, prange, random_state=None, verbose=2, constraints=[]):
         """"""
@@ -303,7 +326,42 @@ class DiscreteBayesianOptimization(BayesianOptimization):
                                             normalize_y=False,
                                             n_restarts_optimizer=10 * self.space.dim,
                                             random_state=self._random_state)
+        # Identifies the fitted GP for workers of the executor, set to the saved model uuid by the Experiment
+        self.model_uuid = None
+        self._fit_count = 0
+        self._executor = None
+        # Centroids of the last KMBBO clustering, warm starting the next one (see parallel_opt._cluster_slice)
+        self.kmbbo_centroids = None
+
+    def __getstate__(self):
+        # The worker pool is never pickled, either into saved models or to the workers themselves
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        return state
 
+    @property
+    def model_version(self):
+        '''Key for the fitted GP, workers receive a fresh copy of the optimizer when it changes'''
+        return getattr(self, 'model_uuid', None), getattr(self, '_fit_count', 0)
+
+    @property
+    def executor(self):
+        return getattr(self, '_executor', None)
+
+    @executor.setter
+    def executor(self, executor):
+        self._executor = executor
+
+    def get_executor(self, processes):
+        '''
+        Returns the persistent AcquisitionExecutor of the optimizer, creating one if none is attached
+        or the attached executor has a different number of processes.
+        '''
+        if self.executor is None or self.executor.processes != processes:
+            if self.executor is not None:
+                self.executor.close()
+            self.executor = AcquisitionExecutor(processes)
+        return self.executor
 
     def probe(self, params, lazy=True):
         """Probe target of x"""
@@ -336,404 +394,301 @@ class DiscreteBayesianOptimization(BayesianOptimization):
         if clear: self.partner_space.clear()
         self.partner_space.register(params)
 
-    def fit_gp(self):
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            self._gp.fit(self._space.params, self._space.target)
+    def partner_register_many(self, params, clear=False):
+        '''register block of points with target of -1'''
+        if clear: self.partner_space.clear()
+        self.partner_space.register_many(params)
+
+    def fit_gp(self, processes=1, n_converged=None):
+        '''
+        Fits the GP hyperparameters with n_restarts_optimizer restarts (see hyperparameters.fit_restarts).
+        The timing and log marginal likelihood of each restart are kept in self.gp_fit_report.
+
+        Parameters
+        ----------
+        processes: integer number of processes for the hyperparameter restarts
+        n_converged: integer, stop once this many restarts reach the best optimum. None runs every restart.
+        '''
+        self._fit_restarts(self._gp.kernel, None, processes, n_converged)
+
+    def refit_gp(self, n_restarts=0, processes=1, n_converged=None):
+        '''
+        Re-optimises the GP hyperparameters, starting from the previously fitted kernel.
+
+        Parameters
+        ----------
+        n_restarts: integer number of additional random restarts of the hyperparameter optimizer
+        processes: integer number of processes for the hyperparameter restarts
+        n_converged: integer, stop once this many restarts reach the best optimum (see fit_gp)
+        '''
+        if not hasattr(self._gp, 'kernel_'):
+            return self.fit_gp(processes=processes, n_converged=n_converged)
+        self._fit_restarts(self._gp.kernel_, n_restarts, processes, n_converged)
+
+    def _fit_restarts(self, kernel, n_restarts, processes, n_converged):
+        gp = clone(self._gp)
+        gp.set_params(kernel=kernel, random_state=self._gp.random_state)
+        gp, self.gp_fit_report = fit_restarts(gp, self._space.params, self._space.target,
+                                              n_restarts=n_restarts,
+                                              processes=processes,
+                                              n_converged=n_converged)
+        # Keep the configured kernel for future full fits
+        gp.set_params(kernel=self._gp.kernel)
+        self._gp = gp
+        self._fit_count = getattr(self, '_fit_count', 0) + 1
+        self._gp_updates = 0
+        self._gp_lml_per_point = gp.log_marginal_likelihood_value_ / len(self._space)
+
+    def update_gp(self, refit_every=None, lml_drift=None, n_restarts=0, processes=1, n_converged=None):
+        '''
+        Incrementally updates the fitted GP with the observations registered since it was last fit.
+
+        The kernel hyperparameters are kept and the Cholesky factor of the training covariance is
+        extended by a rank-k block update for the k new points. The hyperparameters are re-optimised
+        (warm started from the current kernel, see refit_gp) after refit_every incremental updates, or
+        when the log marginal likelihood per point drifts by more than lml_drift from its value at the
+        last optimisation. A full fit_gp is used when there is no fitted GP to update.
+
+        Parameters
+        ----------
+        refit_every: integer, incremental updates between re-optimisations (default GP_REFIT_EVERY)
+        lml_drift: float, log marginal likelihood drift per point forcing a re-optimisation (default GP_LML_DRIFT)
+        n_restarts: integer number of random restarts used when re-optimising
+        processes: integer number of processes for fitting
+        n_converged: integer, stop once this many restarts reach the best optimum when (re)fitting (see fit_gp)
+
+        Returns
+        -------
+        string, 'fit', 'refit' or 'update' describing what was done
+        '''
+        refit_every = self.GP_REFIT_EVERY if refit_every is None else refit_every
+        lml_drift = self.GP_LML_DRIFT if lml_drift is None else lml_drift
+        gp = self._gp
+        X = self._space.params
+        y = self._space.target
+        n_old = len(gp.X_train_) if hasattr(gp, 'alpha_') else 0
+        if n_old == 0 or gp.normalize_y or n_old > len(X) or not np.array_equal(gp.X_train_, X[:n_old]) \
+                or getattr(self, '_gp_lml_per_point', None) is None:
+            self.fit_gp(processes=processes, n_converged=n_converged)
+            return 'fit'
+        if n_old == len(X):
+            return 'update'
+        if getattr(self, '_gp_updates', 0) + 1 >= refit_every:
+            self.refit_gp(n_restarts, processes, n_converged)
+            return 'refit'
+
+        # Rank-k extension of K = L L^T, including the jitter gp.alpha on the diagonal
+        X_new = X[n_old:]
+        K12 = gp.kernel_(X[:n_old], X_new)
+        K22 = gp.kernel_(X_new)
+        K22[np.diag_indices_from(K22)] += gp.alpha
+        L21 = solve_triangular(gp.L_, K12, lower=True, check_finite=False).T
+        try:
+            L22 = cholesky(K22 - L21 @ L21.T, lower=True, check_finite=False)
+        except np.linalg.LinAlgError:
+            self.refit_gp(n_restarts, processes, n_converged)
+            return 'refit'
+        L = np.zeros((len(X), len(X)))
+        L[:n_old, :n_old] = gp.L_
+        L[n_old:, :n_old] = L21
+        L[n_old:, n_old:] = L22
+        alpha = cho_solve((L, True), y, check_finite=False)
+        lml = -0.5 * y @ alpha - np.log(np.diag(L)).sum() - 0.5 * len(X) * np.log(2 * np.pi)
+        if abs(lml / len(X) - self._gp_lml_per_point) > lml_drift:
+            self.refit_gp(n_restarts, processes, n_converged)
+            return 'refit'
+
+        gp.X_train_ = np.copy(X)
+        gp.y_train_ = np.copy(y)
+        gp.L_ = L
+        gp.alpha_ = alpha
+        gp.log_marginal_likelihood_value_ = lml
+        self._gp_updates = getattr(self, '_gp_updates', 0) + 1
+        self._fit_count = getattr(self, '_fit_count', 0) + 1
+        return 'update'
+
+    def _constraint_variables(self, row):
+        '''Sorted indices of the variables appearing in constraint row, including complement terms'''
+        cs = self.constraint_set
+        pieces = cs.piece_rows == row
+        used = cs.A[row] != 0
+        used[cs.piece_vars[pieces]] = True
+        used |= (cs.piece_coefs[pieces] != 0).any(axis=0)
+        return np.flatnonzero(used)
+
+    def _rng_index_sets(self):
+        '''
+        Index sets used by constrained_rng, computed once from the compiled constraints.
+        The first constraint limits the liquids (possibly with complement terms), the optional second the catalysts.
+        '''
+        if getattr(self, '_rng_sets', None) is None:
+            cs = self.constraint_set
+            liquid_all = self._constraint_variables(0)
+            cats = self._constraint_variables(1) if len(cs) > 1 else np.zeros(0, dtype=int)
+            complements = np.unique(cs.piece_vars[cs.piece_rows == 0])
+            self._rng_sets = {
+                'max_liquid': cs.b[0],
+                'max_cats': cs.b[1] if len(cs) > 1 else None,
+                'liquid_all': liquid_all,  # every variable in the liquid constraint
+                'liquids': np.setdiff1d(np.setdiff1d(liquid_all, cats), complements),  # sampled on the liquid simplex
+                'cats': cats,
+                'complements': complements,
+            }
+        return self._rng_sets
 
     def constrained_rng(self, n_points, bin=False):
         '''
         Random number generator that deals more effectively with highly constrained spaces. 
         
-        Works only off single constraint of form L - sum(x_i) >=0
-        Where the lower bound of each x_i is 0.
+        Works off a liquid constraint of form L - sum(x_i) >=0 (with optional complement terms),
+        and an optional second catalyst constraint of form M - sum(x_j) >= 0.
+        Constrained variables are drawn from scaled simplices and the remaining variables uniformly,
+        with all n_points drawn as arrays.
 
         Generates a fraction of points from a nonuniform sampling that favors limiting cases. (n_var/50)
         Parameters
         ----------
         n_points: integer number of points to generate
-        '''
-        #JG removed this for handling SR and Cat constraints
-        # if len(self.constraints) != 1:
-        #     raise ValueError("Too many constraints for constrained random number generator")
+        bin: logical, whether to bin the points to the discrete lattice
 
+        Returns
+        -------
+        (n_points, dim) array
+        '''
         bounds = self.space.bounds
-        #bounds_cat = bounds
-        steps = self.space.steps
         random_state = self._random_state
-
-
-        # Get size and max amount from single constraint
-        s = self.constraints[0]
-        # sr = self.constraints[1]
-        # #print(sr)
-        catalyst_contraint = None
-        try:
-            catalyst_contraint = True
-            cats = self.constraints[1]
-        except:
-            catalyst_contraint = False
-
-        # print(s)
-        # print(sr)
-        # print(cats)
-
-        p = re.compile('(\d+)\]<0.5')
-        ms = p.findall(s)
-        # Count variables and constrained variables
         n_var = self.space.dim
-        n_constrained_var = 0 ##default
-        # n_constrained_var_liq = 0
-        # n_constrained_var_sr = 0
-        n_constrained_var_cats = 0
-
-        for i in range(n_var):
-            if 'x[{}]'.format(i) in s:
-                n_constrained_var += 1
-
-
-            # if 'x[{}]'.format(i) in s:
-            #     if 'x[{}]'.format(i) not in sr:
-            #         n_constrained_var_liq +=1
-            #
-            # if 'x[{}]'.format(i) in sr:
-            #     n_constrained_var_sr += 1
-            # #
-            if catalyst_contraint == True:
-                if 'x[{}]'.format(i) in cats:
-                    n_constrained_var_cats += 1
-            #print(n_constrained_var_cats)
-        ################################################################################
-        # for i in range(n_var):
-        #     if 'x[{}]'.format(i) in sr:
-        #         n_constrained_var_sr += 1
-        #
-        # for i in range(n_var):
-        #     if 'x[{}]'.format(i) in cats:
-        #         n_constrained_var_cats += 1
-        #         ################################################################################
-        #print(ms)
+        if not self.constraints:
+            x = random_state.uniform(bounds[:, 0], bounds[:, 1], size=(n_points, n_var))
+            return self.space.bin_many(x) if bin else x
+        sets = self._rng_index_sets()
+        liquid_all, liquids, cats, complements = sets['liquid_all'], sets['liquids'], sets['cats'], sets['complements']
+        n_constrained_var = len(liquid_all)
+        # Budgets left once the lower bounds are taken up
+        rem_max_val = sets['max_liquid'] - bounds[np.setdiff1d(liquid_all, complements), 0].sum()
+        if len(cats):
+            rem_cats = sets['max_cats'] - bounds[cats, 0].sum()
+
         # Get extra points from nonuniformity
-        n_nonuniform = int(n_points * n_var/50)
+        n_nonuniform = int(n_points * n_var / 50)
         n_points -= n_nonuniform
-        # Initialize randoms
-        x = np.zeros((n_points+n_nonuniform, n_var))
-        # Get max value of liquid constraint
-        try:
-            max_val = float(s.split(' ')[0])
-            # max_sr = float(sr.split(' ')[0])
-            if catalyst_contraint == True:
-                max_cats = float(cats.split(' ')[0])
-        except:
-            raise SyntaxError("Is your liquid constraint lead by the max volume? : {}".format(s))
-
-        # try:
-        #     if "|" in sr:
-        #         sr_constraint = (sr.split(" - ")[1])
-        #         sr_constraint = int(sr_constraint.split("|")[1])
-
-        # except:
-        #     pass
-
-
-        # Generator for complements that are consistent with max scaled by simplex if relevant
-        # followed by simplex sampling for constrained
-        # followed by random sampling for unconstrained
-        complements = []
-        # if ms:
-        #     complements = [int(m) for m in ms]
-        #     for i in range(n_points):
-        #         rem_max_val = -1
-        #         while rem_max_val <= 0:
-        #             rem_max_val = max_val
-        #             for complement in complements:
-        #                 if 'x[{}]'.format(complement) in s:
-        #                     x[i, complement] = get_rng_complement(n_constrained_var, random_state)
-        #                     # Extract regex, includes two options for ordering issues
-        #                     reductions = []
-        #                     p = re.compile(
-        #                         '- \(\(x\[{:d}\]<0.5\) \* \(\(\(0.5 - x\[{:d}\]\)/0.5\) \* \(\d+.\d+-\d+.\d+\) \+ \d+.\d+\) \) '.format(
-        #                             complement, complement))
-        #                     reductions.append(p.findall(s)[0])
-        #                     p = re.compile(
-        #                         '- \(\(x\[{:d}+\]>=0.5\) \* \(\(\(x\[{:d}\] - 0.5\)/0.5\) \* \(\d+.\d+-\d+.\d+\) \+ \d+.\d+\) \) '.format(
-        #                             complement, complement))
-        #                     reductions.append(p.findall(s)[0])
-        #                     for reduction in reductions:
-        #                         rem_max_val += pd.eval(reduction, local_dict={'x': x[i, :]})
-        #                 else:
-        #                     x[i, complement] = random_state.uniform(bounds[complement, 0], bounds[complement, 1])
-        #             # Removing lower bound greater than 0 from rem_max_val and adding in later
-        #             for j in range(n_var):
-        #                 if j in complements:
-        #                     continue
-        #                 elif 'x[{}]'.format(j) in self.constraints[0]:
-        #                     rem_max_val -= bounds[j, 0]
-        #         rnd = get_rnd_quantities(rem_max_val, n_constrained_var, random_state)
-        #         #print("this si something")
-        #         rnd_cats = get_rnd_quantities(2, n_constrained_var, random_state)
-        #         rnd_sr= get_rnd_quantities(rem_max_val, n_constrained_var, random_state)
-        #         cnt = 0
-        #         for j in range(n_var):
-        #             if j in complements:
-        #                 continue
-        #             elif 'x[{}]'.format(j) in self.constraints[0]:
-        #                 x[i, j] = min(rnd[cnt]+bounds[j, 0], bounds[j, 1])
-        #                 cnt += 1
-        #             else:
-        #                 x[i, j] = random_state.uniform(bounds[j, 0], bounds[j, 1])
-
-        if ms:
-            complements = [int(m) for m in ms]
-            for i in range(n_points):
-                rem_max_val = -1
-                while rem_max_val <= 0:
-                    rem_max_val = max_val
-                    # rem_sr = max_sr
-                    # rem_cats = max_cats
-                    for complement in complements:
-                        if 'x[{}]'.format(complement) in s:
-                            x[i, complement] = get_rng_complement(n_constrained_var, random_state)
-                            # Extract regex, includes two options for ordering issues
-                            reductions = []
-                            p = re.compile(
-                                '- \(\(x\[{:d}\]<0.5\) \* \(\(\(0.5 - x\[{:d}\]\)/0.5\) \* \(\d+.\d+-\d+.\d+\) \+ \d+.\d+\) \) '.format(
-                                    complement, complement))
-                            reductions.append(p.findall(s)[0])
-                            p = re.compile(
-                                '- \(\(x\[{:d}+\]>=0.5\) \* \(\(\(x\[{:d}\] - 0.5\)/0.5\) \* \(\d+.\d+-\d+.\d+\) \+ \d+.\d+\) \) '.format(
-                                    complement, complement))
-                            reductions.append(p.findall(s)[0])
-                            for reduction in reductions:
-                                rem_max_val += pd.eval(reduction, local_dict={'x': x[i, :]})
-                        else:
-                            x[i, complement] = random_state.uniform(bounds[complement, 0], bounds[complement, 1])
-                    # Removing lower bound greater than 0 from rem_max_val and adding in later
-                    for j in range(n_var):
-                        if j in complements:
-                            continue
-                        elif 'x[{}]'.format(j) in self.constraints[0]:
-                            rem_max_val -= bounds[j, 0]
-                rnd = get_rnd_quantities(rem_max_val, n_constrained_var, random_state)
-                #print("this si something")
-                rnd_cats = get_rnd_quantities(2, n_constrained_var, random_state)
-                rnd_sr= get_rnd_quantities(rem_max_val, n_constrained_var, random_state)
-                cnt = 0
-                for j in range(n_var):
-                    if j in complements:
-                        continue
-                    elif 'x[{}]'.format(j) in self.constraints[0]:
-                        x[i, j] = min(rnd[cnt]+bounds[j, 0], bounds[j, 1])
-                        cnt += 1
-                    else:
-                        x[i, j] = random_state.uniform(bounds[j, 0], bounds[j, 1])
-        else:
-            # Removing lower bound greater than 0 from rem_max_val and adding in later
-            rem_max_val = max_val
-            # rem_sr = max_sr
-            if catalyst_contraint == True:
-                rem_cats = max_cats
-            sr_count = 0
-
-#############
-            ##Remaining max vol of standard liquids
-            for j in range(n_var):
-                if 'x[{}]'.format(j) in s:
-
-
-                    rem_max_val -= bounds[j, 0]
-
-            ################################################################################
-            ##Remaining max vol of sr liquids
-                # if 'x[{}]'.format(j) in sr:
-                #
-                #     rem_sr -= bounds[j, 0]
-                #     rem_sr = rem_max_val - rem_sr
-
-            # ################################################################################
-            # ##Remaining max mass of catalysts
-                if catalyst_contraint == True:
-                    if 'x[{}]'.format(j) in cats:
-
-                        rem_cats -= bounds[j, 0]
-            ################################################################################
-            sr_list = []
-            for i in range(n_points):
-                cnt1 = 0
-                cnt2 = 0
-                cnt = 0
-
-                rnd = get_rnd_quantities(rem_max_val,n_constrained_var, random_state)
-
-
-                #print(n_constrained_var)
-                #print(n_constrained_var_cats)
-                #print(rem_max_val)
-
-                # rnd_liq = get_rnd_quantities(rem_max_val, n_constrained_var, random_state)
-                #rnd_sr = get_rnd_quantities(rem_sr, n_constrained_var_sr, random_state)
-                if catalyst_contraint == True:
-                    rnd_cats = get_rnd_quantities(rem_cats, n_constrained_var_cats, random_state)
-
-
-
-                #print(rnd)
-                #print(rnd_cats)
-                #print(rnd_cats)
-                sr_count =0
-                cat_count =0
-                sr_list_col = []
-                #print(rnd)
-                for j in range(n_var):
-
-                    #if catalyst_contraint == True:
-                    if 'x[{}]'.format(j) in cats:
-
-                        #print("cat: " + 'x[{}]'.format(j))
-                        #print("cat: " + str(j))
-                        x[i, j] = min(rnd_cats[cnt1] + bounds[j, 0], bounds[j, 1])
-                        cnt1 += 1
-
-
-                    elif 'x[{}]'.format(j) in s:
-
-                        #print("liq: " + str(j))
-                        x[i, j] = min(rnd[cnt]+bounds[j, 0], bounds[j, 1])
-                        cnt += 1
-
-                        #print("liq: " + 'x[{}]'.format(j))
-
-                    # if 'x[{}]'.format(j) in self.constraints[0]:
-                    #     x[i, j] = min(rnd_liq[cnt1]+bounds[j, 0], bounds[j, 1])
-                    #     cnt1 += 1
-                    # if 'x[{}]'.format(j) in sr:
-                    #     x[i, j] = min(rnd_sr[cnt2] + bounds[j, 0], bounds[j, 1])
-                    #     cnt2 += 1
-                    # if 'x[{}]'.format(j) in cats:
-                    #     x[i, j] = min(rnd_cats[cnt3] + bounds[j, 0], bounds[j, 1])
-                    #     cnt3 += 1
-                    else:
-                        x[i, j] = random_state.uniform(bounds[j, 0], bounds[j, 1])
-                    # if not 'x[{}]'.format(j) in cats or not 'x[{}]'.format(j) in s:
-                    #     x[i, j] = random_state.uniform(bounds[j, 0], bounds[j, 1])
-
-
-        # Add nonuniform sampling
-        for i in range(n_points,n_nonuniform+n_points):
-            rem_max_val = max_val
-            # rem_sr = max_sr
-            if catalyst_contraint == True:
-                rem_cats = max_cats
-            sr_count = 0
-
-            var_list = list(range(n_var))
-            #print(var_list)
-            # Removing lower bound greater than 0 from rem_max_val and adding in later
-            #rem_max_val = max_val
-            curr_cats = 0
-            for j in range(n_var):
-                if 'x[{}]'.format(j) in s:
-
-                    rem_max_val -= bounds[j, 0]
-
-                    #print(rem_max_val)
-
-
-                    ################################################################################
-                # if 'x[{}]'.format(j) in sr:
-                #     rem_sr -= bounds[j, 0]
-                if catalyst_contraint == True:
-                    if 'x[{}]'.format(j) in cats:
-                        rem_cats -= bounds[j, 0]
-                        #print(cats)
-                        #print("cat: " + str(rem_cats))
-                        #curr_cats += 1
-                        #print(bounds[j, 0])
-
-                    ################################################################################
-                # print(rem_max_val)
-                # print(rem_cats)
-                # print("#")
-            while var_list:
-                j = var_list.pop(np.random.choice(range(len(var_list))))
-
-
-                value = []
-                if catalyst_contraint == True:
-                    if 'x[{}]'.format(j) in cats:
-                        value = np.random.uniform(0, min(bounds[j, 1] - bounds[j, 0], rem_cats)) + bounds[j, 0]
-                        x[i, j] = value
-
-                        rem_cats -= (x[i, j] - bounds[j, 0])
-                    #print("cat: "+str(np.random.uniform(0, min(bounds[j, 1] - bounds[j, 0], rem_cats)) + bounds[j, 0]))
-                    #print("cat: " + str(rem_cats))
-
-                elif 'x[{}]'.format(j) in s:
-                    value = np.random.uniform(0, min(bounds[j, 1]-bounds[j, 0], rem_max_val)) + bounds[j, 0]
-                    x[i, j] = value
-                    #print("liq: " + str(np.random.uniform(0, min(bounds[j, 1]-bounds[j, 0], rem_max_val)) + bounds[j, 0]))
-
-                    rem_max_val -= (x[i, j] - bounds[j, 0])
 
+        # Random sampling for unconstrained, overwritten below for constrained
+        x = random_state.uniform(bounds[:, 0], bounds[:, 1], size=(n_points + n_nonuniform, n_var))
+
+        # Complements consistent with the max volume, scaled by the first coordinate of a simplex
+        rem = np.full(n_points + n_nonuniform, rem_max_val)
+        if len(complements):
+            x[:, complements] = 0.
+            x[:, liquids] = 0.
+            redo = np.arange(n_points + n_nonuniform)
+            while len(redo):
+                if n_constrained_var > 1:
+                    first = random_state.beta(1, n_constrained_var - 1, size=(len(redo), len(complements)))
                 else:
-                    x[i, j] = random_state.uniform(bounds[j, 0], bounds[j, 1])
-
-                #
-                # if 'x[{}]'.format(j) in sr:
-                #     if rem_max_val - rem_sr > 0:
-                #         x[i, j] = np.random.uniform(0, min(bounds[j, 1] - bounds[j, 0], rem_max_val)) + bounds[j, 0]
-
-                    #print(i, j)
-                    # if j in complements:
-                    #
-                    #     reductions = []
-                    #     p = re.compile(
-                    #         '- \(\(x\[{:d}\]<0.5\) \* \(\(\(0.5 - x\[{:d}\]\)/0.5\) \* \(\d+.\d+-\d+.\d+\) \+ \d+.\d+\) \) '.format(
-                    #             complement, complement))
-                    #     reductions.append(p.findall(s)[0])
-                    #     p = re.compile(
-                    #         '- \(\(x\[{:d}+\]>=0.5\) \* \(\(\(x\[{:d}\] - 0.5\)/0.5\) \* \(\d+.\d+-\d+.\d+\) \+ \d+.\d+\) \) '.format(
-                    #             complement, complement))
-                    #     reductions.append(p.findall(s)[0])
-                    #     for reduction in reductions:
-                    #         rem_max_val += pd.eval(reduction, local_dict={'x': x[i, :]})
-                    #     # Contingency for complement generation irreverent to remaining value
-                    #     # Uses ratio with respect to max_value to pull fraction of remaining
-                    #     while rem_max_val < 0:
-                    #         for reduction in reductions:
-                    #             rem_max_val -= pd.eval(reduction, local_dict={'x': x[i, :]})
-                    #         x[i, j] = (rem_max_val / max_val * (0.5 - x[i, j])) + 0.5
-                    #         for reduction in reductions:
-                    #             rem_max_val += pd.eval(reduction, local_dict={'x': x[i, :]})
-                    # else:
-
-
-
-                        ###############################################################################
-                # if 'x[{}]'.format(j) in sr:
-                #     x[i, j] = random_state.uniform(bounds[j, 0], bounds[j, 1])
-                #
-                # if 'x[{}]'.format(j) in cats:
-                #     x[i, j] = random_state.uniform(bounds[j, 0], bounds[j, 1])
-
-
-                # if 'x[{}]'.format(j) not in self.constraints[0] and 'x[{}]'.format(j) not in self.constraints[2] :
-                #     x[i, j] = random_state.uniform(bounds[j, 0], bounds[j, 1])
-
-
-                # if not 'x[{}]'.format(j) in cats or not 'x[{}]'.format(j) in s:
-                #     x[i, j] = random_state.uniform(bounds[j, 0], bounds[j, 1])
-
-                #print(value)
-                    ################################################################################
-        #cat_frame = pandas.DataFrame(x)
-        #print(x)
+                    first = np.ones((len(redo), len(complements)))
+                sign = random_state.choice([-0.5, 0.5], size=(len(redo), len(complements)))
+                x[np.ix_(redo, complements)] = 0.5 + first * sign
+                # Liquid constraint with only the complements filled in is the volume left for the liquids
+                rem[redo] = self.constraint_set.evaluate(x[redo])[:, 0] + rem_max_val - sets['max_liquid']
+                redo = redo[rem[redo] <= 0]
+
+        # Simplex sampling for the liquid and catalyst constraints
+        u = x[:n_points]
+        rnd = get_rnd_quantities_many(rem[:n_points], n_constrained_var, n_points, random_state)
+        u[:, liquids] = np.minimum(rnd[:, :len(liquids)] + bounds[liquids, 0], bounds[liquids, 1])
+        if len(cats):
+            rnd_cats = get_rnd_quantities_many(rem_cats, len(cats), n_points, random_state)
+            u[:, cats] = np.minimum(rnd_cats + bounds[cats, 0], bounds[cats, 1])
+
+        # Add nonuniform sampling: variables are visited in a random order per point and each constrained
+        # variable takes a uniform share of what is left of its budget
+        if n_nonuniform:
+            v = x[n_points:]
+            group = np.zeros(n_var, dtype=int)  # 0 unconstrained, 1 liquid, 2 catalyst
+            group[liquids] = 1
+            group[cats] = 2
+            budget = np.zeros((n_nonuniform, 3))
+            budget[:, 1] = rem[n_points:]
+            if len(cats):
+                budget[:, 2] = rem_cats
+            free = np.setdiff1d(np.arange(n_var), complements)
+            order = free[np.argsort(random_state.uniform(size=(n_nonuniform, len(free))), axis=1)]
+            rows = np.arange(n_nonuniform)
+            for k in range(len(free)):
+                j = order[:, k]
+                g = group[j]
+                constrained = g > 0
+                span = np.where(constrained, np.minimum(bounds[j, 1] - bounds[j, 0], budget[rows, g]),
+                                bounds[j, 1] - bounds[j, 0])
+                value = random_state.uniform(0, 1, n_nonuniform) * np.maximum(span, 0)
+                v[rows, j] = value + bounds[j, 0]
+                budget[rows[constrained], g[constrained]] -= value[constrained]
 
         if bin:
-            x = np.floor((x - bounds[:, 0]) / steps) * steps + bounds[:, 0]
+            x = self.space.bin_many(x)
 
         return x
 
+    def lattice_rng(self, n_points):
+        '''
+        Random lattice points that satisfy every constraint by construction.
+
+        Points from constrained_rng are floored to the lattice in integer step counts, which can only
+        lower the linear volume/mass sums. Any constraint still violated, through rounding of the float
+        sums or a complement term moved by the flooring, is repaired in a single pass by removing whole
+        steps from the plain variables of that constraint, in a random order per point. If that is not
+        enough the complements of the point are moved to the lattice value next to 0.5 with the smallest
+        contribution, and the pass is repeated.
+
+        Parameters
+        ----------
+        n_points: integer number of points to generate
+
+        Returns
+        -------
+        (n_points, dim) array of binned points
+        '''
+        x = self.constrained_rng(n_points, bin=False)
+        lower = self.space.bounds[:, 0]
+        steps = self.space.steps
+        idx = np.clip(self.space.lattice_index_many(x), 0, self.space.n_steps - 1)
+        if not self.constraints:
+            return lower + idx * steps
+        cs = self.constraint_set
+        tol = FEASIBILITY_TOL
+        for attempt in range(2):
+            for row in range(len(cs)):
+                G = cs.evaluate(lower + idx * steps)
+                points = np.flatnonzero(G[:, row] < -tol)
+                plain = np.setdiff1d(np.flatnonzero(cs.A[row] < 0), cs.piece_vars[cs.piece_rows == row])
+                if not len(points) or not len(plain):
+                    continue
+                deficit = -G[points, row]
+                order = plain[np.argsort(self._random_state.uniform(size=(len(points), len(plain))), axis=1)]
+                for k in range(len(plain)):
+                    j = order[:, k]
+                    unit = -cs.A[row, j] * steps[j]
+                    take = np.minimum(idx[points, j], np.maximum(np.ceil(deficit / unit - tol), 0))
+                    idx[points, j] -= take.astype(idx.dtype)
+                    deficit -= take * unit
+            x = lower + idx * steps
+            points = np.flatnonzero(~cs.feasible(x))
+            if not len(points):
+                return x
+            # Complements whose flooring outweighs the remaining volume take their cheapest value next to 0.5
+            for j in np.unique(cs.piece_vars):
+                below = np.floor((0.5 - lower[j]) / steps[j] - tol)
+                above = np.ceil((0.5 - lower[j]) / steps[j] - tol)
+                options = np.clip([below, above], 0, self.space.n_steps[j] - 1)
+                scores = []
+                for option in options:
+                    trial = idx[points].copy()
+                    trial[:, j] = option
+                    scores.append(cs.evaluate(lower + trial * steps).min(axis=1))
+                idx[points, j] = options[np.argmax(scores, axis=0)].astype(idx.dtype)
+        raise ValueError("Constraints cannot be satisfied on the discrete lattice: {}".format(self.constraints))
+
     def suggest(self, utility_function, sampler='greedy', fit_gp=True, **kwargs):
         """
         Potential keywords 
@@ -750,18 +705,14 @@ class DiscreteBayesianOptimization(BayesianOptimization):
         """
         if len(self._space) == 0:
             if self.constraints:
-                return [self._space.array_to_params(x) for x in self.constrained_rng(kwargs.get('n_acqs', 1), bin=True)]
+                return [self._space.array_to_params(x) for x in self.lattice_rng(kwargs.get('n_acqs', 1))]
             else:
                 return [self._space.array_to_params(
                     self.space._bin(self._space.random_sample(constraints=self.get_constraint_dict()))) for _ in
                         range(kwargs.get('n_acqs', 1))]
 
-        # Sklearn's GP throws a large number of warnings at times, but
-        # we don't really need to see them here.
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            if fit_gp:
-                self._gp.fit(self._space.params, self._space.target)
+        if fit_gp:
+            self.fit_gp()
 
         # Finding argmax(s) of the acquisition function.
         if sampler == 'KMBBO':
@@ -0,0 +1,448 @@
+"""
+Compiled inequality constraints of the form g(x) >= 0.
+
+The array-like constraint strings (e.g. '5 - x[0] - x[3]', with complement terms such as
+'((x[2]<0.5) * (((0.5 - x[2])/0.5) * (5.000000-0.000000) + 0.000000) )') are parsed once into
+    g(x) = b + A @ x + sum_p [x[i_p] op_p t_p] * (c_p + w_p @ x)
+so that a whole (N, d) block of candidates is scored with a single matrix product, and the
+Jacobian for SLSQP is available in closed form.
+
+Constraint is the structured form of a single constraint in terms of variable names, as read from
+optimizer.config. It carries its terms, coefficients and complement segments, so a ConstraintSet
+is built from it directly without parsing any strings.
+"""
+import ast
+import operator
+
+import numpy as np
+
+# Slack allowed when checking feasibility, so lattice points on a limit are not lost to float rounding of the sums
+FEASIBILITY_TOL = 1e-9
+
+_COMPARISONS = {'<': operator.lt,
+                '<=': operator.le,
+                '>': operator.gt,
+                '>=': operator.ge}
+_AST_COMPARISONS = {ast.Lt: '<',
+                    ast.LtE: '<=',
+                    ast.Gt: '>',
+                    ast.GtE: '>='}
+
+
+class _Affine(object):
+    """c + w @ x, restricted to the region selected by an optional indicator (var, op, threshold)"""
+
+    def __init__(self, dim, const=0., coef=None, indicator=None):
+        self.const = float(const)
+        self.coef = np.zeros(dim) if coef is None else coef
+        self.indicator = indicator
+
+    def scaled(self, factor):
+        return _Affine(len(self.coef), self.const * factor, self.coef * factor, self.indicator)
+
+
+class _Expression(object):
+    """Sum of affine terms, keyed by their indicator (None for terms that always apply)"""
+
+    def __init__(self, dim, terms=None):
+        self.dim = dim
+        self.terms = terms if terms is not None else {}
+
+    @classmethod
+    def constant(cls, dim, value):
+        return cls(dim, {None: _Affine(dim, const=value)})
+
+    @classmethod
+    def variable(cls, dim, idx):
+        coef = np.zeros(dim)
+        coef[idx] = 1.
+        return cls(dim, {None: _Affine(dim, coef=coef)})
+
+    @classmethod
+    def indicator(cls, dim, idx, op, threshold):
+        key = (idx, op, float(threshold))
+        return cls(dim, {key: _Affine(dim, const=1., indicator=key)})
+
+    @property
+    def constant_value(self):
+        """Value of the expression if it does not depend on x, else None"""
+        if set(self.terms) - {None}:
+            return None
+        term = self.terms.get(None, _Affine(self.dim))
+        return None if term.coef.any() else term.const
+
+    def __add__(self, other):
+        terms = dict(self.terms)
+        for key, term in other.terms.items():
+            if key in terms:
+                terms[key] = _Affine(self.dim, terms[key].const + term.const, terms[key].coef + term.coef, key)
+            else:
+                terms[key] = term
+        return _Expression(self.dim, terms)
+
+    def __neg__(self):
+        return _Expression(self.dim, {key: term.scaled(-1.) for key, term in self.terms.items()})
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def scaled(self, factor):
+        return _Expression(self.dim, {key: term.scaled(factor) for key, term in self.terms.items()})
+
+    def __mul__(self, other):
+        for a, b in ((self, other), (other, self)):
+            value = a.constant_value
+            if value is not None:
+                return b.scaled(value)
+        # indicator * affine is the only nonlinear product supported
+        for a, b in ((self, other), (other, self)):
+            if len(a.terms) == 1 and None not in a.terms and set(b.terms) == {None}:
+                key, gate = next(iter(a.terms.items()))
+                if not gate.coef.any():
+                    inner = b.terms[None].scaled(gate.const)
+                    return _Expression(self.dim, {key: _Affine(self.dim, inner.const, inner.coef, key)})
+        raise SyntaxError("Constraint is not piecewise linear in x")
+
+
+class ConstraintSet(object):
+    """
+    Vectorised evaluator for a list of array-like inequality constraints (each expression >= 0).
+    Instances hold only NumPy arrays, so they and their bound methods are picklable.
+
+    Example
+    -------
+    >>> cs = ConstraintSet(['5 - x[0] - x[1]'], dim=2)
+    >>> cs.feasible(np.array([[1., 2.], [3., 4.]]))
+    array([ True, False])
+    """
+
+    def __init__(self, constraints, dim, keys=None):
+        """
+        Parameters
+        ----------
+        constraints : list of string constraints in terms of array indices x[i], or Constraint objects
+        dim : integer dimension of the space
+        keys : list of the variable names of the space in array order, needed for Constraint objects
+        """
+        constraints = list(constraints)
+        self.text_constraints = [c.array_string(keys) if isinstance(c, Constraint) else c for c in constraints]
+        self.dim = dim
+        n = len(self.text_constraints)
+
+        self.b = np.zeros(n)
+        self.A = np.zeros((n, dim))
+        # Piecewise terms [x[var] op threshold] * (const + coef @ x) added to row
+        rows, variables, ops, thresholds, consts, coefs = [], [], [], [], [], []
+        for row, constraint in enumerate(constraints):
+            if isinstance(constraint, Constraint):
+                expression = constraint.expression(keys)
+            else:
+                expression = self._parse(constraint)
+            for key, term in expression.terms.items():
+                if key is None:
+                    self.b[row] += term.const
+                    self.A[row] += term.coef
+                else:
+                    rows.append(row)
+                    variables.append(key[0])
+                    ops.append(key[1])
+                    thresholds.append(key[2])
+                    consts.append(term.const)
+                    coefs.append(term.coef)
+        self.piece_rows = np.array(rows, dtype=int)
+        self.piece_vars = np.array(variables, dtype=int)
+        self.piece_ops = ops
+        self.piece_thresholds = np.array(thresholds, dtype=float)
+        self.piece_consts = np.array(consts, dtype=float)
+        self.piece_coefs = np.array(coefs, dtype=float).reshape(-1, dim)
+
+    def __len__(self):
+        return len(self.b)
+
+    def _parse(self, constraint):
+        try:
+            tree = ast.parse(constraint.strip(), mode='eval')
+        except SyntaxError:
+            raise SyntaxError("Cannot parse constraint: {}".format(constraint))
+        return self._visit(tree.body, constraint)
+
+    def _visit(self, node, constraint):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return _Expression.constant(self.dim, node.value)
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == 'x':
+            idx = node.slice.value if isinstance(node.slice, ast.Constant) else None
+            if not isinstance(idx, int) or not 0 <= idx < self.dim:
+                raise SyntaxError("Invalid variable index in constraint: {}".format(constraint))
+            return _Expression.variable(self.dim, idx)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            operand = self._visit(node.operand, constraint)
+            return -operand if isinstance(node.op, ast.USub) else operand
+        if isinstance(node, ast.BinOp):
+            left = self._visit(node.left, constraint)
+            right = self._visit(node.right, constraint)
+            if isinstance(node.op, ast.Add):
+                return left + right
+            if isinstance(node.op, ast.Sub):
+                return left - right
+            if isinstance(node.op, ast.Mult):
+                return left * right
+            if isinstance(node.op, ast.Div) and right.constant_value:
+                return left.scaled(1. / right.constant_value)
+        if isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in _AST_COMPARISONS:
+            left = node.left
+            right = self._visit(node.comparators[0], constraint).constant_value
+            if isinstance(left, ast.Subscript) and right is not None:
+                idx = int(np.argmax(self._visit(left, constraint).terms[None].coef))
+                return _Expression.indicator(self.dim, idx, _AST_COMPARISONS[type(node.ops[0])], right)
+        raise SyntaxError("Unsupported term in constraint: {}".format(constraint))
+
+    def _piece_masks(self, X):
+        """(N, n_pieces) float mask of which piecewise terms are active"""
+        masks = np.empty((X.shape[0], len(self.piece_ops)))
+        for p, op in enumerate(self.piece_ops):
+            masks[:, p] = _COMPARISONS[op](X[:, self.piece_vars[p]], self.piece_thresholds[p])
+        return masks
+
+    def active_pieces(self, x):
+        """(n_pieces,) bool mask of the piecewise terms active at a single point x"""
+        x = np.asarray(x, dtype=float).reshape(1, self.dim)
+        return self._piece_masks(x)[0].astype(bool)
+
+    def evaluate(self, X, masks=None):
+        """
+        Constraint values for a block of points.
+
+        Parameters
+        ----------
+        X : ndarray
+            (N, d) array of points
+        masks : optional (n_pieces,) bool array, holds which piecewise terms are active instead of
+            testing their conditions, which makes every constraint linear in x
+
+        Returns
+        -------
+        (N, m) array, feasible where every column is >= 0
+        """
+        X = np.asarray(X, dtype=float).reshape(-1, self.dim)
+        G = X @ self.A.T + self.b
+        if len(self.piece_ops):
+            if masks is None:
+                masks = self._piece_masks(X)
+            pieces = masks * (X @ self.piece_coefs.T + self.piece_consts)
+            for p, row in enumerate(self.piece_rows):
+                G[:, row] += pieces[:, p]
+        return G
+
+    def feasible(self, X, tol=FEASIBILITY_TOL):
+        """(N,) bool mask of points satisfying every constraint"""
+        return (self.evaluate(X) >= -tol).all(axis=1)
+
+    def jacobian(self, x, masks=None):
+        """(m, d) Jacobian of the constraints at a single point x, optionally with fixed piece masks"""
+        x = np.asarray(x, dtype=float).reshape(1, self.dim)
+        J = self.A.copy()
+        if len(self.piece_ops):
+            if masks is None:
+                masks = self._piece_masks(x)[0]
+            for p, row in enumerate(self.piece_rows):
+                J[row] += masks[p] * self.piece_coefs[p]
+        return J
+
+    def scipy_constraints(self, masks=None):
+        """
+        List of scipy.optimize style inequality dicts, one per constraint, with analytic Jacobians.
+        The callables are module level objects, so the dicts can be sent to a multiprocessing Pool.
+        With masks (see evaluate) the dicts are the linear constraints of that branch of the pieces.
+        """
+        return [{'type': 'ineq',
+                 'fun': ConstraintFunction(self, row, masks),
+                 'jac': ConstraintJacobian(self, row, masks)}
+                for row in range(len(self))]
+
+
+class Constraint(object):
+    """
+    Structured inequality constraint in terms of variable names,
+        constant + sum_name terms[name] * name + sum_pieces [name op threshold] * (const + sum coefs[v] * v) >= 0
+    where the pieces are the segments of complement variables.
+
+    Example
+    -------
+    >>> c = Constraint.parse('5 - A - B', names=['A', 'B'])
+    >>> str(c)
+    '5 - A - B'
+    >>> str(c.complement('!Complement!_1', 'A', (0., 5.), 'B', (0., 2.)))
+    '5 + ((!Complement!_1<0.5) * (-5 + 10*!Complement!_1)) + ((!Complement!_1>=0.5) * (2 - 4*!Complement!_1))'
+    """
+
+    def __init__(self, constant=0., terms=None, pieces=None):
+        """
+        Parameters
+        ----------
+        constant : float
+        terms : dict of variable name to coefficient
+        pieces : list of (name, op, threshold, const, coefs) segments, op one of '<', '<=', '>', '>='
+            and coefs a dict of variable name to coefficient
+        """
+        self.constant = float(constant)
+        self.terms = dict(terms) if terms else {}
+        self.pieces = [(name, op, float(threshold), float(const), dict(coefs))
+                       for name, op, threshold, const, coefs in (pieces or [])]
+
+    @classmethod
+    def parse(cls, text, names, constants=None):
+        """
+        Parses a constraint line of optimizer.config, a sum of terms separated by ' + ' or ' - ',
+        each a number, a variable name, or number*name.
+
+        Parameters
+        ----------
+        text : string constraint, e.g. '5 - 20_Xylose-0.25M - 21_Proline'
+        names : variable names allowed in the constraint
+        constants : optional dict of fixed compounds to their values, substituted as numbers
+
+        Returns
+        -------
+        Constraint
+        """
+        names = set(names)
+        constants = constants or {}
+        constant = 0.
+        terms = {}
+        sign = 1.
+        text_products = ' '.join(text.split()).replace(' *', '*').replace('* ', '*')
+        for token in text_products.split():
+            if token in ('+', '-'):
+                sign *= -1. if token == '-' else 1.
+                continue
+            factor, _, name = token.rpartition('*')
+            if name not in names and name not in constants and name.startswith('-') and \
+                    (name[1:] in names or name[1:] in constants):
+                sign, name = -sign, name[1:]
+            try:
+                coef = sign * (float(factor) if factor else 1.)
+            except ValueError:
+                raise SyntaxError("Unknown term '{}' in constraint: {}".format(token, text))
+            if name in names:
+                terms[name] = terms.get(name, 0.) + coef
+            elif name in constants:
+                constant += coef * float(constants[name])
+            else:
+                try:
+                    constant += coef * float(name)
+                except ValueError:
+                    raise SyntaxError("Unknown term '{}' in constraint: {}".format(token, text))
+            sign = 1.
+        return cls(constant, terms)
+
+    def complement(self, key, a_name, a_range, b_name, b_range):
+        """
+        Constraint with the complementary pair a_name, b_name replaced by the single variable key in [0, 1],
+        where a = hi_a - 2 (hi_a - lo_a) key for key < 0.5 and b = 2 lo_b - hi_b + 2 (hi_b - lo_b) key otherwise.
+
+        Parameters
+        ----------
+        key : name of the complement variable
+        a_name, b_name : names of the complementary compounds
+        a_range, b_range : (lo, hi, ...) ranges of the complementary compounds
+
+        Returns
+        -------
+        Constraint
+        """
+        terms = dict(self.terms)
+        pieces = list(self.pieces)
+        a = terms.pop(a_name, 0.)
+        b = terms.pop(b_name, 0.)
+        if a:
+            lo, hi = float(a_range[0]), float(a_range[1])
+            pieces.append((key, '<', 0.5, a * hi, {key: -2. * a * (hi - lo)}))
+        if b:
+            lo, hi = float(b_range[0]), float(b_range[1])
+            pieces.append((key, '>=', 0.5, b * (2. * lo - hi), {key: 2. * b * (hi - lo)}))
+        return Constraint(self.constant, terms, pieces)
+
+    def variables(self):
+        """Set of the variable names the constraint depends on"""
+        names = set(self.terms)
+        for name, _, _, _, coefs in self.pieces:
+            names.add(name)
+            names.update(coefs)
+        return names
+
+    def expression(self, keys):
+        """Compiled _Expression over the array indices of keys"""
+        keys = list(keys)
+        missing = self.variables() - set(keys)
+        if missing:
+            raise ValueError("Constraint {} uses variables not in the space: {}".format(self, sorted(missing)))
+        dim = len(keys)
+        index = {key: idx for idx, key in enumerate(keys)}
+        expression = _Expression.constant(dim, self.constant)
+        for name, coef in self.terms.items():
+            expression = expression + _Expression.variable(dim, index[name]).scaled(coef)
+        for name, op, threshold, const, coefs in self.pieces:
+            segment = _Expression.constant(dim, const)
+            for var, coef in coefs.items():
+                segment = segment + _Expression.variable(dim, index[var]).scaled(coef)
+            expression = expression + _Expression.indicator(dim, index[name], op, threshold) * segment
+        return expression
+
+    def _render(self, label):
+        def affine(const, coefs, leading):
+            text = '{:.12g}'.format(const) if leading or const else ''
+            for name, coef in coefs.items():
+                if not coef:
+                    continue
+                magnitude = '' if abs(coef) == 1 else '{:.12g}*'.format(abs(coef))
+                if text:
+                    text += ' {} {}{}'.format('-' if coef < 0 else '+', magnitude, label(name))
+                else:
+                    text = '{}{}{}'.format('-' if coef < 0 else '', magnitude, label(name))
+            return text or '0'
+
+        text = affine(self.constant, self.terms, True)
+        for name, op, threshold, const, coefs in self.pieces:
+            text += ' + (({}{}{:.12g}) * ({}))'.format(label(name), op, threshold, affine(const, coefs, True))
+        return text
+
+    def array_string(self, keys):
+        """The constraint as a string in terms of array indices x[i]"""
+        index = {key: idx for idx, key in enumerate(keys)}
+        return self._render(lambda name: 'x[{}]'.format(index[name]))
+
+    def __str__(self):
+        return self._render(lambda name: name)
+
+    def __repr__(self):
+        return "Constraint('{}')".format(self)
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+
+class ConstraintFunction(object):
+    """Picklable callable returning the value of a single row of a ConstraintSet at x"""
+
+    def __init__(self, constraint_set, row, masks=None):
+        self.constraint_set = constraint_set
+        self.row = row
+        self.masks = masks
+
+    def __call__(self, x):
+        return self.constraint_set.evaluate(x, self.masks)[0, self.row]
+
+
+class ConstraintJacobian(object):
+    """Picklable callable returning the gradient of a single row of a ConstraintSet at x"""
+
+    def __init__(self, constraint_set, row, masks=None):
+        self.constraint_set = constraint_set
+        self.row = row
+        self.masks = masks
+
+    def __call__(self, x):
+        return self.constraint_set.jacobian(x, self.masks)[self.row]
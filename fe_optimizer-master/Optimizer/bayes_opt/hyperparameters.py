@@ -0,0 +1,91 @@
+"""
+Hyperparameter restarts for GaussianProcessRegressor, optionally run in a process pool.
+
+sklearn runs its n_restarts_optimizer L-BFGS-B restarts of the log marginal likelihood serially.
+Here each restart is an independent single start fit, so the restarts can be spread over a Pool,
+stopped early once enough of them converge to the best optimum, and timed individually.
+"""
+import time
+import warnings
+from multiprocessing import Pool
+
+import numpy as np
+from sklearn.base import clone
+from sklearn.utils import check_random_state
+
+
+def _optimise_from(gp, X, y, theta):
+    """Single L-BFGS-B run of the log marginal likelihood from theta (log-transformed hyperparameters)"""
+    start_time = time.time()
+    gp = clone(gp)
+    gp.set_params(kernel=gp.kernel.clone_with_theta(theta), n_restarts_optimizer=0)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        gp.fit(X, y)
+    return gp.kernel_.theta, gp.log_marginal_likelihood_value_, time.time() - start_time
+
+
+def _optimise_task(args):
+    return _optimise_from(*args)
+
+
+def fit_restarts(gp, X, y, n_restarts=None, processes=1, n_converged=None, tol=1e-3):
+    """
+    Fits the hyperparameters of a GP from its kernel plus n_restarts random starting points.
+
+    Parameters
+    ----------
+    gp: GaussianProcessRegressor, its kernel is the first starting point and is left unchanged
+    X: (n, d) array of training points
+    y: (n,) array of targets
+    n_restarts: integer number of random restarts (default gp.n_restarts_optimizer)
+    processes: integer number of worker processes, restarts run serially for 1
+    n_converged: integer, stop once this many restarts reach the best log marginal likelihood
+        (within tol). None runs every restart.
+    tol: float, tolerance on the log marginal likelihood for converged restarts
+
+    Returns
+    -------
+    gp: fitted clone of gp, with the kernel hyperparameters of the best restart
+    report: list of dicts with the 'restart' index, 'log_marginal_likelihood' and 'seconds' of each restart run
+    """
+    n_restarts = gp.n_restarts_optimizer if n_restarts is None else n_restarts
+    kernel = gp.kernel
+    rng = check_random_state(gp.random_state)
+    bounds = kernel.bounds
+    thetas = [kernel.theta] + [rng.uniform(bounds[:, 0], bounds[:, 1]) for _ in range(n_restarts)]
+    if gp.optimizer is None:
+        thetas = thetas[:1]
+
+    # Restarts run in blocks of one per process, so convergence can be checked between blocks
+    block = max(int(processes), 1)
+    results = []
+    pool = Pool(processes) if processes > 1 and len(thetas) > 1 else None
+    try:
+        for i in range(0, len(thetas), block):
+            tasks = [(gp, X, y, theta) for theta in thetas[i:i + block]]
+            if pool is not None:
+                results.extend(pool.map(_optimise_task, tasks))
+            else:
+                results.extend(_optimise_task(task) for task in tasks)
+            if n_converged:
+                best = max(result[1] for result in results)
+                if sum(result[1] >= best - tol for result in results) >= n_converged:
+                    break
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    report = [{'restart': i, 'log_marginal_likelihood': lml, 'seconds': seconds}
+              for i, (_, lml, seconds) in enumerate(results)]
+    best_theta = max(results, key=lambda result: result[1])[0]
+
+    # Final fit at the best hyperparameters, keeping the configured kernel and optimizer for future fits
+    fitted = clone(gp)
+    fitted.set_params(kernel=kernel.clone_with_theta(best_theta), optimizer=None)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        fitted.fit(X, y)
+    fitted.set_params(kernel=kernel, optimizer=gp.optimizer, random_state=gp.random_state)
+    return fitted, report
@@ -2,18 +2,31 @@ import warnings
 import numpy as np
 from scipy.stats import norm
 from scipy.optimize import minimize
-from multiprocessing import Pool, Queue, Process
+from multiprocessing import Pool, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import os
 import time
-import re
 import itertools
-import pandas as pd
+import copy
 
 from .util import UtilityFunction, ensure_rng
+from .prediction import get_predictor
+from .constraints import ConstraintSet
 from .target_space import _hashable
 
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 
 TIMEOUT_TIME = 4 * 60 * 60  # Hours to timeout
+SLICE_BLOCK_SIZE = 1000  # Candidates scored per acquisition call in the KMBBO slice sampler
+COMPLEMENT_FLIP_TOL = 1e-6  # Complements this close to their threshold are also optimized on the other side
+MINIBATCH_KMEANS_SIZE = 2000  # Slice sets at least this large are clustered with mini-batch k-means
+KMEANS_RESTARTS = 10  # k-means++ initialisations of the KMBBO clustering
+KMEANS_WARM_RESTARTS = 3  # k-means++ initialisations run alongside a warm start from the previous centroids
+
+
+def _utility_gradient(ac):
+    '''utility_and_gradient of the UtilityFunction bound to ac, or None for other acquisition callables'''
+    return getattr(getattr(ac, '__self__', None), 'utility_and_gradient', None)
 
 
 class LocalOptimizer():
@@ -21,6 +34,7 @@ class LocalOptimizer():
 
     def __init__(self, ac, gp, y_max, bounds, method="L-BFGS-B"):
         self.ac = ac
+        self.ac_gradient = _utility_gradient(ac)
         self.gp = gp
         self.y_max = y_max
         self.bounds = bounds
@@ -32,133 +46,435 @@ class LocalOptimizer():
     def func_min(self, x):
         return self.ac(x.reshape(1, -1), gp=self.gp, y_max=self.y_max)
 
+    def func_max_jac(self, x):
+        value, gradient = self.ac_gradient(x, gp=self.gp, y_max=self.y_max)
+        return -value, -gradient
+
+    def func_min_jac(self, x):
+        return self.ac_gradient(x, gp=self.gp, y_max=self.y_max)
+
+    def objective(self, sign):
+        '''
+        Objective and jac argument for scipy.optimize.minimize, using the analytic gradient when available.
+        sign: 1 to minimize the acquisition function, -1 to maximize it.
+        '''
+        if self.ac_gradient is None:
+            return (self.func_min if sign > 0 else self.func_max), None
+        return (self.func_min_jac if sign > 0 else self.func_max_jac), True
+
     def minimizer(self, x_try):
-        return minimize(self.func_min,
-                        x_try.reshape(1, -1),
-                        bounds=self.bounds,
-                        method="L-BFGS-B")
+        fun, jac = self.objective(1)
+        res = minimize(fun,
+                       x_try.reshape(1, -1),
+                       bounds=self.bounds,
+                       method="L-BFGS-B",
+                       jac=jac)
+        res.fun = np.atleast_1d(res.fun)
+        return res
 
     def maximizer(self, x_try):
-        res = minimize(self.func_max,
+        fun, jac = self.objective(-1)
+        res = minimize(fun,
                        x_try.reshape(1, -1),
                        bounds=self.bounds,
-                       method="L-BFGS-B")
-        res.fun[0] = -1 * res.fun[0]
+                       method="L-BFGS-B",
+                       jac=jac)
+        res.fun = -1 * np.atleast_1d(res.fun)
         return res
 
 
-class LocalConstrainedOptimizer():
+class LocalConstrainedOptimizer(LocalOptimizer):
     ''' Class of helper functions for minimization (Class needs to be picklable)'''
 
     def __init__(self, ac, gp, y_max, bounds, method="SLSQP", constraints=()):
-        self.ac = ac
-        self.gp = gp
-        self.y_max = y_max
-        self.bounds = bounds
-        self.method = method
+        super().__init__(ac, gp, y_max, bounds, method)
         self.constraints = constraints
 
-    def func_max(self, x):
-        return -self.ac(x.reshape(1, -1), gp=self.gp, y_max=self.y_max)
-
-    def func_min(self, x):
-        return self.ac(x.reshape(1, -1), gp=self.gp, y_max=self.y_max)
-
-    def minimizer(self, x_try):
-        return minimize(self.func_min,
-                        x_try.reshape(1, -1),
-                        bounds=self.bounds,
-                        method="L-BFGS-B")
-
     def maximizer(self, x_try):
-        res = minimize(self.func_max,
+        fun, jac = self.objective(-1)
+        res = minimize(fun,
                        x_try.reshape(1, -1),
                        bounds=self.bounds,
                        method=self.method,
+                       jac=jac,
                        constraints=self.constraints)
-        res.fun = [-1 * res.fun]
+        res.fun = -1 * np.atleast_1d(res.fun)
         return res
 
 
 class LocalComplementOptimizer(LocalConstrainedOptimizer):
-    ''' Class of helper functions for optimization including complement variables. TAKES STRING CONSTRAINTS NOT FUNCTIONS'''
-
-    def __init__(self, ac, gp, y_max, bounds, method="SLSQP", constraints=[], text_constraints=[]):
+    '''
+    Class of helper functions for optimization including complement variables.
+
+    The complement terms make the constraints discontinuous at each complement threshold (0.5), so SLSQP is run
+    on branches that hold every complement on one side of its threshold, where the constraints are linear.
+    By default only the branch the seed lies in is optimized, then the side of each complement that finishes on
+    its threshold is flipped once, so a restart costs at most k + 1 SLSQP runs for k complements.
+    enumerate_sides=True runs every one of the 2^k branches instead.
+    '''
+
+    def __init__(self, ac, gp, y_max, bounds, method="SLSQP", constraints=(), text_constraints=(),
+                 constraint_set=None, enumerate_sides=False):
         super().__init__(ac, gp, y_max, bounds, method, constraints)
-        self.text_constraints = text_constraints  # Array like constraints
-        self.constraint_sets = []
-
-        # Set up complemets
-        ms = []
-        p = re.compile('(\d+)\]<0.5')
-        for s in self.text_constraints:
-            ms.extend(p.findall(s))
-        # Shifted to avoid sign issue with 0
-        complements = [int(m) + 1 for m in ms]
-        complement_assignments = list(itertools.product(*((x, -x) for x in complements)))
-        for assignment in complement_assignments:
-            dicts = []
-            for constraint in self.text_constraints:
-                dicts.append(self.relax_complement_constraint(constraint, assignment))
-            self.constraint_sets.append(dicts)
-
-    def relax_complement_constraint(self, constraint, assignment):
+        if constraint_set is None:
+            constraint_set = ConstraintSet(text_constraints, len(bounds))
+        self.constraint_set = constraint_set
+        self.enumerate_sides = enumerate_sides
+        # (variable, threshold) of each complement
+        self.complements = sorted(set(zip(constraint_set.piece_vars.tolist(),
+                                          constraint_set.piece_thresholds.tolist())))
+
+    def branch_masks(self, sides):
         '''
-        Takes in string constraint containing complement, and removes one 
-        term and all logicals to create continuous function. 
-        Term removed depends on sign in assignment
-        Arguments
-        ==========
-        constraint: string, array style constraint
-        assignment: tuple, postive or negative integers to dictate removal of complement constraints
-            These should be 1+ index in the array to avoid issue with 0=-0
-            Negative will remove the condition where x[i] >=0.5
-            Positive will remove the condition where x[i] < 0.5
+        Piece masks of the branch with each complement below (True) or at or above (False) its threshold
         '''
-        new_constraint = constraint
-        for i in assignment:
-            if i < 0:
-                p = re.compile(
-                    '- \(\(x\[{:d}+\]>=0.5\) \* \(\(\(x\[{:d}\] - 0.5\)/0.5\) \* \(\d+.\d+-\d+.\d+\) \+ \d+.\d+\) \)'.format(
-                        abs(i + 1), abs(i + 1)))
-                new_constraint = p.sub('', new_constraint)
-                p = re.compile('\(x\[{:d}\]<0.5\) \* '.format(abs(i + 1)))
-                new_constraint = p.sub('', new_constraint)
+        x = np.zeros(len(self.bounds))
+        for (var, threshold), below in zip(self.complements, sides):
+            x[var] = threshold - 1. if below else threshold
+        return self.constraint_set.active_pieces(x)
+
+    def branch_maximizer(self, x_try, sides):
+        '''Maximizes within a single branch, the complement bounds restricted to their side of the threshold'''
+        bounds = self.bounds.copy()
+        for (var, threshold), below in zip(self.complements, sides):
+            if below:
+                bounds[var, 1] = min(bounds[var, 1], threshold)
             else:
-                p = re.compile(
-                    '- \(\(x\[{:d}\]<0.5\) \* \(\(\(0.5 - x\[{:d}\]\)/0.5\) \* \(\d+.\d+-\d+.\d+\) \+ \d+.\d+\) \)'.format(
-                        abs(i - 1), abs(i - 1)))
-                new_constraint = p.sub('', new_constraint)
-                p = re.compile('\(x\[{:d}+\]>=0.5\) \* '.format(abs(i - 1)))
-                new_constraint = p.sub('', new_constraint)
-        funcs = []
-        st = "def f_{}(x): return pd.eval({})\nfuncs.append(f_{})".format(1, new_constraint, 1)
-        exec(st)
-        dict = {'type': 'ineq', 'fun': funcs[0]}
-        return dict
+                bounds[var, 0] = max(bounds[var, 0], threshold)
+        fun, jac = self.objective(-1)
+        res = minimize(fun,
+                       np.clip(x_try, bounds[:, 0], bounds[:, 1]).reshape(1, -1),
+                       bounds=bounds,
+                       method=self.method,
+                       jac=jac,
+                       constraints=self.constraint_set.scipy_constraints(self.branch_masks(sides)))
+        res.fun = -1 * np.atleast_1d(res.fun)
+        # The branch is a relaxation at its edges, so check against the true constraints
+        if not self.constraint_set.feasible(res.x.reshape(1, -1))[0]:
+            res.success = False
+        return res
 
     def maximizer(self, x_try):
-        ''' Overide maximizer to generate multiple options for each complement'''
-        results = []
-        for constraint_set in self.constraint_sets:
-            print(constraint_set)
-            res = minimize(self.func_max,
-                           x_try.reshape(1, -1),
-                           bounds=self.bounds,
-                           method=self.method,
-                           constraints=constraint_set)
-            print(res)
-            res.fun = [-1 * res.fun]
-            tmp = False
-            for dict in self.constraints:
-                if dict['fun'](res.x) < 0: tmp = True
-            if tmp: res.success = False
-            results.append(res)
-        results.sort(key=lambda x: x.fun[0], reverse=True)
+        x_try = np.ravel(x_try)
+        if self.enumerate_sides:
+            results = [self.branch_maximizer(x_try, sides)
+                       for sides in itertools.product((True, False), repeat=len(self.complements))]
+        else:
+            sides = tuple(bool(x_try[var] < threshold) for var, threshold in self.complements)
+            results = [self.branch_maximizer(x_try, sides)]
+            for i, (var, threshold) in enumerate(self.complements):
+                if abs(results[0].x[var] - threshold) < COMPLEMENT_FLIP_TOL:
+                    flipped = sides[:i] + (not sides[i],) + sides[i + 1:]
+                    results.append(self.branch_maximizer(results[0].x, flipped))
+        results.sort(key=lambda res: (res.success, res.fun[0]), reverse=True)
         return results[0]
 
 
-def disc_acq_max(ac, instance, n_acqs=1, n_warmup=100000, n_iter=250, multiprocessing=1):
+# Optimizer instance held by each worker of an AcquisitionExecutor
+_WORKER_STATE = {}
+
+
+def _init_worker(instance):
+    '''Pool initializer, receives the optimizer (and its fitted GP) once per worker'''
+    _WORKER_STATE['instance'] = instance
+
+
+def _run_worker_task(task):
+    '''Calls func(instance, *args) against the optimizer instance held by the worker'''
+    func, args = task
+    return func(_WORKER_STATE['instance'], *args)
+
+
+def _worker_maximize(instance, lo, x_try):
+    lo.gp = instance._gp
+    return lo.maximizer(x_try)
+
+
+def _worker_minimize(instance, lo, x_try):
+    lo.gp = instance._gp
+    return lo.minimizer(x_try)
+
+
+class AcquisitionExecutor(object):
+    '''
+    Long-lived process pool for the acquisition optimizers.
+
+    The optimizer instance, including its fitted GP, is sent to each worker once when the pool starts.
+    The pool is kept for as long as the model version (instance.model_version) is unchanged, so
+    repeated suggest calls on the same model only send the seeds and small helper objects per task.
+    A new model version restarts the workers with the new instance.
+    '''
+
+    def __init__(self, processes):
+        '''
+        Parameters
+        ----------
+        processes: integer number of worker processes
+        '''
+        self.processes = processes
+        self._pool = None
+        self._version = None
+
+    def __getstate__(self):
+        # Pools cannot be pickled, a copied executor starts its own workers when used
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['_version'] = None
+        return state
+
+    @property
+    def version(self):
+        return self._version
+
+    def _get_pool(self, instance):
+        version = instance.model_version
+        if self._pool is None or version != self._version:
+            self.close()
+            if os.name == 'posix':
+                # Workers attaching to shared memory blocks (see _SharedWarmup) register them with the resource
+                # tracker. Started before the pool, the tracker is shared with the workers, so those
+                # registrations are the creator's and are dropped when it unlinks the block. Workers started
+                # first would each run their own tracker, reporting every block as leaked at exit.
+                resource_tracker.ensure_running()
+            self._pool = Pool(self.processes, initializer=_init_worker, initargs=(instance,))
+            self._version = version
+        return self._pool
+
+    def map(self, instance, func, args_list):
+        '''
+        Evaluates func(worker_instance, *args) for each args in args_list, in order.
+
+        Parameters
+        ----------
+        instance: DiscreteBayesianOptimization object instance, shipped to workers on a new model version
+        func: module level function taking the worker copy of the instance as its first argument
+        args_list: list of argument tuples
+
+        Returns
+        -------
+        List of results
+        '''
+        pool = self._get_pool(instance)
+        return pool.map(_run_worker_task, [(func, tuple(args)) for args in args_list])
+
+    def map_local(self, instance, lo, method, x_seeds):
+        '''
+        Runs lo.maximizer or lo.minimizer from each seed, using the GP held by the workers
+
+        Parameters
+        ----------
+        instance: DiscreteBayesianOptimization object instance
+        lo: LocalOptimizer style helper, sent without its GP
+        method: 'maximizer' or 'minimizer'
+        x_seeds: (n, d) array of starting points
+
+        Returns
+        -------
+        List of scipy.optimize results
+        '''
+        func = {'maximizer': _worker_maximize, 'minimizer': _worker_minimize}[method]
+        detached = copy.copy(lo)
+        detached.gp = None
+        return self.map(instance, func, [(detached, x_try) for x_try in x_seeds])
+
+    def close(self):
+        '''Shuts down the worker processes'''
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+        self._pool = None
+        self._version = None
+
+
+def _satisfy_constraints(instance, x):
+    '''Replaces any rows of x that violate the constraints with lattice points that are feasible by construction'''
+    bad = np.flatnonzero(~instance.constraint_set.feasible(x))
+    if len(bad):
+        x[bad] = instance.lattice_rng(len(bad))
+    return x
+
+
+def _top_unseen(instance, x_tries, ys, n_top):
+    '''
+    Dictionary of the n_top highest scoring binned tries, keeping the best score of each bin
+    and dropping any bin already observed or in the partner space.
+    '''
+    order = ys.argsort()[::-1]
+    x_tries = x_tries[order]
+    ys = ys[order]
+    keys = instance.space.lattice_keys(x_tries)
+    # First occurrence of each bin is its best score
+    _, first = np.unique(keys, return_index=True)
+    first.sort()
+    unseen = first[~instance.space.contains_many(x_tries[first], others=(instance.partner_space,))]
+    return {_hashable(x_tries[idx, :]): ys[idx] for idx in unseen[:n_top]}
+
+
+def _store_local_maxima(instance, acqs, acq_threshold, results, n_acqs):
+    '''
+    Attempt to store each successful local maximum if better than the threshold value.
+    Results whose bin is already observed or in the partner space are dropped in one check.
+    If it is new point, delete and replace threshold value.
+    '''
+    results = [res for res in results if res.success]
+    if not results:
+        return acqs, acq_threshold
+    binned = instance.space.bin_many(np.array([res.x for res in results]))
+    seen = instance.space.contains_many(binned, others=(instance.partner_space,))
+    for res, x, is_seen in zip(results, binned, seen):
+        if is_seen:
+            continue
+        if not acqs or res.fun[0] >= acq_threshold[1]:
+            acqs[_hashable(x)] = res.fun[0]
+            if len(acqs) > n_acqs:
+                del acqs[acq_threshold[0]]
+                acq_threshold = sorted(acqs.items(), key=lambda t: (t[1], t[0]))[0]
+    return acqs, acq_threshold
+
+
+def _slice_sample(ac, gp, y_max, a_min, s, n_slice, propose, random_state, block_size=SLICE_BLOCK_SIZE,
+                  timeout=None):
+    '''
+    Slice sampling of the acquisition function, with candidates proposed and scored in blocks.
+
+    Each sample draws a level u uniformly between a_min and the acquisition of the previous sample,
+    then takes the first candidate whose acquisition exceeds u. As the candidates do not depend on u,
+    scoring a whole block in one call and walking through it gives the same chain as scoring
+    candidates one at a time.
+
+    Parameters
+    ----------
+    ac: The acquisition function object that return its point-wise value.
+    gp: fitted GaussianProcessRegressor
+    y_max: float, current maximum target
+    a_min: float, lower bound on the acquisition function
+    s: (1, d) array, starting point of the chain
+    n_slice: integer number of samples
+    propose: callable, propose(n) returns an (n, d) array of candidates
+    random_state: np.random.RandomState
+    block_size: integer number of candidates scored per acquisition call
+    timeout: float, seconds after which a TimeoutError is raised, or None
+
+    Returns
+    -------
+    slice: (n_slice, d) array of samples
+    stats: dictionary of the number of 'proposed' and 'accepted' candidates, 'blocks' scored and 'acceptance_rate'
+    '''
+    start_time = time.time()
+    slice = np.zeros((n_slice, s.shape[1]))
+    u = random_state.uniform(a_min, ac(s, gp=gp, y_max=y_max)[0])
+    filled = 0
+    proposed = 0
+    blocks = 0
+    while filled < n_slice:
+        candidates = propose(block_size)
+        ys = ac(candidates, gp=gp, y_max=y_max)
+        proposed += len(candidates)
+        blocks += 1
+        pos = 0
+        while filled < n_slice:
+            above = np.flatnonzero(ys[pos:] > u)
+            if not len(above):
+                break
+            pos += above[0]
+            slice[filled] = candidates[pos]
+            filled += 1
+            u = random_state.uniform(a_min, ys[pos])
+            pos += 1
+        if timeout is not None and time.time() - start_time > timeout:
+            raise TimeoutError("Failure in KMMBO optimizer. Slice aggregation is failing..."
+                               " Check number of desired slices (n_slice)")
+    stats = {'proposed': proposed,
+             'accepted': filled,
+             'blocks': blocks,
+             'acceptance_rate': filled / float(max(proposed, 1))}
+    return slice, stats
+
+
+def _snap_to_unseen(instance, centroid, taken):
+    '''
+    Nearest lattice point to centroid (in units of steps) that is in bounds, satisfies the constraints,
+    and is neither observed, in the partner space, nor in the taken keys.
+    Searches moves of r steps along one dimension, or r steps up one dimension and down another
+    (which keeps the constrained sums), for increasing r.
+
+    Returns
+    -------
+    (d,) array, or None if there is no such point
+    '''
+    space = instance.space
+    steps = space.steps
+    bounds = space.bounds
+    dim = space.dim
+    base = space.bin_many(centroid.reshape(1, -1))[0]
+    eye = np.eye(dim)
+    pairs = (eye[:, None, :] - eye[None, :, :]).reshape(-1, dim)
+    pairs = pairs[np.abs(pairs).sum(axis=1) > 0]
+    directions = np.vstack((eye, -eye, pairs))
+    for r in range(1, int(space.n_steps.max()) + 1):
+        candidates = base + r * directions * steps
+        candidates = candidates[((candidates >= bounds[:, 0] - 1e-9) & (candidates <= bounds[:, 1] + 1e-9)).all(axis=1)]
+        if not len(candidates):
+            continue
+        candidates = space.bin_many(candidates)
+        candidates = candidates[instance.constraint_set.feasible(candidates)]
+        candidates = candidates[~space.contains_many(candidates, others=(instance.partner_space,))]
+        candidates = candidates[~np.isin(space.lattice_keys(candidates), taken)]
+        if len(candidates):
+            distance = (((candidates - centroid) / steps) ** 2).sum(axis=1)
+            return candidates[distance.argmin()]
+    return None
+
+
+def _cluster_slice(instance, slice, n_acqs, random_state):
+    '''
+    k-means centroids of the slice samples, binned to distinct unseen lattice points.
+
+    When instance.kmbbo_centroids holds the centroids of a previous call with matching shape, the clustering
+    from that warm start competes with KMEANS_WARM_RESTARTS k-means++ initialisations (KMEANS_RESTARTS otherwise),
+    and the lower inertia wins, so stale centroids cannot lock in a poor optimum. The chosen centroids are
+    kept in instance.kmbbo_centroids and the choice in instance.kmbbo_report. Slice sets of at least
+    MINIBATCH_KMEANS_SIZE points are clustered with mini-batch k-means.
+    Centroids whose bin is observed, in the partner space, or shared with an earlier centroid are
+    snapped to the nearest unseen lattice point instead of reclustering.
+
+    Returns
+    -------
+    List of the binned centroids as tuples
+    '''
+    estimator = MiniBatchKMeans if len(slice) >= MINIBATCH_KMEANS_SIZE else KMeans
+    previous = getattr(instance, 'kmbbo_centroids', None)
+    warm_start = previous is not None and np.shape(previous) == (n_acqs, slice.shape[1])
+    fits = {'k-means++': estimator(n_clusters=n_acqs, init='k-means++',
+                                   n_init=KMEANS_WARM_RESTARTS if warm_start else KMEANS_RESTARTS,
+                                   random_state=random_state).fit(slice)}
+    if warm_start:
+        fits['warm start'] = estimator(n_clusters=n_acqs, init=np.asarray(previous, dtype=float), n_init=1,
+                                       random_state=random_state).fit(slice)
+    # Inertia over the whole slice set, as mini-batch k-means reports it for its last batch only
+    inertias = {name: -kmeans.score(slice) for name, kmeans in fits.items()}
+    chosen = min(inertias, key=inertias.get)
+    centroids = fits[chosen].cluster_centers_
+    instance.kmbbo_centroids = centroids
+    instance.kmbbo_report = {'warm_start': warm_start, 'chosen': chosen, 'inertia': inertias}
+
+    binned = instance.space.bin_many(centroids)
+    keys = instance.space.lattice_keys(binned)
+    seen = instance.space.contains_many(binned, others=(instance.partner_space,))
+    seen |= ~instance.constraint_set.feasible(binned)
+    taken = keys[:0]
+    for i in range(n_acqs):
+        if seen[i] or np.isin(keys[i:i + 1], taken)[0]:
+            snapped = _snap_to_unseen(instance, centroids[i], taken)
+            if snapped is None:
+                raise RuntimeError("KMBBO sampling cannot find {} unique new lattice points.".format(n_acqs))
+            binned[i] = snapped
+            keys[i] = instance.space.lattice_keys(snapped.reshape(1, -1))[0]
+        taken = keys[:i + 1]
+    return [_hashable(x) for x in binned]
+
+
+def disc_acq_max(ac, instance, n_acqs=1, n_warmup=100000, n_iter=250, multiprocessing=1, warmup=None):
     """
     A function to find the maximum of the acquisition function
 
@@ -174,6 +490,8 @@ def disc_acq_max(ac, instance, n_acqs=1, n_warmup=100000, n_iter=250, multiproce
     n_warmup: number of times to randomly sample the aquisition function
     n_iter: number of times to run scipy.minimize
     multiprocessing: number of cores for multiprocessing of scipy.minimize
+    warmup: optional tuple of (n, d) binned warm-up points and their (n,) acquisition values,
+        used in place of drawing n_warmup points
 
     Returns
     -------
@@ -191,21 +509,15 @@ def disc_acq_max(ac, instance, n_acqs=1, n_warmup=100000, n_iter=250, multiproce
     lo = LocalOptimizer(ac, gp, y_max, bounds)
 
     # Warm up with random points
-    x_tries = np.floor((random_state.uniform(bounds[:, 0], bounds[:, 1],
-                                             size=(n_warmup, bounds.shape[0])) - bounds[:, 0]) /
-                       steps) * steps + bounds[:, 0]
-    ys = ac(x_tries, gp=gp, y_max=y_max)
+    if warmup is None:
+        x_tries = instance.space.bin_many(random_state.uniform(bounds[:, 0], bounds[:, 1],
+                                                               size=(n_warmup, bounds.shape[0])))
+        ys = ac(x_tries, gp=gp, y_max=y_max)
+    else:
+        x_tries, ys = warmup
 
     # Using a dictionary to update top n_acqs,and retains the threshold for the bottom
-    x_tries = x_tries[ys.argsort()[::-1]]
-    ys = ys[ys.argsort()[::-1]]
-    acqs = {}
-    for idx in range(x_tries.shape[0]):
-        if _hashable(x_tries[idx, :]) in instance.space:
-            continue
-        else:
-            acqs[_hashable(x_tries[idx, :])] = ys[idx]
-        if len(acqs) > n_acqs: break
+    acqs = _top_unseen(instance, x_tries, ys, n_acqs + 1)
     acq_threshold = sorted(acqs.items(), key=lambda t: (t[1], t[0]))[0]
 
     # Explore the parameter space more throughly
@@ -213,45 +525,18 @@ def disc_acq_max(ac, instance, n_acqs=1, n_warmup=100000, n_iter=250, multiproce
                                    size=(n_iter, bounds.shape[0]))
 
     if multiprocessing > 1:
-        # Memory unconscious multiprocessing makes list of n_iter results...
-        pool = Pool(multiprocessing)
-        results = list(pool.imap_unordered(lo.maximizer, x_seeds))
-        pool.close()
-        pool.join()
-        for res in results:
-            if not acqs or res.fun[0] >= acq_threshold[1]:
-                if _hashable(instance.space._bin(res.x)) in instance.space:
-                    continue
-                if _hashable(instance.space._bin(res.x)) in instance.partner_space:
-                    continue
-                acqs[_hashable(instance.space._bin(res.x))] = res.fun[0]
-                if len(acqs) > n_acqs:
-                    del acqs[acq_threshold[0]]
-                    acq_threshold = sorted(acqs.items(), key=lambda t: (t[1], t[0]))[0]
+        results = instance.get_executor(multiprocessing).map_local(instance, lo, 'maximizer', x_seeds)
     else:
-        for x_try in x_seeds:
-            # Maximize the acquisition function
-            res = lo.maximizer(x_try)
-            # See if success
-            if not res.success:
-                continue
+        # Maximize the acquisition function
+        results = [lo.maximizer(x_try) for x_try in x_seeds]
 
-            # Attempt to store it if better than previous maximum.
-            # If it is new point, delete and replace threshold value
-            if not acqs or res.fun[0] >= acq_threshold[1]:
-                if _hashable(instance.space._bin(res.x)) in instance.space:
-                    continue
-                if _hashable(instance.space._bin(res.x)) in instance.partner_space:
-                    continue
-                acqs[_hashable(instance.space._bin(res.x))] = res.fun[0]
-                if len(acqs) > n_acqs:
-                    del acqs[acq_threshold[0]]
-                    acq_threshold = sorted(acqs.items(), key=lambda t: (t[1], t[0]))[0]
+    acqs, acq_threshold = _store_local_maxima(instance, acqs, acq_threshold, results, n_acqs)
 
     return [key for key in acqs.keys()]
 
 
-def disc_acq_KMBBO(ac, instance, n_acqs=1, n_slice=200, n_warmup=100000, n_iter=250, multiprocessing=1):
+def disc_acq_KMBBO(ac, instance, n_acqs=1, n_slice=200, n_warmup=100000, n_iter=250, multiprocessing=1,
+                   slice_block=SLICE_BLOCK_SIZE):
     """
     A function to find the batch sampled acquisition function. Uses slice sampling of continuous space,
     followed by k-means.The k- centroids are then binned and checked for redundancy. 
@@ -267,6 +552,8 @@ def disc_acq_KMBBO(ac, instance, n_acqs=1, n_slice=200, n_warmup=100000, n_iter=
     n_warmup: number of times to randomly sample the aquisition function for a_min
     n_iter: number of times to run scipy.minimize for a_min
     multiprocessing: number of cores for multiprocessing of scipy.minimize
+    slice_block: number of slice sampling candidates scored per acquisition call.
+        Acceptance statistics are kept in instance.slice_stats.
 
     Returns
     -------
@@ -281,7 +568,6 @@ def disc_acq_KMBBO(ac, instance, n_acqs=1, n_slice=200, n_warmup=100000, n_iter=
     bounds = instance._space.bounds
     steps = instance._space.steps
     random_state = instance._random_state
-    slice = np.zeros((n_slice, bounds.shape[0]))
 
     # Class of helper functions for optimization (Class needs to be picklable)
     lo = LocalOptimizer(ac, gp, y_max, bounds)
@@ -296,11 +582,7 @@ def disc_acq_KMBBO(ac, instance, n_acqs=1, n_slice=200, n_warmup=100000, n_iter=
     x_seeds = random_state.uniform(bounds[:, 0], bounds[:, 1],
                                    size=(n_iter, bounds.shape[0]))
     if multiprocessing > 1:
-        # Memory unconscious multiprocessing makes list of n_iter results...
-        pool = Pool(multiprocessing)
-        results = list(pool.imap_unordered(lo.minimizer, x_seeds))
-        pool.close()
-        pool.join()
+        results = instance.get_executor(multiprocessing).map_local(instance, lo, 'minimizer', x_seeds)
         a_min = sorted(results, key=lambda x: x.fun[0])[0].fun[0]
     else:
         for x_try in x_seeds:
@@ -314,50 +596,25 @@ def disc_acq_KMBBO(ac, instance, n_acqs=1, n_slice=200, n_warmup=100000, n_iter=
     # Initial sample over space
     s = random_state.uniform(bounds[:, 0], bounds[:, 1], size=(1, bounds.shape[0]))
     # Slice aggregation
-    for i in range(n_slice):
-        u = random_state.uniform(a_min, ac(s, gp=gp, y_max=y_max))
-        while True:
-            s = random_state.uniform(bounds[:, 0], bounds[:, 1], size=(1, bounds.shape[0]))
-            if ac(s, gp=gp, y_max=y_max) > u:
-                slice[i] = s
-                break
+    slice, instance.slice_stats = _slice_sample(
+        ac, gp, y_max, a_min, s, n_slice,
+        lambda n: random_state.uniform(bounds[:, 0], bounds[:, 1], size=(n, bounds.shape[0])),
+        random_state, block_size=slice_block)
+    if instance.verbose == 3:
+        print("Slice sampling acceptance: ", instance.slice_stats)
 
-    unique = False
-    i = 0
-    while not unique:
-        i += 1
-        if i > 50: raise RuntimeError("KMBBO sampling cannot find unique new values after 50 attempts.")
-        # Find centroids
-        kmeans = KMeans(n_clusters=n_acqs,
-                        random_state=random_state,
-                        n_jobs=multiprocessing).fit(slice)
-
-        # Make hashable, check for uniqueness, and assert length
-        acqs = {}
-        unique = True
-        for i in range(n_acqs):
-            if _hashable(instance.space._bin(kmeans.cluster_centers_[i, :])) in instance.space:
-                unique = False
-                break
-            if _hashable(instance.space._bin(kmeans.cluster_centers_[i, :])) in instance.partner_space:
-                unique = False
-                break
-            acqs[_hashable(instance.space._bin(kmeans.cluster_centers_[i, :]))] = i
-        if len(acqs) != n_acqs:
-            unique = False
-        random_state = None
-    assert len(acqs) == n_acqs, "k-means clustering is not distinct in discretized space!"
-    return [key for key in acqs.keys()]
+    return _cluster_slice(instance, slice, n_acqs, random_state)
 
 
-def disc_constrained_acq_max(ac, instance, n_acqs=1, n_warmup=10000, n_iter=250, multiprocessing=1, complements=False):
+def disc_constrained_acq_max(ac, instance, n_acqs=1, n_warmup=10000, n_iter=250, multiprocessing=1, complements=False,
+                             warmup=None):
     """
     A function to find the maximum of the acquisition function subject to inequality constraints
 
     It uses a combination of random sampling (cheap) and the 'SLSQP'
     optimization method. First by sampling `n_warmup` (1e5) points at random,
     and then running SLSQP from `n_iter` (250) random starting points.
-    #TODO: parallelization. Issues present in pickling constraint functions 
+    The SLSQP restarts run on the instance's AcquisitionExecutor when multiprocessing > 1.
     
     Parameters
     ----------
@@ -368,6 +625,8 @@ def disc_constrained_acq_max(ac, instance, n_acqs=1, n_warmup=10000, n_iter=250,
     n_iter: number of times to run scipy.minimize
     multiprocessing: integer, number of processes to use
     complements: logical, whether or not to consider complements
+    warmup: optional tuple of (n, d) feasible lattice warm-up points and their (n,) acquisition values,
+        used in place of drawing n_warmup points
 
     Returns
     -------
@@ -384,122 +643,56 @@ def disc_constrained_acq_max(ac, instance, n_acqs=1, n_warmup=10000, n_iter=250,
     # Class of helper functions for minimization (Class needs to be picklable)
     if complements:
         lo = LocalComplementOptimizer(ac, gp, y_max, bounds, constraints=instance.get_constraint_dict(),
-                                      text_constraints=instance.constraints)
+                                      constraint_set=instance.constraint_set)
     else:
         lo = LocalConstrainedOptimizer(ac, gp, y_max, bounds, constraints=instance.get_constraint_dict())
 
-    # Warm up with random points
-    if multiprocessing > 1:
-        with Pool(processes=multiprocessing) as pool:
-            results = pool.starmap(instance.constrained_rng,
-                                   [(n_warmup // multiprocessing, True) for _ in range(multiprocessing)])
-        x_tries = np.vstack(results)
+    # Warm up with random lattice points, feasible by construction
+    if warmup is None:
+        x_tries = instance.lattice_rng(n_warmup)
+        ys = ac(x_tries, gp=gp, y_max=y_max)
     else:
-        x_tries = instance.constrained_rng(n_warmup, bin=True)
-
-    # Apply constraints to initial tries
-    mask = np.ones((x_tries.shape[0],), dtype=bool)
-    for dict in instance.get_constraint_dict():
-        for i, x in enumerate(x_tries[:]):
-            if dict['fun'](x) < 0: mask[i] = False
-
-    # Satisfy each initial point to ensure n_warmup
-    # This should not be needed given the nature of the constrained_rng
-    idx = 0
-    while (~mask).any():
-        if mask[idx]:
-            idx += 1
-            continue
-        while ~mask[idx]:
-            mask[idx] = True
-            proposal = instance.constrained_rng(1, bin=True).reshape(-1,)
-            for dict in instance.get_constraint_dict():
-                if dict['fun'](proposal) < 0: mask[idx] = False
-
-    ys = ac(x_tries, gp=gp, y_max=y_max)
+        x_tries, ys = warmup
 
     # Using a dictionary to update top n_acqs,and retains the threshold for the bottom
-    x_tries = x_tries[ys.argsort()[::-1]]
-    ys = ys[ys.argsort()[::-1]]
-    acqs = {}
-    for idx in range(x_tries.shape[0]):
-        if _hashable(x_tries[idx, :]) in instance.space:
-            continue
-        elif _hashable(x_tries[idx, :]) in instance.partner_space:
-            continue
-        else:
-            acqs[_hashable(x_tries[idx, :])] = ys[idx]
-        if len(acqs) >= n_acqs: break
+    acqs = _top_unseen(instance, x_tries, ys, n_acqs)
     acq_threshold = sorted(acqs.items(), key=lambda t: (t[1], t[0]))[0]
 
     # Explore the parameter space more throughly
+    # Ensure seeds satisfy initial constraints, if not replace seeds with satisfactory points
+    x_seeds = _satisfy_constraints(instance, instance.constrained_rng(n_iter, bin=False))
+
     if multiprocessing > 1:
-        with Pool(processes=multiprocessing) as pool:
-            results = pool.starmap(instance.constrained_rng,
-                                   [(n_iter // multiprocessing, False) for _ in range(multiprocessing)])
-        x_seeds = np.vstack(results)
+        results = instance.get_executor(multiprocessing).map_local(instance, lo, 'maximizer', x_seeds)
     else:
-        x_seeds = instance.constrained_rng(n_iter, bin=False)
-
-    # Ensure seeds satisfy initial constraints
-    mask = np.ones((x_seeds.shape[0],), dtype=bool)
-    for dict in instance.get_constraint_dict():
-        for i, x in enumerate(x_seeds[:]):
-            if dict['fun'](x) < 0: mask[i] = False
-
-    # If not replace seeds with satisfactory points
-    idx = 0
-    while (~mask).any():
-        if mask[idx]:
-            idx += 1
-            continue
-        while ~mask[idx]:
-            mask[idx] = True
-            proposal = instance.constrained_rng(1, bin=False).reshape(-1,)
-            for dict in instance.get_constraint_dict():
-                if dict['fun'](proposal) < 0: mask[idx] = False
-
-    for x_try in x_seeds:
-        # Maximize the acquisition function
-        #try:
-        res = lo.maximizer(x_try)
-        #except ValueError: #SLSQP can diverge if it starts near or outside a boundary on a flat surface
-            #print("Note for Phil's benefit, ValueError in sklearn based maximzer.")
-            #print(ValueError)
-            #continue
-        # See if success
-        if not res.success:
-            continue
-
-        # Double check on constraints
-        tmp = False
-        for dict in instance.get_constraint_dict():
-            if dict['fun'](res.x) < 0: tmp = True
-        if tmp: continue
-
-        # Attempt to store it if better than previous maximum.
-        # If it is new point, delete and replace threshold value
-        if not acqs or res.fun[0] >= acq_threshold[1]:
-            if _hashable(instance.space._bin(res.x)) in instance.space:
-                continue
-            if _hashable(instance.space._bin(res.x)) in instance.partner_space:
-                continue
-            acqs[_hashable(instance.space._bin(res.x))] = res.fun[0]
-            if len(acqs) > n_acqs:
-                del acqs[acq_threshold[0]]
-                acq_threshold = sorted(acqs.items(), key=lambda t: (t[1], t[0]))[0]
-
-        #print(acqs)
-
-        if time.time() - start_time > 0.5 * TIMEOUT_TIME:
-            raise TimeoutError("Failure in greedy constrained optimizer."
-                               " Check number gradient based initializations (n_iter).")
+        results = []
+        for x_try in x_seeds:
+            # Maximize the acquisition function
+            #try:
+            results.append(lo.maximizer(x_try))
+            #except ValueError: #SLSQP can diverge if it starts near or outside a boundary on a flat surface
+                #print("Note for Phil's benefit, ValueError in sklearn based maximzer.")
+                #print(ValueError)
+                #continue
+
+            if time.time() - start_time > 0.5 * TIMEOUT_TIME:
+                raise TimeoutError("Failure in greedy constrained optimizer."
+                                   " Check number gradient based initializations (n_iter).")
+
+    # See if success, and double check on constraints
+    results = [res for res in results if res.success]
+    if results:
+        feasible = instance.constraint_set.feasible(np.array([res.x for res in results]))
+        results = [res for res, ok in zip(results, feasible) if ok]
+
+    acqs, acq_threshold = _store_local_maxima(instance, acqs, acq_threshold, results, n_acqs)
     if instance.verbose == 3:
         print("Sorted acquisition function values: ", sorted(acqs.values()))
     return [key for key in acqs.keys()]
 
 
-def disc_constrained_acq_KMBBO(ac, instance, n_acqs=1, n_slice=200, n_warmup=100000, n_iter=250, multiprocessing=1):
+def disc_constrained_acq_KMBBO(ac, instance, n_acqs=1, n_slice=200, n_warmup=100000, n_iter=250, multiprocessing=1,
+                               slice_block=SLICE_BLOCK_SIZE):
     """
     A function to find the batch sampled acquisition function. Uses slice sampling of continuous space,
     followed by k-means.The k- centroids are then binned and checked for redundancy. 
@@ -515,6 +708,8 @@ def disc_constrained_acq_KMBBO(ac, instance, n_acqs=1, n_slice=200, n_warmup=100
     n_warmup: number of times to randomly sample the aquisition function for a_min
     n_iter: number of times to run scipy.minimize for a_min
     multiprocessing: number of cores for multiprocessing of scipy.minimize
+    slice_block: number of slice sampling candidates scored per acquisition call.
+        Acceptance statistics are kept in instance.slice_stats.
 
     Returns
     -------
@@ -529,8 +724,6 @@ def disc_constrained_acq_KMBBO(ac, instance, n_acqs=1, n_slice=200, n_warmup=100
     bounds = instance._space.bounds
     steps = instance._space.steps
     random_state = instance._random_state
-    slice = np.zeros((n_slice, bounds.shape[0]))
-    constraint_dict = instance.get_constraint_dict()
     # Uses LBGFS for minding min (could be outside of constraints)
     lo = LocalOptimizer(ac, gp, y_max, bounds)
 
@@ -544,11 +737,7 @@ def disc_constrained_acq_KMBBO(ac, instance, n_acqs=1, n_slice=200, n_warmup=100
     x_seeds = random_state.uniform(bounds[:, 0], bounds[:, 1],
                                    size=(n_iter, bounds.shape[0]))
     if multiprocessing > 1:
-        # Memory unconscious multiprocessing makes list of n_iter results...
-        pool = Pool(multiprocessing)
-        results = list(pool.imap_unordered(lo.minimizer, x_seeds))
-        pool.close()
-        pool.join()
+        results = instance.get_executor(multiprocessing).map_local(instance, lo, 'minimizer', x_seeds)
         a_min = min(0, sorted(results, key=lambda x: x.fun[0])[0].fun[0])
         # Note: The algorithm needs a minimum l.e.q. 0. 
     else:
@@ -560,81 +749,131 @@ def disc_constrained_acq_KMBBO(ac, instance, n_acqs=1, n_slice=200, n_warmup=100
                 a_min = res.fun[0]
 
     # Initial sample over space
-    invalid = True
-    while invalid:
-        s = instance.constrained_rng(1, bin=False)
-        invalid = False
-        for dict in constraint_dict:
-            if dict['fun'](s.squeeze()) < 0: invalid = True
-            # Slice aggregation
-    start_time = time.time()
-    for i in range(n_slice):
-        u = random_state.uniform(a_min, ac(s, gp=gp, y_max=y_max))
-        while True:
-            invalid = True
-            while invalid:
-                s = instance.constrained_rng(1, bin=False)
-                invalid = False
-                for dict in constraint_dict:
-                    if dict['fun'](s.squeeze()) < 0: invalid = True
-            if ac(s, gp=gp, y_max=y_max) > u:
-                slice[i] = s
-                break
-        if time.time() - start_time > 0.5 * TIMEOUT_TIME:
-            raise TimeoutError("Failure in KMMBO optimizer. Slice aggregation is failing..."
-                               " Check number of desired slices (n_slice)")
+    s = _satisfy_constraints(instance, instance.constrained_rng(1, bin=False))
+    # Slice aggregation
+    slice, instance.slice_stats = _slice_sample(
+        ac, gp, y_max, a_min, s, n_slice,
+        lambda n: _satisfy_constraints(instance, instance.constrained_rng(n, bin=False)),
+        random_state, block_size=slice_block, timeout=0.5 * TIMEOUT_TIME)
+    if instance.verbose == 3:
+        print("Slice sampling acceptance: ", instance.slice_stats)
 
     # k-means
-    start_time = time.time()
-    unique = False
-    i = 0
-    while not unique:
-        i += 1
-        if i > 50: raise RuntimeError("KMBBO sampling cannot find unique new values after 50 attempts.")
-        # Find centroids
-        kmeans = KMeans(n_clusters=n_acqs,
-                        random_state=random_state,
-                        n_jobs=multiprocessing).fit(slice)
-
-        # Make hashable, check for uniqueness, and assert length
-        acqs = {}
-        unique = True
-        for i in range(n_acqs):
-            if _hashable(instance.space._bin(kmeans.cluster_centers_[i, :])) in instance.space:
-                unique = False
-                break
-            if _hashable(instance.space._bin(kmeans.cluster_centers_[i, :])) in instance.partner_space:
-                unique = False
-                break
-            acqs[_hashable(instance.space._bin(kmeans.cluster_centers_[i, :]))] = i
-        if len(acqs) != n_acqs:
-            unique = False
-        random_state = None
-        if time.time() - start_time > 0.5 * TIMEOUT_TIME:
-            raise TimeoutError("Failure in KMMBO optimizer. k-means clustering is failing..."
-                               " Check number of desired slices (n_slice) and batch size")
-
-    assert len(acqs) == n_acqs, "k-means clustering is not distinct in discretized space!"
-    return [key for key in acqs.keys()]
+    return _cluster_slice(instance, slice, n_acqs, random_state)
+
+
+class _SharedWarmup(object):
+    '''
+    Warm-up candidates for the capitalist markets with their GP posterior mean and std, computed once.
+    Every UCB market scores the same candidates as mean + kappa * std, without another GP prediction.
+
+    When shared, the arrays live in a single multiprocessing shared memory block and the object pickles
+    to the block name, so workers map the candidates rather than receiving a copy with each market.
+    '''
+
+    def __init__(self, x, mean, std, shared=False):
+        '''
+        Parameters
+        ----------
+        x: (n, d) array of warm-up points
+        mean: (n,) array of posterior means
+        std: (n,) array of posterior standard deviations
+        shared: bool, whether to place the arrays in shared memory
+        '''
+        self._shm = None
+        self._owner = False
+        data = np.column_stack((x, mean, std))
+        if shared:
+            self._shm = SharedMemory(create=True, size=data.nbytes)
+            self._owner = True
+            self._data = np.ndarray(data.shape, dtype=data.dtype, buffer=self._shm.buf)
+            self._data[:] = data
+        else:
+            self._data = data
+
+    def __getstate__(self):
+        if self._shm is None:
+            return {'data': self._data}
+        return {'name': self._shm.name, 'shape': self._data.shape}
+
+    def __setstate__(self, state):
+        self._owner = False
+        if 'data' in state:
+            self._shm = None
+            self._data = state['data']
+        else:
+            self._shm = SharedMemory(name=state['name'])
+            self._data = np.ndarray(state['shape'], dtype=float, buffer=self._shm.buf)
 
+    @property
+    def x(self):
+        return self._data[:, :-2]
 
-def capitalist_worker(ucb_max, instance, n_warmup, n_iter, complements, procnums, utilities, market_sizes, out_q):
-    """Worker function for multiprocessing"""
-    outdict = {}
-    for k in range(len(utilities)):
-        outdict[procnums[k]] = ucb_max(ac=utilities[k].utility,
-                                       instance=instance,
-                                       n_acqs=market_sizes[k],
-                                       n_warmup=n_warmup,
-                                       n_iter=n_iter,
-                                       multiprocessing=1,
-                                       complements=complements
-                                       )
-    out_q.put(outdict)
+    def ucb(self, kappa):
+        '''Upper confidence bound of every candidate'''
+        return self._data[:, -2] + kappa * self._data[:, -1]
+
+    def close(self):
+        '''Releases the shared memory block (or this process's view of it), removed if this is the creating process'''
+        if self._shm is not None:
+            self._data = None
+            self._shm.close()
+            if self._owner:
+                self._shm.unlink()
+            self._shm = None
+
+
+def _capitalist_warmup(instance, n_warmup, shared=False):
+    '''Draws the shared warm-up candidates, feasible lattice points if constrained, and their GP posterior'''
+    if instance.constraints:
+        x_tries = instance.lattice_rng(n_warmup)
+    else:
+        bounds = instance.space.bounds
+        x_tries = instance.space.bin_many(instance._random_state.uniform(bounds[:, 0], bounds[:, 1],
+                                                                         size=(n_warmup, bounds.shape[0])))
+    predictor = get_predictor(instance._gp)
+    if predictor is not None:
+        mean, std = predictor.predict(x_tries)
+    else:
+        mean, std = instance._gp.predict(x_tries, return_std=True)
+    return _SharedWarmup(x_tries, mean, std, shared=shared)
+
+
+def _run_market(instance, ucb_max, utility, market_size, n_warmup, n_iter, complements, warmup=None):
+    """Runs a single market, returning its suggestions and the seconds it took"""
+    start_time = time.time()
+    if warmup is not None:
+        warmup = (warmup.x, warmup.ucb(utility.kappa))
+    market_kwargs = {'complements': complements} if instance.constraints else {}
+    trials = ucb_max(ac=utility.utility,
+                     instance=instance,
+                     n_acqs=market_size,
+                     n_warmup=n_warmup,
+                     n_iter=n_iter,
+                     multiprocessing=1,
+                     warmup=warmup,
+                     **market_kwargs
+                     )
+    return trials, time.time() - start_time
+
+
+def _capitalist_market(instance, ucb_max, utility, market_size, n_warmup, n_iter, complements, partner_points,
+                       seed, warmup=None):
+    """
+    Worker function for multiprocessing, runs a single market against the worker's copy of the optimizer.
+    The market scores the shared warm-up candidates with its own kappa, then runs its own local refinements.
+    """
+    instance.reset_rng(int(seed))
+    instance.partner_register_many(partner_points, clear=True)
+    try:
+        return _run_market(instance, ucb_max, utility, market_size, n_warmup, n_iter, complements, warmup)
+    finally:
+        if warmup is not None:
+            warmup.close()
 
 
 def disc_capitalist_max(instance, exp_mean=1, n_splits=4, n_acqs=4, n_warmup=10000, n_iter=250, multiprocessing=1,
-                        complements=False):
+                        complements=False, time_budget=0.5 * TIMEOUT_TIME, max_market_runs=None):
     """
     The capitalist acquisition function creates an unequal distribution of greed/wealth in sampling in parallel.
     A suite of Upper Confidence Bound (UCB) acquisition functions are created with hyperparameter lambda drawn
@@ -642,17 +881,31 @@ def disc_capitalist_max(instance, exp_mean=1, n_splits=4, n_acqs=4, n_warmup=100
 
     If the number of acquisitions do not divide evenly into the number of markets, the more greedy markets get used first
 
-    Parallel Algorithm Configuration, F. Hutter and H. Hoos and K. Leyton-Brown, 55--70  (2012)
+    The n_warmup candidates and their GP posterior are computed once and shared by every market (through shared
+    memory when multiprocessing), each market re-scoring them with its own kappa before its local refinements.
+
+    Markets run in rounds. Unique suggestions are kept across rounds, and only the markets that returned
+    redundant points are asked again, for as many points as they are short. The rounds stop when every market
+    is satisfied or the time or market run budget is spent. The budgets are hard: no market is started once
+    they are spent (a round that has started is completed), and fewer than n_acqs suggestions are then
+    returned, the number missing being kept in instance.capitalist_shortfall. Callers that need exactly n_acqs
+    points must complete the batch themselves, e.g. with greedy suggestions, as Experiment.generate_batch does
+    (see Experiment.fill_shortfall). The returned points are in the partner space, so further samplers avoid them.
+    The kappa, request, acceptance and latency of every market run are kept in instance.capitalist_log.
+
+    Parallel Algorithm Configuration, F. Hutter and H. Hoos and K. Leyton-Brown, 55--70  (2012)
     Parameters
     ----------
     instance: DiscreteBayesianOptimization object instance.
     exp_mean: float, mean of exponential distribution funciton to draw from. A lower mean will create a more greedy market
-    n_splits: int, number of
+    n_splits: int, number of markets (UCB acquisition functions)
     n_acqs: int, number of acquisitions to take from acquisition function ac.
     n_warmup: int, number of times to randomly sample the aquisition function
     n_iter: int, number of times to run scipy.minimize
     multiprocessing: int, number of processes to use
     complements: bool, whether or not to consider complements
+    time_budget: float, seconds after which no new round of markets is started
+    max_market_runs: int, maximum number of market runs over all rounds (None for no limit)
 
     Returns
     -------
@@ -666,7 +919,7 @@ def disc_capitalist_max(instance, exp_mean=1, n_splits=4, n_acqs=4, n_warmup=100
     assert n_acqs >= n_splits, "Number of desired acquisitions from capitalist sampling must be larger than the" \
                                " number of market segments"
 
-    ucb_params = np.sort(np.random.exponential(exp_mean, n_splits))
+    ucb_params = np.sort(instance._random_state.exponential(exp_mean, n_splits))
     utilities = []
     for param in ucb_params:
         utilities.append(UtilityFunction(kind='ucb', kappa=param, xi=0.0))
@@ -679,70 +932,72 @@ def disc_capitalist_max(instance, exp_mean=1, n_splits=4, n_acqs=4, n_warmup=100
             else:
                 break
 
+    # One set of warm-up candidates and posterior for every market, re-scored per kappa
+    warmup = _capitalist_warmup(instance, n_warmup, shared=multiprocessing > 1)
+
     results = []
+    seen = set()
+    demands = list(market_sizes)
+    instance.capitalist_log = []
     start_time = time.time()
-    while time.time() - start_time < 0.5 * TIMEOUT_TIME:
-        if multiprocessing > 1:
-            out_q = Queue()
-            procs = []
-            n_processes = min(multiprocessing, len(utilities))
-            chunksize = int(np.ceil(len(utilities) / float(n_processes)))
-            n_processes = int(np.ceil(len(utilities) / chunksize))  # For uneven splits
-            for i in range(n_processes):
-                p = Process(target=capitalist_worker,
-                            args=(ucb_max,
-                                  instance,
-                                  n_warmup,
-                                  n_iter,
-                                  complements,
-                                  range(chunksize * i, chunksize * (i + 1)),
-                                  utilities[chunksize * i:chunksize * (i + 1)],
-                                  market_sizes[chunksize * i:chunksize * (i + 1)],
-                                  out_q))
-                procs.append(p)
-                p.start()
-            resultsdict = {}
-            for i in range(n_processes):
-                resultsdict.update(out_q.get())
-            for p in procs:
-                p.join()
-            trial_results = [item for sublist in resultsdict.values() for item in sublist]
-            np.random.shuffle(trial_results)
-            for trial in trial_results:
-                if _hashable(trial) not in results:
-                    results.append(_hashable(trial))
-                    instance.partner_register(trial)
-        else:
-            for i in range(n_splits):
-                trial_results = ucb_max(ac=utilities[i].utility,
-                                        instance=instance,
-                                        n_acqs=market_sizes[i],
-                                        n_warmup=n_warmup,
-                                        n_iter=n_iter,
-                                        multiprocessing=multiprocessing,
-                                        complements=complements)
-                for trial in trial_results:
-                    if _hashable(trial) not in results:
-                        results.append(_hashable(trial))
-                        instance.partner_register(trial)
-
-        if len(results) >= n_acqs:
-            results = results[:n_acqs]
-            break
-        else:
-            print("Redundancies detected across capitalist markets. ",
-                  "Running another market level loop...",
-                  "\nTime at {:5.2f} minutes. Maximum set to {:5.2f} minutes. ".format((time.time() - start_time) / 60,
-                                                                                       TIMEOUT_TIME * 0.5 / 60),
-                  "Completed {} of {} acquisitions found".format(len(results),n_acqs))
-
-    if len(results) < n_acqs:
-        utility = UtilityFunction(kind='ucb')
-        results.extend(ucb_max(ac=utility[i].utility,
-                               instance=instance,
-                               n_acqs=n_acqs - len(results),
-                               n_warmup=n_warmup,
-                               n_iter=n_iter,
-                               multiprocessing=multiprocessing,
-                               complements=complements))
+
+    def accept(market, trials, seconds, n_round):
+        accepted = 0
+        for trial in trials:
+            trial = _hashable(trial)
+            if trial not in seen and accepted < demands[market]:
+                seen.add(trial)
+                results.append(trial)
+                instance.partner_register(trial)
+                accepted += 1
+        instance.capitalist_log.append({'round': n_round,
+                                        'market': market,
+                                        'kappa': utilities[market].kappa,
+                                        'requested': demands[market],
+                                        'accepted': accepted,
+                                        'seconds': seconds})
+        demands[market] -= accepted
+        if instance.verbose == 3:
+            print("Capitalist market {} (kappa {:.3f}): {} of {} points in {:.2f} s".format(
+                market, utilities[market].kappa, accepted, instance.capitalist_log[-1]['requested'], seconds))
+
+    try:
+        n_round = 0
+        while sum(demands) > 0 and time.time() - start_time < time_budget:
+            # Greedier markets first, and only those still short of points
+            markets = [i for i in range(n_splits) if demands[i] > 0]
+            if max_market_runs is not None:
+                markets = markets[:max(max_market_runs - len(instance.capitalist_log), 0)]
+            if not markets:
+                break
+            if n_round > 0:
+                print("Redundancies detected across capitalist markets. ",
+                      "Asking {} markets for replacements...".format(len(markets)),
+                      "\nTime at {:5.2f} minutes. Maximum set to {:5.2f} minutes. ".format(
+                          (time.time() - start_time) / 60, time_budget / 60),
+                      "Completed {} of {} acquisitions found".format(len(results), n_acqs))
+            if multiprocessing > 1:
+                # Markets are independent tasks on the persistent executor, the partner space is sent with each
+                partner_points = instance.partner_space.points
+                seeds = instance._random_state.randint(0, 2 ** 31 - 1, size=len(markets))
+                outputs = instance.get_executor(multiprocessing).map(
+                    instance, _capitalist_market,
+                    [(ucb_max, utilities[i], demands[i], n_warmup, n_iter, complements, partner_points, seed, warmup)
+                     for i, seed in zip(markets, seeds)])
+                for i, (trials, seconds) in zip(markets, outputs):
+                    accept(i, trials, seconds, n_round)
+            else:
+                for i in markets:
+                    trials, seconds = _run_market(instance, ucb_max, utilities[i], demands[i], n_warmup, n_iter,
+                                                  complements, warmup)
+                    accept(i, trials, seconds, n_round)
+            n_round += 1
+    finally:
+        warmup.close()
+
+    instance.capitalist_shortfall = n_acqs - len(results)
+    if instance.capitalist_shortfall:
+        print("Capitalist sampling budget spent after {} market runs in {:.2f} minutes: found {} of {} unique "
+              "acquisitions.".format(len(instance.capitalist_log), (time.time() - start_time) / 60,
+                                     len(results), n_acqs))
     return results
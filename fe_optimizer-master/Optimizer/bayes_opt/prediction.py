@@ -0,0 +1,181 @@
+"""
+Cached posterior predictions of a fitted GaussianProcessRegressor.
+
+sklearn's predict validates its input and solves against the Cholesky factor on every call, which
+dominates the cost of the single row calls made by the local optimizers. GPPredictor keeps
+K^-1 y (gp.alpha_), the Cholesky factor L and its inverse from the fitted GP, so the mean and std
+of a block of points cost one kernel evaluation and two matrix products, and the gradients of the
+mean and std at a point are available for the acquisition functions.
+"""
+import weakref
+
+import numpy as np
+from scipy.linalg import solve_triangular
+from sklearn.gaussian_process.kernels import Sum, Product, Matern, RBF, ConstantKernel, WhiteKernel
+
+# Predictor for each GP, rebuilt when the GP is refit (gp.alpha_ is replaced by fit)
+_PREDICTORS = weakref.WeakKeyDictionary()
+
+
+def get_predictor(gp):
+    """
+    Returns the cached GPPredictor of a fitted GP, or None if the GP has not been fit.
+
+    Parameters
+    ----------
+    gp : fitted sklearn GaussianProcessRegressor
+
+    Returns
+    -------
+    GPPredictor or None
+    """
+    if not hasattr(gp, 'alpha_'):
+        return None
+    predictor = _PREDICTORS.get(gp)
+    if predictor is None or predictor.alpha is not gp.alpha_:
+        predictor = GPPredictor(gp)
+        _PREDICTORS[gp] = predictor
+    return predictor
+
+
+def kernel_row_gradient(kernel, x, X):
+    """
+    Closed form k(x, X) and its gradient with respect to x, for kernels built from sums and products
+    of Matern (nu = 0.5, 1.5, 2.5, inf), RBF, ConstantKernel and WhiteKernel. This covers the
+    Matern(nu=2.5) * ConstantKernel + WhiteKernel kernel of DiscreteBayesianOptimization.
+
+    Parameters
+    ----------
+    kernel : fitted sklearn kernel
+    x : (d,) array, point at which to differentiate
+    X : (n, d) array of training points
+
+    Returns
+    -------
+    k : (n,) array, or None if the kernel is not supported
+    dk : (n, d) array, or None if the kernel is not supported
+    """
+    if isinstance(kernel, (Sum, Product)):
+        left = kernel_row_gradient(kernel.k1, x, X)
+        right = kernel_row_gradient(kernel.k2, x, X)
+        if left[0] is None or right[0] is None:
+            return None, None
+        if isinstance(kernel, Sum):
+            return left[0] + right[0], left[1] + right[1]
+        return left[0] * right[0], left[1] * right[0][:, None] + left[0][:, None] * right[1]
+    if isinstance(kernel, ConstantKernel):
+        return np.full(X.shape[0], kernel.constant_value), np.zeros(X.shape)
+    if isinstance(kernel, WhiteKernel):
+        # The noise term only contributes when x is compared with itself
+        return np.zeros(X.shape[0]), np.zeros(X.shape)
+    if isinstance(kernel, (Matern, RBF)):
+        nu = kernel.nu if isinstance(kernel, Matern) else np.inf
+        scale = np.asarray(kernel.length_scale, dtype=float) ** 2
+        diff = x - X
+        r = np.sqrt(np.sum(diff ** 2 / scale, axis=1))
+        if nu == 0.5:
+            k = np.exp(-r)
+            factor = -np.divide(k, r, out=np.zeros_like(r), where=r > 0)
+        elif nu == 1.5:
+            e = np.exp(-np.sqrt(3.) * r)
+            k = (1. + np.sqrt(3.) * r) * e
+            factor = -3. * e
+        elif nu == 2.5:
+            e = np.exp(-np.sqrt(5.) * r)
+            k = (1. + np.sqrt(5.) * r + 5. / 3. * r ** 2) * e
+            factor = -5. / 3. * (1. + np.sqrt(5.) * r) * e
+        elif np.isinf(nu):
+            k = np.exp(-0.5 * r ** 2)
+            factor = -k
+        else:
+            return None, None
+        return k, factor[:, None] * diff / scale
+    return None, None
+
+
+class GPPredictor(object):
+    """
+    Posterior mean and standard deviation of a fitted GP, matching gp.predict(x, return_std=True).
+    The kernel is assumed stationary (k(x, x) independent of x), as for every kernel built in this package.
+    """
+
+    def __init__(self, gp):
+        """
+        Parameters
+        ----------
+        gp : fitted sklearn GaussianProcessRegressor
+        """
+        self.kernel = gp.kernel_
+        self.X_train = gp.X_train_
+        self.alpha = gp.alpha_
+        self.L = gp.L_
+        self.L_inv = solve_triangular(self.L, np.eye(self.L.shape[0]), lower=True, check_finite=False)
+        self.y_mean = float(np.ravel(getattr(gp, '_y_train_mean', 0.))[0])
+        self.y_std = float(np.ravel(getattr(gp, '_y_train_std', 1.))[0])
+        self._alpha = np.ravel(self.alpha)
+
+    def predict(self, X):
+        """
+        Posterior mean and std for a block of points.
+
+        Parameters
+        ----------
+        X : ndarray
+            (N, d) array of points
+
+        Returns
+        -------
+        mean, std : (N,) arrays
+        """
+        X = np.atleast_2d(X)
+        K_trans = self.kernel(X, self.X_train)
+        mean = self.y_std * (K_trans @ self._alpha) + self.y_mean
+        V = K_trans @ self.L_inv.T
+        var = self.kernel.diag(X) - np.einsum('ij,ij->i', V, V)
+        var[var < 0] = 0.
+        return mean, self.y_std * np.sqrt(var)
+
+    def kernel_gradient(self, x):
+        """
+        k(x, X_train) and its (n_train, d) gradient with respect to the point x.
+        Closed form for the kernels handled by kernel_row_gradient, otherwise central differences
+        of the kernel row (a single kernel evaluation of 2d rows).
+        """
+        x = np.ravel(x)
+        k, dk = kernel_row_gradient(self.kernel, x, self.X_train)
+        if k is not None:
+            return k, dk
+        k = self.kernel(x.reshape(1, -1), self.X_train)[0]
+        h = 1e-6 * np.maximum(1., np.abs(x))
+        shifts = np.diag(h)
+        K = self.kernel(np.vstack((x + shifts, x - shifts)), self.X_train)
+        d = len(x)
+        return k, ((K[:d] - K[d:]) / (2 * h[:, None])).T
+
+    def predict_gradient(self, x):
+        """
+        Posterior mean and std at a single point, with their gradients.
+
+        Parameters
+        ----------
+        x : ndarray
+            a single point, with len(x) == d
+
+        Returns
+        -------
+        mean, std : floats
+        dmean, dstd : (d,) arrays
+        """
+        x = np.ravel(x)
+        k, dk = self.kernel_gradient(x)
+        v = self.L_inv @ k
+        var = max(self.kernel.diag(x.reshape(1, -1))[0] - v @ v, 0.)
+        mean = self.y_std * (k @ self._alpha) + self.y_mean
+        dmean = self.y_std * (dk.T @ self._alpha)
+        std = self.y_std * np.sqrt(var)
+        if var > 0:
+            # d(var)/dx = -2 dk^T K^-1 k
+            dstd = self.y_std * -(dk.T @ (self.L_inv.T @ v)) / np.sqrt(var)
+        else:
+            dstd = np.zeros_like(x)
+        return mean, std, dmean, dstd
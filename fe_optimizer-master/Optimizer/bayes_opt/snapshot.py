@@ -0,0 +1,181 @@
+"""
+Compact snapshots of a fitted optimizer.
+
+A snapshot file holds a small JSON header, readable on its own, followed by the large arrays of the
+model (the registered points and targets, and the GP training matrix, targets, alpha_ and L_) stored
+raw at aligned offsets. The rest of the optimizer, stripped of those arrays, is a small pickle stored
+as one more array. Loading memory-maps the arrays, so the GP training matrix is read from disk only
+as it is used, and the header (uuid, processed files, ...) is read without touching the arrays.
+
+File layout: SNAPSHOT_MAGIC, header length as little-endian uint64, header JSON, arrays.
+"""
+import copy
+import json
+import os
+import pickle
+import struct
+
+import numpy as np
+
+SNAPSHOT_MAGIC = b'DBOSNAP1'
+SNAPSHOT_ALIGN = 64  # byte alignment of each array in the file
+# Fitted GP arrays kept out of the pickled optimizer
+GP_ARRAYS = ('X_train_', 'y_train_', 'alpha_', 'L_')
+
+
+def _aligned(offset):
+    return -(-offset // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+
+
+def _skeleton(model):
+    '''Shallow copy of the optimizer with its registered points and fitted GP arrays removed'''
+    skeleton = copy.copy(model)
+    space = copy.copy(model._space)
+    space._params = np.empty((0, space.dim))
+    space._target = np.empty(0)
+    space._length = 0
+    space._cache = {}
+    if hasattr(space, '_discrete_cache'):
+        space._discrete_cache = {}
+        space._lattice_index = None
+        space._lattice_pending = []
+    skeleton._space = space
+    gp = copy.copy(model._gp)
+    for name in GP_ARRAYS:
+        if hasattr(gp, name):
+            setattr(gp, name, None)
+    skeleton._gp = gp
+    return skeleton
+
+
+def _detach(model, fname):
+    '''
+    Reads into memory any array of the optimizer memory-mapped from fname, so the file can be replaced
+    (a mapped file cannot be replaced on Windows, and replacing it would leave the maps on the old file).
+    '''
+    path = os.path.realpath(fname)
+
+    def mapped(value):
+        return isinstance(value, np.memmap) and value.filename is not None and \
+            os.path.realpath(value.filename) == path
+
+    space = model._space
+    for name in ('_params', '_target'):
+        if mapped(getattr(space, name, None)):
+            setattr(space, name, np.array(getattr(space, name)))
+    for name in GP_ARRAYS:
+        if mapped(getattr(model._gp, name, None)):
+            setattr(model._gp, name, np.array(getattr(model._gp, name)))
+
+
+def save_snapshot(fname, model, header=None, arrays=None):
+    '''
+    Writes the optimizer to a snapshot file, replacing any existing file in a single rename.
+    Arrays of the optimizer memory-mapped from that file are first read into memory.
+
+    Parameters
+    ----------
+    fname: path of the snapshot file
+    model: BayesianOptimization or DiscreteBayesianOptimization instance
+    header: dict of JSON serialisable metadata, e.g. {'uuid': ..., 'processed_files': [...]}
+    arrays: optional dict of further named arrays to store
+    '''
+    _detach(model, fname)
+    blobs = {'params': np.ascontiguousarray(model.space.params),
+             'target': np.ascontiguousarray(model.space.target)}
+    gp = model._gp
+    aliases = {}
+    for name in GP_ARRAYS:
+        value = getattr(gp, name, None)
+        if value is None:
+            continue
+        if name == 'X_train_' and np.array_equal(value, blobs['params']):
+            # The GP is normally trained on every registered point, stored once
+            aliases[name] = 'params'
+        else:
+            blobs['gp' + name] = np.ascontiguousarray(value)
+    blobs.update({name: np.ascontiguousarray(value) for name, value in (arrays or {}).items()})
+    blobs['model'] = np.frombuffer(pickle.dumps(_skeleton(model), protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+
+    # Offsets are relative to the start of the array section
+    layout = {}
+    offset = 0
+    for name, value in blobs.items():
+        layout[name] = {'dtype': value.dtype.str, 'shape': list(value.shape), 'offset': offset}
+        offset = _aligned(offset + value.nbytes)
+    full_header = dict(header or {})
+    full_header['arrays'] = layout
+    full_header['gp_aliases'] = aliases
+    encoded = json.dumps(full_header).encode('utf-8')
+    start = _aligned(len(SNAPSHOT_MAGIC) + 8 + len(encoded))
+
+    tmp = fname + '.tmp'
+    with open(tmp, 'wb') as handle:
+        handle.write(SNAPSHOT_MAGIC)
+        handle.write(struct.pack('<Q', len(encoded)))
+        handle.write(encoded)
+        for name, value in blobs.items():
+            handle.seek(start + layout[name]['offset'])
+            handle.write(value.tobytes())
+    os.replace(tmp, fname)
+
+
+def _read_header(handle):
+    if handle.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+        raise ValueError("Not an optimizer snapshot: {}".format(handle.name))
+    length, = struct.unpack('<Q', handle.read(8))
+    header = json.loads(handle.read(length).decode('utf-8'))
+    return header, _aligned(len(SNAPSHOT_MAGIC) + 8 + length)
+
+
+def read_snapshot_header(fname):
+    '''
+    Reads the metadata of a snapshot without reading its arrays.
+
+    Returns
+    -------
+    header: dict, as passed to save_snapshot, plus the 'arrays' layout
+    '''
+    with open(fname, 'rb') as handle:
+        return _read_header(handle)[0]
+
+
+def load_snapshot(fname, mmap=True):
+    '''
+    Loads an optimizer written by save_snapshot.
+
+    Parameters
+    ----------
+    fname: path of the snapshot file
+    mmap: bool, memory-map the arrays (read-only) instead of reading them into memory
+
+    Returns
+    -------
+    model: the optimizer, its GP fitted as when saved
+    header: dict of metadata
+    arrays: dict of the further named arrays passed to save_snapshot
+    '''
+    with open(fname, 'rb') as handle:
+        header, start = _read_header(handle)
+        blobs = {}
+        for name, entry in header['arrays'].items():
+            dtype = np.dtype(entry['dtype'])
+            shape = tuple(entry['shape'])
+            count = int(np.prod(shape))
+            if mmap and count and name != 'model':
+                blobs[name] = np.memmap(fname, dtype=dtype, mode='r', offset=start + entry['offset'], shape=shape)
+            else:
+                handle.seek(start + entry['offset'])
+                blobs[name] = np.fromfile(handle, dtype=dtype, count=count).reshape(shape)
+
+    model = pickle.loads(blobs.pop('model').tobytes())
+    params = blobs.pop('params')
+    target = blobs.pop('target')
+    if len(target):
+        model._space.register_many(np.array(params), np.array(target))
+    for name in GP_ARRAYS:
+        if name in header['gp_aliases']:
+            setattr(model._gp, name, params)
+        elif 'gp' + name in blobs:
+            setattr(model._gp, name, blobs.pop('gp' + name))
+    return model, header, blobs
@@ -6,6 +6,10 @@ import numpy as np
 from .util import ensure_rng
 
 
+# Relative tolerance (in steps) when flooring onto the lattice, so binning an already binned point is idempotent
+_BIN_TOL = 1e-9
+
+
 def _hashable(x):
     """ ensure that an point is hashable by a python dict """
     return tuple(map(float, x))
@@ -53,9 +57,10 @@ class TargetSpace(object):
             dtype= float
         )
 
-        # preallocated memory for X and Y points
+        # preallocated memory for X and Y points, only the first _length rows are valid
         self._params = np.empty(shape=(0, self.dim))
         self._target = np.empty(shape=(0))
+        self._length = 0
 
         # keep track of unique points we have seen so far
         self._cache = {}
@@ -64,8 +69,19 @@ class TargetSpace(object):
         return _hashable(x) in self._cache
 
     def __len__(self):
-        assert len(self._params) == len(self._target)
-        return len(self._target)
+        return self._length
+
+    def __getstate__(self):
+        # Trim the unused capacity so pickles only hold the registered points
+        state = self.__dict__.copy()
+        state['_params'] = self.params.copy()
+        state['_target'] = self.target.copy()
+        return state
+
+    def __setstate__(self, state):
+        # Pickles written before the preallocated store have exact length arrays
+        state.setdefault('_length', len(state['_target']))
+        self.__dict__.update(state)
 
     @property
     def empty(self):
@@ -73,11 +89,17 @@ class TargetSpace(object):
 
     @property
     def params(self):
-        return self._params
+        """View of the registered points, shape (len(self), dim)"""
+        return self._params[:self._length]
 
     @property
     def target(self):
-        return self._target
+        """View of the registered target values, shape (len(self),)"""
+        return self._target[:self._length]
+
+    @property
+    def capacity(self):
+        return self._target.shape[0]
 
     @property
     def dim(self):
@@ -154,6 +176,39 @@ class TargetSpace(object):
             )
         return x
 
+    def _as_array_many(self, params):
+        """Coerce an (n, dim) array, a list of arrays, or a list of param dicts to a 2d float array"""
+        if isinstance(params, list) and params and isinstance(params[0], dict):
+            params = self.params_to_array(params)
+        x = np.asarray(params, dtype=float)
+        x = x.reshape(-1, self.dim) if x.size else np.empty(shape=(0, self.dim))
+        return x
+
+    def _reserve(self, n_new):
+        """
+        Ensures the preallocated X and Y buffers can hold n_new more points.
+        Capacity is doubled when exceeded, so appends run in amortized constant time.
+        """
+        required = self._length + n_new
+        if required <= self.capacity:
+            return
+        capacity = max(required, 2 * self.capacity, 16)
+
+        params = np.empty(shape=(capacity, self.dim))
+        target = np.empty(shape=(capacity))
+        params[:self._length] = self.params
+        target[:self._length] = self.target
+        self._params = params
+        self._target = target
+
+    def _append(self, x, target):
+        """Copy validated rows into the preallocated buffers"""
+        n_new = x.shape[0]
+        self._reserve(n_new)
+        self._params[self._length:self._length + n_new] = x
+        self._target[self._length:self._length + n_new] = target
+        self._length += n_new
+
     def register(self, params, target):
         """
         Append a point and its target value to the known data.
@@ -194,8 +249,41 @@ class TargetSpace(object):
         # Insert data into unique dictionary
         self._cache[_hashable(x.ravel())] = target
 
-        self._params = np.concatenate([self._params, x.reshape(1, -1)])
-        self._target = np.concatenate([self._target, [target]])
+        self._append(x.reshape(1, -1), target)
+
+    def register_many(self, params, targets):
+        """
+        Append a block of points and their target values to the known data,
+        e.g. a whole completed plate, with a single copy into the store.
+
+        Parameters
+        ----------
+        params : ndarray or list
+            (n, dim) array, or list of points/param dicts
+
+        targets : array-like
+            n target function values
+
+        Raises
+        ------
+        KeyError:
+            if any point is not unique, in which case nothing is registered
+        """
+        x = self._as_array_many(params)
+        y = np.asarray(targets, dtype=float).ravel()
+        if x.shape[0] != y.shape[0]:
+            raise ValueError("Number of points ({}) does not match ".format(x.shape[0]) +
+                             "number of targets ({}).".format(y.shape[0]))
+
+        keys = [_hashable(row) for row in x]
+        seen = set()
+        for row, key in zip(x, keys):
+            if key in self._cache or key in seen:
+                raise KeyError('Data point {} is not unique in continuous space'.format(row))
+            seen.add(key)
+
+        self._cache.update(zip(keys, y))
+        self._append(x, y)
 
     def probe(self, params):
         """
@@ -338,18 +426,139 @@ class DiscreteSpace(TargetSpace):
         super(DiscreteSpace, self).__init__(target_func=target_func,
                                             pbounds=self._pbounds,
                                             random_state=random_state)
-        
+        self._set_lattice()
+
+    def __setstate__(self, state):
+        super(DiscreteSpace, self).__setstate__(state)
+        # Pickles written before the lattice index are rebuilt from the discrete cache
+        if '_lattice_radix' not in state:
+            self._set_lattice()
+
     @property
     def steps(self):
         return self._steps
-    
-    def _bin(self,x):
-        # TODO: clean using modulo 
-        binned  = np.empty((self.dim,1))
-        for col, (lower, upper) in enumerate(self._bounds):
-            binned[col] = np.floor((x[col]-lower)/self._steps[col])*self._steps[col]+lower
-        return binned.ravel()
-    
+
+    @property
+    def n_steps(self):
+        """Number of lattice values along each dimension"""
+        return self._lattice_radix - 2
+
+    def _set_lattice(self):
+        """
+        Sets up the integer lattice used for vectorised membership checks.
+        Each dimension has n_steps valid step indices, offset by one so that slot 0 and slot n_steps + 1
+        collect any points below or above the bounds without colliding with points on the lattice.
+        Keys are the mixed radix packing of these indices into an int64, or the raw index bytes
+        if the lattice is too large to pack.
+        """
+        n_steps = np.floor((self._bounds[:, 1] - self._bounds[:, 0]) / self._steps + _BIN_TOL).astype(np.int64) + 1
+        self._lattice_radix = n_steps + 2
+        size = 1
+        for radix in self._lattice_radix:
+            size *= int(radix)
+        if size < 2 ** 63:
+            self._lattice_multipliers = np.cumprod(np.concatenate([[1], self._lattice_radix[:-1]])).astype(np.int64)
+        else:
+            self._lattice_multipliers = None
+        self._lattice_index = None
+        self._lattice_pending = []
+
+    def lattice_index_many(self, X):
+        """
+        Step index of each point along each dimension, i.e. floor((x - lower) / step).
+
+        Parameters
+        ----------
+        X : ndarray
+            (n, dim) array of points
+
+        Returns
+        -------
+        (n, dim) int64 array
+        """
+        X = np.asarray(X, dtype=float).reshape(-1, self.dim)
+        return np.floor((X - self._bounds[:, 0]) / self._steps + _BIN_TOL).astype(np.int64)
+
+    def bin_many(self, X):
+        """
+        Floor a block of points onto the discrete lattice.
+
+        Parameters
+        ----------
+        X : ndarray
+            (n, dim) array of points
+
+        Returns
+        -------
+        (n, dim) array of binned points
+        """
+        return self.lattice_index_many(X) * self._steps + self._bounds[:, 0]
+
+    def lattice_keys(self, X):
+        """
+        Integer lattice keys for a block of points. Points in the same bin share a key.
+
+        Parameters
+        ----------
+        X : ndarray
+            (n, dim) array of points, binned or not
+
+        Returns
+        -------
+        (n,) int64 array, or (n,) void array of index bytes for very large lattices
+        """
+        idx = np.clip(self.lattice_index_many(X) + 1, 0, self._lattice_radix - 1)
+        if self._lattice_multipliers is not None:
+            return idx @ self._lattice_multipliers
+        idx = np.ascontiguousarray(idx)
+        return idx.view(np.dtype((np.void, idx.dtype.itemsize * self.dim))).ravel()
+
+    @property
+    def lattice_index(self):
+        """Sorted unique lattice keys of every point in the discrete cache"""
+        if self._lattice_index is None:
+            cached = np.array(list(self._discrete_cache), dtype=float).reshape(-1, self.dim)
+            self._lattice_index = np.unique(self.lattice_keys(cached))
+            self._lattice_pending = []
+        elif self._lattice_pending:
+            self._lattice_index = np.unique(np.concatenate([self._lattice_index] + self._lattice_pending))
+            self._lattice_pending = []
+        return self._lattice_index
+
+    def contains_many(self, X, others=()):
+        """
+        Vectorised membership check of the bins of a block of points.
+
+        Parameters
+        ----------
+        X : ndarray
+            (n, dim) array of points, binned or not
+
+        others : iterable of DiscreteSpace
+            further spaces to check against, e.g. the PartnerSpace of running points
+
+        Returns
+        -------
+        (n,) bool mask, True where the bin of the point is in this space or any of others
+        """
+        keys = self.lattice_keys(X)
+        mask = np.isin(keys, self.lattice_index)
+        for other in others:
+            mask |= np.isin(keys, other.lattice_index)
+        return mask
+
+    def _index_lattice(self, binned):
+        """Queue binned points for merging into the sorted lattice index"""
+        if self._lattice_index is not None:
+            self._lattice_pending.append(self.lattice_keys(binned))
+
+    def set_bounds(self, new_bounds):
+        super(DiscreteSpace, self).set_bounds(new_bounds)
+        self._set_lattice()
+
+    def _bin(self, x):
+        return self.bin_many(np.asarray(x, dtype=float).reshape(1, -1))[0]
+
     def __contains__(self,x):
         return(_hashable(self._bin(x))) in self._discrete_cache
     
@@ -392,11 +601,43 @@ class DiscreteSpace(TargetSpace):
         if x in self and verbose:
             print('Data point {} is not unique. \n(Discrete value {})'.format(x,self._bin(x)))
         # Insert data into unique dictionary
-        self._discrete_cache[_hashable(self._bin(x))] = target
+        binned = self._bin(x)
+        self._discrete_cache[_hashable(binned)] = target
         self._cache[_hashable(x.ravel())] = target
+        self._index_lattice(binned)
+
+        self._append(x.reshape(1, -1), target)
+
+    def register_many(self, params, targets, verbose=False):
+        """
+        Append a block of points and their target values to the known data,
+        e.g. a whole completed plate, with a single copy into the store.
+        As with register(), repeated discrete values are allowed.
+
+        Parameters
+        ----------
+        params : ndarray or list
+            (n, dim) array, or list of points/param dicts
 
-        self._params = np.concatenate([self._params, x.reshape(1, -1)])
-        self._target = np.concatenate([self._target, [target]])
+        targets : array-like
+            n target function values
+        """
+        x = self._as_array_many(params)
+        y = np.asarray(targets, dtype=float).ravel()
+        if x.shape[0] != y.shape[0]:
+            raise ValueError("Number of points ({}) does not match ".format(x.shape[0]) +
+                             "number of targets ({}).".format(y.shape[0]))
+
+        binned = self.bin_many(x)
+        for row, bin_row, target in zip(x, binned, y):
+            key = _hashable(bin_row)
+            if verbose and key in self._discrete_cache:
+                print('Data point {} is not unique. \n(Discrete value {})'.format(row, bin_row))
+            self._discrete_cache[key] = target
+            self._cache[_hashable(row)] = target
+        self._index_lattice(binned)
+
+        self._append(x, y)
         
 class PartnerSpace(DiscreteSpace):
     '''
@@ -407,10 +648,17 @@ class PartnerSpace(DiscreteSpace):
 
     def __len__(self):
         return len(self._cache)
+
+    @property
+    def points(self):
+        """(n, dim) array of the cached (unbinned) points"""
+        return np.array(list(self._cache), dtype=float).reshape(-1, self.dim)
     
     def clear(self):
         self._discrete_cache = {}
         self._cache = {}
+        self._lattice_index = None
+        self._lattice_pending = []
         
     def register(self, params, verbose=False):
         """
@@ -427,5 +675,26 @@ class PartnerSpace(DiscreteSpace):
         if x in self and verbose:
             print('Data point {} is not unique in partner space. \n(Discrete value {})'.format(x,self._bin(x)))
         # Insert data into unique dictionary
-        self._discrete_cache[_hashable(self._bin(x))] = -1
+        binned = self._bin(x)
+        self._discrete_cache[_hashable(binned)] = -1
         self._cache[_hashable(x.ravel())] = -1
+        self._index_lattice(binned)
+
+    def register_many(self, params, verbose=False):
+        """
+        Append a block of points with value of -1 to the partner cache.
+
+        Parameters
+        ----------
+        params : ndarray or list
+            (n, dim) array, or list of points/param dicts
+        """
+        x = self._as_array_many(params)
+        binned = self.bin_many(x)
+        for row, bin_row in zip(x, binned):
+            key = _hashable(bin_row)
+            if verbose and key in self._discrete_cache:
+                print('Data point {} is not unique in partner space. \n(Discrete value {})'.format(row, bin_row))
+            self._discrete_cache[key] = -1
+            self._cache[_hashable(row)] = -1
+        self._index_lattice(binned)
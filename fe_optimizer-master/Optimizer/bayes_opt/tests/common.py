@@ -0,0 +1,19 @@
+import numpy as np
+
+from ..bayesian_optimization import DiscreteBayesianOptimization
+
+PRANGE = {'a': (0., 5., 0.5), 'b': (0., 5., 0.5), 'c': (0., 5., 0.25), 'd': (0., 5., 0.25)}
+CONSTRAINTS = ['5 - c - d']
+
+
+def make_optimizer(n_points=30, random_state=0, constraints=CONSTRAINTS, fit=True):
+    '''Small constrained optimizer with n_points random observations of a linear target'''
+    dbo = DiscreteBayesianOptimization(f=None, prange=PRANGE, random_state=random_state, verbose=0,
+                                       constraints=constraints)
+    x = np.unique(dbo.lattice_rng(n_points), axis=0)
+    rng = np.random.RandomState(random_state)
+    dbo.register_many(x, x @ rng.uniform(-1, 1, x.shape[1]) + 0.1 * rng.randn(len(x)))
+    if fit:
+        dbo._gp.set_params(n_restarts_optimizer=1)
+        dbo.fit_gp()
+    return dbo
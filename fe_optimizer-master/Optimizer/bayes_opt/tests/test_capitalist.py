@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from ..parallel_opt import disc_capitalist_max
+from .common import make_optimizer
+
+OPTIMIZER_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Workers started before the first shared block, the case that used to leave tracker registrations behind
+LEAK_SCRIPT = '''
+import sys
+sys.path.insert(0, {path!r})
+from bayes_opt.tests.common import make_optimizer
+from bayes_opt.parallel_opt import disc_capitalist_max
+dbo = make_optimizer()
+dbo.get_executor(2)._get_pool(dbo)
+for _ in range(2):
+    disc_capitalist_max(dbo, n_splits=2, n_acqs=4, n_warmup=500, n_iter=2, multiprocessing=2)
+dbo.executor.close()
+'''
+
+
+def _shared_blocks():
+    return {name for name in os.listdir('/dev/shm') if name.startswith('psm_')}
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason="shared memory blocks are not listed as files")
+def test_capitalist_leaves_no_shared_memory():
+    dbo = make_optimizer()
+    before = _shared_blocks()
+    try:
+        suggestions = disc_capitalist_max(dbo, n_splits=2, n_acqs=4, n_warmup=500, n_iter=2, multiprocessing=2)
+    finally:
+        dbo.executor.close()
+    assert len(set(suggestions)) == 4
+    assert _shared_blocks() <= before
+
+
+@pytest.mark.skipif(os.name != 'posix', reason="the resource tracker only runs on posix")
+def test_capitalist_workers_do_not_leak_tracker_registrations():
+    result = subprocess.run([sys.executable, '-c', LEAK_SCRIPT.format(path=OPTIMIZER_DIR)],
+                            capture_output=True, text=True, timeout=600)
+    assert result.returncode == 0, result.stderr
+    assert 'leaked' not in result.stderr
+    assert 'No such file' not in result.stderr
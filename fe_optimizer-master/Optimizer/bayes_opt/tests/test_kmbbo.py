@@ -0,0 +1,18 @@
+from ..util import UtilityFunction
+from .common import make_optimizer
+
+
+def test_kmbbo_warm_starts_from_the_previous_centroids():
+    dbo = make_optimizer()
+    utility = UtilityFunction(kind='ucb', kappa=2.5, xi=0)
+    kwargs = {'n_acqs': 4, 'n_slice': 100, 'n_warmup': 1000, 'n_iter': 5}
+
+    first = dbo.suggest(utility, sampler='KMBBO', fit_gp=False, **kwargs)
+    assert not dbo.kmbbo_report['warm_start']
+    assert dbo.kmbbo_report['chosen'] == 'k-means++'
+    assert dbo.kmbbo_centroids.shape == (4, len(dbo.space.keys))
+
+    second = dbo.suggest(utility, sampler='KMBBO', fit_gp=False, **kwargs)
+    assert dbo.kmbbo_report['warm_start']
+    assert set(dbo.kmbbo_report['inertia']) == {'k-means++', 'warm start'}
+    assert len(first) == len(second) == 4
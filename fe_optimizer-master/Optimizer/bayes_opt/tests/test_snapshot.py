@@ -0,0 +1,27 @@
+import numpy as np
+
+from ..snapshot import GP_ARRAYS, load_snapshot, save_snapshot
+from .common import make_optimizer
+
+
+def test_snapshot_saved_over_the_file_it_was_loaded_from(tmp_path):
+    fname = str(tmp_path / 'optimizer.snapshot')
+    dbo = make_optimizer()
+    save_snapshot(fname, dbo, header={'uuid': 'first'})
+
+    loaded, header, _ = load_snapshot(fname)
+    assert header['uuid'] == 'first'
+    assert any(isinstance(getattr(loaded._gp, name), np.memmap) for name in GP_ARRAYS)
+    x = np.unique(loaded.lattice_rng(20), axis=0)
+    expected = loaded._gp.predict(x)
+    loaded.register(params=x[0], target=1.)
+    save_snapshot(fname, loaded, header={'uuid': 'second'})
+    for name in GP_ARRAYS:
+        assert not isinstance(getattr(loaded._gp, name), np.memmap)
+
+    reloaded, header, _ = load_snapshot(fname)
+    assert header['uuid'] == 'second'
+    assert len(reloaded.space) == len(dbo.space) + 1
+    np.testing.assert_array_equal(reloaded.space.params, loaded.space.params)
+    np.testing.assert_allclose(reloaded._gp.predict(x), expected)
+    np.testing.assert_allclose(loaded._gp.predict(x), expected)
@@ -7,6 +7,8 @@ import numpy as np
 from scipy.stats import norm
 from scipy.optimize import minimize
 
+from .prediction import get_predictor
+
 
 
 def acq_max(ac, gp, y_max, bounds, random_state, n_warmup=100000, n_iter=250):
@@ -105,28 +107,65 @@ class UtilityFunction(object):
         if self.kind == 'poi':
             return self._poi(x, gp, y_max, self.xi)
 
+    def utility_and_gradient(self, x, gp, y_max):
+        """
+        Value and analytic gradient of the utility at a single point, for optimizers called with jac=True.
+
+        Parameters
+        ----------
+        x: ndarray, a single point
+        gp: fitted GaussianProcessRegressor
+        y_max: float, current maximum target
+
+        Returns
+        -------
+        value: float
+        gradient: (d,) array
+        """
+        predictor = get_predictor(gp)
+        if predictor is None:
+            raise ValueError("The GP must be fit before utility gradients can be computed.")
+        mean, std, dmean, dstd = predictor.predict_gradient(x)
+        if self.kind == 'ucb':
+            return mean + self.kappa * std, dmean + self.kappa * dstd
+        if std <= 0:
+            z = np.inf if mean - y_max - self.xi > 0 else -np.inf
+            if self.kind == 'ei':
+                return max(mean - y_max - self.xi, 0.), dmean * norm.cdf(z)
+            return norm.cdf(z), np.zeros_like(dmean)
+        z = (mean - y_max - self.xi) / std
+        if self.kind == 'ei':
+            return (mean - y_max - self.xi) * norm.cdf(z) + std * norm.pdf(z), \
+                   dmean * norm.cdf(z) + dstd * norm.pdf(z)
+        if self.kind == 'poi':
+            return norm.cdf(z), norm.pdf(z) * (dmean - z * dstd) / std
+
     @staticmethod
-    def _ucb(x, gp, kappa):
+    def _predict(x, gp):
+        """Mean and std from the cached predictor of a fitted GP, or gp.predict for an unfitted one"""
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            mean, std = gp.predict(x, return_std=True)
+            predictor = get_predictor(gp)
+            if predictor is None:
+                return gp.predict(x, return_std=True)
+            return predictor.predict(x)
+
+    @staticmethod
+    def _ucb(x, gp, kappa):
+        mean, std = UtilityFunction._predict(x, gp)
 
         return mean + kappa * std
 
     @staticmethod
     def _ei(x, gp, y_max, xi):
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            mean, std = gp.predict(x, return_std=True)
+        mean, std = UtilityFunction._predict(x, gp)
 
         z = (mean - y_max - xi) / std
         return (mean - y_max - xi) * norm.cdf(z) + std * norm.pdf(z)
 
     @staticmethod
     def _poi(x, gp, y_max, xi):
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            mean, std = gp.predict(x, return_std=True)
+        mean, std = UtilityFunction._predict(x, gp)
 
         z = (mean - y_max - xi) / std
         return norm.cdf(z)
@@ -311,6 +350,24 @@ def get_rnd_quantities_alt(max_amount, dimension, random_state):
     return get_rnd_simplex(dimension, random_state) * m
 
 
+def get_rnd_simplex_many(dimension, n_points, random_state):
+    '''
+    n_points uniform points on a simplex, as an (n_points, dimension) array. Batched get_rnd_simplex.
+    '''
+    t = np.sort(random_state.uniform(0, 1, (n_points, max(dimension - 1, 0))), axis=1)
+    t = np.hstack((np.zeros((n_points, 1)), t, np.ones((n_points, 1))))
+    return np.diff(t, axis=1)
+
+
+def get_rnd_quantities_many(max_amount, dimension, n_points, random_state):
+    '''
+    Get an (n_points, dimension) array of quantities x_i>=0 whose rows sum up to max_amount at most.
+    Batched get_rnd_quantities, max_amount may be a scalar or an (n_points,) array.
+    '''
+    r = random_state.uniform(0, 1, n_points)
+    m = r ** (1 / (dimension + 1)) * np.asarray(max_amount, dtype=float)
+    return get_rnd_simplex_many(dimension, n_points, random_state) * m[:, None]
+
 
 if __name__ == "__main__":
     for i in range(10):
@@ -6,14 +6,17 @@ Allowed ranges of quantities for every component in a dict (Experiment.rng)
 Adapted for Formulation Engine by Jack Gee
 ---Need to confirm it can read in the required headers and dispense data---
 '''
-from bayes_opt import DiscreteBayesianOptimization, UtilityFunction
+from bayes_opt import DiscreteBayesianOptimization, UtilityFunction, Events, AcquisitionExecutor, Constraint
+from bayes_opt.snapshot import save_snapshot, load_snapshot, read_snapshot_header
 import os
 from time import time, sleep
+import collections
 import datetime
 import multiprocessing
 from shutil import copyfile
 import pickle
 import numpy as np
+import pandas as pd
 import traceback
 import uuid
 import math
@@ -30,12 +33,37 @@ if chemspeed_flag:
     from cs_parser import Parser
 
 
+def _numeric(frame, key):
+    '''Column of a frame as a float array, with anything that is not a number as nan'''
+    return pd.to_numeric(frame[key], errors='coerce').to_numpy(dtype=float)
+
+
 class Experiment:
     MINI_BATCH = 30 #if error occurers, 30 samples seems to work?? Manually adjust blanks as required and 0 dispenses
     BATCH = 30
     #BATCH_FILES = int(sys.argv[1])  # number of files that we want to see in the queue, should be BATCH/BATCH_FILES = MINI_BATCH
     BATCH_FILES = 1
     SLEEP_DELAY = 5  # delay in seconds before querying the queue folder again
+    GP_PROCESSES = 1  # processes used for the GP hyperparameter restarts when training a model
+    GP_CONVERGED_RESTARTS = 5  # stop hyperparameter restarts once this many reach the best optimum (None for all)
+    FILL_ATTEMPTS = 10  # draws of random lattice points when completing a short batch (see fill_shortfall)
+    TARGET_COLUMN = 'calc_%_H2_umol'  # measured response in the completed files
+    LEAK_COLUMN = 'calc_%_O2_umol'  # oxygen in the completed files, points above LEAK_LIMIT are leaking
+    LEAK_LIMIT = 5
+    # Columns of the completed and running files that do not represent a compound
+    # only need water dispensed and h2 evol umol for optimisation - rest stated here should be ignored by optimiser
+    IGNORED_COLUMNS = frozenset({'form_id', 'form_name', 'form_status', 'form_datetime', 'sample_name',
+                                 'calc_% H2_Avg', 'calc_%_O2_Avg', 'calc_%_H2_umol', 'calc_%_O2_umol', 'Water 1',
+                                 'internal_hydrogen_standard_micromol', 'calc_%_N2_Avg', 'calc_%_H2_2STD',
+                                 'calc_%_H2_umol/h', 'calc_%_O2_2STD', 'calc_%_O2_umol/h', 'calc_%_Ar_Avg',
+                                 'calc_%_CO2_Avg', 'calc_%_CO2_2STD', 'calc_%_CO2_umol', 'calc_%_CO2_umol/h'})
+    # Reason codes of skipped rows (see skip_reasons)
+    SKIP_NONE = 0
+    SKIP_LEAK = 1
+    SKIP_CONTROL = 2
+    SKIP_REASONS = {SKIP_LEAK: 'leaking', SKIP_CONTROL: 'control only'}
+    MODEL_FILE = 'optimizer.snapshot'  # saved model, see bayes_opt.snapshot
+    LEGACY_MODEL_FILE = 'optimizer.pickle'  # saved model of earlier versions, still read if no snapshot exists
 
 
     directory_path = './'
@@ -47,13 +75,14 @@ class Experiment:
         self.properties = {}  # Properties (liquid, solid, etc.) of the compounds, e.g. comp['P10'] = {'phys': 'solid', 'proc' : 'cat'}
         self.rng = {}  # Ranges with resolution, e.g. rng['P10'] = {'lo' : 0, 'hi' : 1, 'res' : 0.1}
         self.dbo_ranges = {}  # Ranges with resolution formated for dbo (including maping of complements)
-        self.constraints = []  # list of the constraints that points should satisfy, e.g.
+        self.constraints = []  # list of the constraints that points should satisfy, as structured Constraint objects
         self.controls = []  # list of the control experiments to include in each minibatch
         self.complements = {}  # Mapping of all complementary variables to single dimensions in optimizer space {'!Complement!_01' : {}}
 
         # Outcomes of ongoing experimentation
-        self.points = []  # list of measured targets (different experiments), e.g. [{'P10' : 0.1, 'TiO2' : 0.2}, ... ]
-        self.targets = []  # measured response at the experiments [1.1, 2.1, ...]
+        self.point_keys = []  # optimizer variables in the order of the columns of self.points (sorted, as in the optimizer space)
+        self.points = np.empty((0, 0))  # (n, dim) array of measured points (different experiments), columns as in self.point_keys
+        self.targets = np.empty(0)  # measured response at the experiments [1.1, 2.1, ...]
 
         self.name = 'Unknown'  # Name of the experiment that will appear in all the files
         self.batch_number = 1  # Number of the mini_batch to submit next
@@ -65,9 +94,17 @@ class Experiment:
 
         self.__read_config()
         self.__prep_dirs()
+        self.point_keys = sorted(self.dbo_ranges)
+        self.points = np.empty((0, len(self.point_keys)))
+        self._skip_rules = {}  # compiled skip rules for each set of frame columns (see skip_rules)
+        self.skip_stats = collections.Counter()  # rows of completed files skipped, by (reason, column)
         self.parser = Parser(self.compounds, self.directory_path)  # Associated parser responsible for IO operations
+        self.parser.output_columns = self.output_columns()
 
         self.SUBSAMPLE_SIZE = 8
+        self.executor = None  # Persistent worker pool handed to each loaded model (see watch_queue)
+        self.kmbbo_centroids = None  # Centroids of the last KMBBO batch, warm starting the next one
+        self._saved_model_stamp = None  # (file signature, uuid) of the saved model last checked
 
     def __read_config(self):
         '''
@@ -171,22 +208,15 @@ class Experiment:
 
             # Update of optimizer ranges and constraints from complements
             self.dbo_ranges = {p: (r['lo'], r['hi'], r['res']) for p, r in self.rng.items() if r['lo'] < r['hi']}
+            # Constraints are kept structured, fixed compounds enter as their constant values
+            self.constraints = [Constraint.parse(s, names=self.dbo_ranges, constants=self.constants)
+                                for s in self.constraints]
             for key, dict in self.complements.items():
                 a = self.dbo_ranges.pop(dict['A_name'])
                 b = self.dbo_ranges.pop(dict['B_name'])
                 self.dbo_ranges[key] = (0., 1., min(a[2] / (a[1] - a[0]) / 2,
                                                     b[2] / (b[1] - b[0]) / 2))
-
-                new_constraints = []
-                for s in self.constraints:
-                    s = s.replace(dict['A_name'],
-                                  "(({}<0.5) * (((0.5 - {})/0.5) * ({:f}-{:f}) + {:f}) )".format(key, key, a[1], a[0],
-                                                                                                 a[0]))
-                    s = s.replace(dict['B_name'],
-                                  "(({}>=0.5) * ((({} - 0.5)/0.5) * ({:f}-{:f}) + {:f}) )".format(key, key, b[1], b[0],
-                                                                                                  b[0]))
-                    new_constraints.append(s)
-                self.constraints = new_constraints
+                self.constraints = [c.complement(key, dict['A_name'], a, dict['B_name'], b) for c in self.constraints]
 
         except IOError:
             print("There is no configuration file in the experiment folder.")
@@ -283,23 +313,50 @@ class Experiment:
 
         """
         import pandas as pd
-        df = pd.DataFrame(self.points)
+        df = pd.DataFrame(self.points, columns=self.point_keys)
         df['Target'] = self.targets
         df.to_csv(path)
 
     def clear_previous_model(self):
         '''
         Moves previous model to past model folder
-        data = {}  # Data dictionary to be saved
+        '''
+        for model_file in (self.MODEL_FILE, self.LEGACY_MODEL_FILE):
+            fname = os.path.join(self.directory_path, model_file)
+            if os.path.isfile(fname):
+                copyfile(fname, self.archived_model_path(model_file))
+                os.remove(fname)
+
+    def archived_model_path(self, model_file=MODEL_FILE):
+        '''Path the current model is archived to, models/state_N with the extension of model_file'''
+        return os.path.join(self.directory_path, 'models',
+                            'state_{}{}'.format(self.batch_number - 1, os.path.splitext(model_file)[1]))
+
+    def load_saved_model(self, mmap=True):
+        '''
+        Loads the saved model, from the snapshot or else a legacy pickle.
 
+        Arguments
+        ----------
+        mmap: bool, memory-map the arrays of the snapshot (read-only) instead of reading them into memory
+
+        Returns
+        ----------
+        dbo: instance of DiscreteBayesianOptimization, or None if no model is saved
+        model_uuid: uuid of the saved model, or None
         '''
-        fname = os.path.join(self.directory_path, 'optimizer.pickle')
+        fname = os.path.join(self.directory_path, self.MODEL_FILE)
+        if os.path.isfile(fname):
+            dbo, header, _ = load_snapshot(fname, mmap=mmap)
+            return dbo, uuid.UUID(header['uuid'])
+        fname = os.path.join(self.directory_path, self.LEGACY_MODEL_FILE)
         if os.path.isfile(fname):
-            copyfile(fname,
-                     os.path.join(self.directory_path, 'models', 'state_{}.pickle'.format(self.batch_number - 1)))
-            os.remove(fname)
+            with open(fname, 'rb') as handle:
+                data = pickle.load(handle)
+            return data['model'], data['uuid']
+        return None, None
 
-    def generate_model(self, verbose=0, random_state=None):
+    def generate_model(self, verbose=0, random_state=None, incremental=False):
         '''
         Creates, saves, and returns Bayesian optimizer 
         Saves previous model in folder according to read batch number, or 0 if none is available
@@ -307,6 +364,10 @@ class Experiment:
         ----------
         verbose: 0 (quiet), 1 (printing only maxima as found), 2 (print every registered point)
         random_state: integer for random number generator
+        incremental: logical, update the saved model with the new observations instead of rebuilding it.
+            The kernel hyperparameters are kept and only re-optimised on the schedule of
+            DiscreteBayesianOptimization.update_gp. Falls back to a full rebuild when the saved model
+            does not match the current configuration or data.
         
         Returns
         ----------
@@ -314,47 +375,54 @@ class Experiment:
         '''
 
         self.clean_queue()
-        data = {}  # Data dictionary to be saved
 
-        prange = self.dbo_ranges
-        # Initialize optimizer and utility function 
-        dbo = DiscreteBayesianOptimization(f=None,
-                                           prange=prange,
-                                           verbose=verbose,
-                                           random_state=random_state,
-                                           constraints=self.constraints)
-        if verbose:
-            dbo._prime_subscriptions()
-            dbo.dispatch(Events.OPTMIZATION_START)
-
-        # Register past data to optimizer
         self.update_points_and_targets()
-        for idx, point in enumerate(self.points):
-            dbo.register(params=point, target=self.targets[idx])
-            #if verbose and idx % batch_size == 0: dbo.dispatch(Events.BATCH_END)
-            if verbose and idx % batch_size == 0: dbo.dispatch(Events.BATCH_END)
+        dbo = self.load_model_for_update() if incremental else None
+        updating = dbo is not None
+        if not updating:
+            prange = self.dbo_ranges
+            # Initialize optimizer and utility function 
+            dbo = DiscreteBayesianOptimization(f=None,
+                                               prange=prange,
+                                               verbose=verbose,
+                                               random_state=random_state,
+                                               constraints=self.constraints)
+            if verbose:
+                dbo._prime_subscriptions()
+                dbo.dispatch(Events.OPTMIZATION_START)
+
+            # Register past data to optimizer in a single block
+            if len(self.points):
+                dbo.register_many(params=self.points, targets=self.targets)
+                if verbose: dbo.dispatch(Events.BATCH_END)
 
         # Register running data to partner space in optimizer
         running_points = self.get_running_points()
-        for idx, point in enumerate(running_points):
-            if idx == 0:
-                dbo.partner_register(params=point, clear=True)
-            else:
-                dbo.partner_register(params=point, clear=False)
+        dbo.partner_register_many(params=running_points, clear=True)
 
         # Fit gaussian process
-        data['random_state'] = np.random.get_state()
+        random_state = np.random.get_state()
         if len(dbo.space) > 0:
             dbo.output_space('dbo_space.csv')
             #self.output_space('exp_space.csv')
             start_time = time()
-            dbo.fit_gp()
-            print("Model trained in {:8.2f} minutes".format((time()-start_time)/60))
-            if any(dbo._gp.kernel_.k1.k1.length_scale<5e-3):
+            if updating:
+                action = dbo.update_gp(processes=self.GP_PROCESSES, n_converged=self.GP_CONVERGED_RESTARTS)
+                print("Model {} in {:8.2f} minutes".format({'fit': 'trained', 'refit': 're-optimised',
+                                                           'update': 'updated'}[action],
+                                                          (time() - start_time) / 60))
+            else:
+                action = 'fit'
+                dbo.fit_gp(processes=self.GP_PROCESSES, n_converged=self.GP_CONVERGED_RESTARTS)
+                print("Model trained in {:8.2f} minutes".format((time()-start_time)/60))
+            if action != 'update':
+                self.print_fit_report(dbo)
+            if action != 'update' and any(dbo._gp.kernel_.k1.k1.length_scale<5e-3):
                 print("Warning: Very short length scale detected when fitting Matern kernel. Retraining model...")
                 start_time = time()
-                dbo.fit_gp()
+                dbo.fit_gp(processes=self.GP_PROCESSES, n_converged=self.GP_CONVERGED_RESTARTS)
                 print("Model trained in {:8.2f} minutes".format((time() - start_time) / 60))
+                self.print_fit_report(dbo)
             if any(dbo._gp.kernel_.k1.k1.length_scale>5e2):
                 print("Warning: Very long length scale detected when fitting Matern kernel.")
             print("Model length scales:")
@@ -364,18 +432,75 @@ class Experiment:
             print("Model constant scale: {}".format(dbo._gp.kernel_.k1.k2.constant_value))
         # Refresh queue and copy old model
         self.read_batch_number()
-        fname = os.path.join(self.directory_path, 'optimizer.pickle')
-        if os.path.isfile(fname):
-            copyfile(fname,
-                     os.path.join(self.directory_path, 'models', 'state_{}.pickle'.format(self.batch_number - 1)))
+        fname = os.path.join(self.directory_path, self.MODEL_FILE)
+        legacy = os.path.join(self.directory_path, self.LEGACY_MODEL_FILE)
+        for model_file, path in ((self.MODEL_FILE, fname), (self.LEGACY_MODEL_FILE, legacy)):
+            if os.path.isfile(path):
+                copyfile(path, self.archived_model_path(model_file))
+
+        # Save the model with its metadata in the header
+        model_uuid = uuid.uuid4()
+        dbo.model_uuid = model_uuid
+        header = {'uuid': str(model_uuid),
+                  'processed_files': list(self.parser.processed_files.keys()),
+                  'batch_number': self.batch_number,
+                  'n_points': len(dbo.space),
+                  'random_state': [random_state[0]] + [float(value) for value in random_state[2:]]}
+        save_snapshot(fname, dbo, header=header, arrays={'random_state_keys': random_state[1]})
+        self._saved_model_stamp = None
+        # The legacy pickle is archived above and superseded by the snapshot
+        if os.path.isfile(legacy):
+            os.remove(legacy)
 
-        # Build dictionary to save and return model
-        data['processed_files'] = list(self.parser.processed_files.keys())
-        data['model'] = dbo
-        data['uuid'] = uuid.uuid4()
-        with open(fname, 'wb') as handle:
-            pickle.dump(data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        return dbo
+
+    @staticmethod
+    def print_fit_report(dbo):
+        '''Prints the log marginal likelihood and timing of each hyperparameter restart of the last fit'''
+        report = getattr(dbo, 'gp_fit_report', [])
+        if not report:
+            return
+        best = max(entry['log_marginal_likelihood'] for entry in report)
+        print("Hyperparameter restarts ({} run, {:.2f} s total):".format(len(report),
+                                                                      sum(entry['seconds'] for entry in report)))
+        for entry in report:
+            print("  restart {:3d}: log marginal likelihood {:12.4f} in {:7.2f} s{}".format(
+                entry['restart'], entry['log_marginal_likelihood'], entry['seconds'],
+                " (best)" if entry['log_marginal_likelihood'] == best else ""))
+
+    def load_model_for_update(self):
+        '''
+        Loads the saved optimizer and registers the observations it has not seen, for an incremental update.
+        Call after update_points_and_targets.
 
+        Returns
+        ----------
+        dbo: instance of DiscreteBayesianOptimization, or None if there is no saved model, the saved model
+            was built with different ranges or constraints, or it holds observations no longer in the data
+        '''
+        # Read into memory, since the updated model is saved over the snapshot it is loaded from
+        dbo, _ = self.load_saved_model(mmap=False)
+        if dbo is None:
+            return None
+        if dbo.space.keys != sorted(self.dbo_ranges) or \
+                [str(c) for c in dbo._key_constraints] != [str(c) for c in self.constraints]:
+            return None
+        ranges = np.array([self.dbo_ranges[key][:3] for key in dbo.space.keys], dtype=float)
+        if not np.array_equal(np.column_stack((dbo.space.bounds, dbo.space.steps)), ranges):
+            return None
+        # Observations are matched as (point, target) rows counted with multiplicity, since compositions
+        # such as the controls repeat across plates
+        saved = collections.Counter(row.tobytes() for row in np.column_stack((dbo.space.params, dbo.space.target)))
+        new = np.ones(len(self.points), dtype=bool)
+        for i, row in enumerate(np.column_stack((self.points, self.targets))):
+            key = row.tobytes()
+            if saved[key] > 0:
+                saved[key] -= 1
+                new[i] = False
+        if any(saved.values()):
+            return None
+        if new.any():
+            dbo.register_many(params=self.points[new], targets=self.targets[new])
         return dbo
 
     def generate_batch(self, batch_size=BATCH, verbose=0, random_state=None, utility_kind="ucb", kappa=2.5, xi=0.0,
@@ -401,35 +526,73 @@ class Experiment:
         if sampler == 'greedy' or sampler == 'capitalist':
             kwargs['complements'] = bool(self.complements)
         # Initialize optimizer and utility function 
-        fname = os.path.join(self.directory_path, 'optimizer.pickle')
-        if os.path.isfile(fname):
-            with open(fname, 'rb') as handle:
-                data = pickle.load(handle)
-                dbo = data['model']
-                running_points = self.get_running_points()
-                for point in running_points:
-                    dbo.partner_register(params=point, clear=False)
-                self.model_uuid = data['uuid']
+        dbo, model_uuid = self.load_saved_model()
+        if dbo is not None:
+            dbo.model_uuid = model_uuid
+            dbo.partner_register_many(params=self.get_running_points(), clear=False)
+            self.model_uuid = model_uuid
         else:
             dbo = self.generate_model(verbose=verbose, random_state=random_state)
             self.model_uuid = self.get_saved_model_uuid()
         utility = UtilityFunction(kind=utility_kind, kappa=kappa, xi=xi)
+        # Workers keep the model between batches, and are only restarted when the model uuid changes
+        if self.executor is not None:
+            dbo.executor = self.executor
+        # The model is reloaded for every batch, so the KMBBO centroids are kept here between batches
+        dbo.kmbbo_centroids = self.kmbbo_centroids
 
         # Generate batch of suggestions
         dbo.reset_rng()
         batch = dbo.suggest(utility, sampler=sampler, n_acqs=batch_size, fit_gp=False, **kwargs)
+        self.kmbbo_centroids = dbo.kmbbo_centroids
+        if len(batch) < batch_size:
+            # e.g. the time_budget or max_market_runs of capitalist sampling was spent (dbo.capitalist_shortfall)
+            batch += self.fill_shortfall(dbo, batch_size - len(batch), utility, kwargs.get('multiprocessing', 1))
 
         # Clear and re-register running data to partner space in optimizer (can be adjusted in capitalist)
         running_points = self.get_running_points()
-        for idx, point in enumerate(running_points):
-            if idx == 0:
-                dbo.partner_register(params=point, clear=True)
-            else:
-                dbo.partner_register(params=point, clear=False)
+        if len(running_points):
+            dbo.partner_register_many(params=running_points, clear=True)
         for point in batch:
             self.complement_mapping(point)
         return batch
 
+    def fill_shortfall(self, dbo, n_missing, utility, multiprocessing=1):
+        '''
+        Suggestions for the points a batch is missing, so that a batch is never short: greedy acquisitions,
+        then unseen random lattice points for anything greedy sampling cannot provide.
+        The points already suggested must be registered in the partner space of dbo, as capitalist sampling does.
+
+        Arguments
+        ----------
+        dbo: instance of DiscreteBayesianOptimization
+        n_missing: integer number of points missing from the batch
+        utility: UtilityFunction used for the greedy acquisitions
+        multiprocessing: integer number of processes for the greedy sampler
+
+        Returns
+        ----------
+        fill: list of n_missing dictionaries of parameters
+        '''
+        print("Warning: batch is {} points short. Filling with greedy suggestions.".format(n_missing))
+        greedy_args = {'complements': bool(self.complements)} if dbo.constraints else {}
+        fill = dbo.suggest(utility, sampler='greedy', n_acqs=n_missing, fit_gp=False,
+                           multiprocessing=multiprocessing, **greedy_args)[:n_missing]
+        for point in fill:
+            dbo.partner_register(params=point)
+        for _ in range(self.FILL_ATTEMPTS):
+            if len(fill) == n_missing:
+                break
+            x = dbo.lattice_rng(10 * (n_missing - len(fill)))
+            x = x[~dbo.space.contains_many(x, others=(dbo.partner_space,))]
+            _, first = np.unique(dbo.space.lattice_keys(x), return_index=True)
+            for row in x[np.sort(first)][:n_missing - len(fill)]:
+                dbo.partner_register(params=row)
+                fill.append(dbo.space.array_to_params(row))
+        if len(fill) < n_missing:
+            raise RuntimeError("Cannot find {} unseen points to complete the batch.".format(n_missing))
+        return fill
+
     def register_mini_batch(self, mini_batch):
         '''
         Submit the mini_batch to the workflow.
@@ -577,118 +740,146 @@ class Experiment:
 
     def get_running_points(self):
         '''
-        Check whether there are experiments in the runque or active running, and return list. 
+        Check whether there are experiments in the runque or active running, and return them as an (n, dim) array
+        with columns as in self.point_keys.
         This purposefully ignores '_dispensed' values, since this shouldn't be relevant until completed. 
         '''
         dfs = self.parser.process_running(self.name)
 
-        skipped = 0
-        _points = []
+        skipped = collections.Counter()
+        _points = [np.empty((0, len(self.point_keys)))]
         for df in dfs:
-            for idx, row in df.iterrows():
-                #print(idx, row)
-                point = {}
+            reasons, columns = self.skip_reasons(df)
+            skipped.update(zip(reasons[reasons != self.SKIP_NONE], columns[reasons != self.SKIP_NONE]))
+            _points.append(self.extract_points(df, completed=False)[reasons == self.SKIP_NONE])
 
-                if self.skip_point(row):
-                    skipped = skipped + 1
-                else:
-                    for comp in self.compounds:
-                        if self.rng[comp]['lo'] < self.rng[comp]['hi']:
-                            if comp in df:
-                                point[comp] = row[comp]
-                                continue
-                            else:
-                                if comp in self.identical_compounds.keys():
-                                    found_alternative = False
-                                    for alternative in self.identical_compounds[comp].keys():
-                                        if alternative in df:
-                                            # print(
-                                            #    'found_alternative ' + alternative + ' in ' + row['Name'] +
-                                            # ' for compound' + comp + ' with final concentration ' + str(
-                                            #        float(row[alternative]) * float(
-                                            #            self.identical_compounds[comp][alternative])))
-                                            found_alternative = True
-                                            point[comp] = float(row[alternative]) * float(
-                                                self.identical_compounds[comp][alternative])
-                                            continue
-                                    if not found_alternative:
-                                        point[comp] = 0
-                                else:
-                                    point[comp] = 0
-                                point[comp] = 0
-                    self.complement_mapping(point)
-                    _points.append(point)
-
-        if skipped != 0:
-            print('Warning: Ignored ' + str(skipped) + ' points in running folder.')
-        return _points
+        if skipped:
+            print('Warning: Ignored {} points in running folder ({}).'.format(sum(skipped.values()),
+                                                                              self.skip_summary(skipped)))
+        return np.concatenate(_points)
 
-    def skip_point(self, point):
+    def column_kind(self, key):
         '''
-                    Exclude any points that contain compounds that are not under consideration:
-                    i.e. filter non-variable compounds that are != 0
-                    Returns false if there is any compounds in the sample that are not under consideration
-        '''
-        for key, value in point.items():
-            # case 0: sample is leaking
-            #taken from 5 umol to 500 umol to have this line ignored - meoh too likely to give unexpected o2 levels
-            if key == 'calc_%_O2_umol' and value > 5:
-                print('Warning, skipping leaky point ' + point['form_id'])
-                return True
-
-            '''         
-               unedited case 1 in case errors
-               # case 1: standard column that is not representing a compound
-            #most of these are KUKA specific - only need water dispensed and h2 evol umol for optimisation
-            if (key in {'SampleIndex', 'SampleNumber', 'Name', 'vial_capped', 'gc_well_number',
-                        'hydrogen_evolution', 'oxygen_evolution', 'hydrogen_evolution_micromol',
-                        'oxygen_evolution_micromol', 'water', 'water_dispensed',
-                        'internal_hydrogen_standard_micromol', 'weighted_hydrogen_micromol', 'sample_location_weight',
-                        'weighted_is_sl_hydrogen_evolution_micromol'}) \
-                    or 'Unnamed' in key:  # deal with faulty comma
-                continue'''
-
-
-            # case 1: standard column that is not representing a compound
-            # only need water dispensed and h2 evol umol for optimisation - rest stated here should be ignored by optimiser
-
-            if (key in {'form_id', 'form_name', 'form_status', 'form_datetime', 'sample_name',
-                        'calc_% H2_Avg', 'calc_%_O2_Avg', 'calc_%_H2_umol',
-                        'calc_%_O2_umol', 'Water 1','internal_hydrogen_standard_micromol', "calc_%_N2_Avg", "calc_%_H2_2STD", "calc_%_H2_umol/h", "calc_%_O2_2STD", "calc_%_O2_umol/h", "calc_%_Ar_Avg", "calc_%_CO2_Avg", "calc_%_CO2_2STD", "calc_%_CO2_umol", "calc_%_CO2_umol/h"}) \
-                    or 'Unnamed' in key:  # deal with faulty comma
-                continue
+        Classifies a column of a completed or running file for the skip rules:
+        'leak' (oxygen measurement), 'ignored' (standard column that is not representing a compound),
+        'control' (compound with upper limit <= 0, i.e. control only / not included in the experiment),
+        'compound' (variable compound or its '_dispensed' value), 'identical' (identical compound of a variable
+        with a different concentration) or 'other'.
+        '''
+        key = str(key)
+        if key == self.LEAK_COLUMN:
+            return 'leak'
+        if key in self.IGNORED_COLUMNS or 'Unnamed' in key:  # deal with faulty comma
+            return 'ignored'
+        if key in self.compounds:
+            return 'control' if self.rng[key]['hi'] <= 0 else 'compound'
+        name = key[:-len('_dispensed')] if key.endswith('_dispensed') else key
+        if name in self.compounds:
+            return 'compound'
+        if any(name in alternatives for alternatives in self.identical_compounds.values()):
+            return 'identical'
+        return 'other'
+
+    def skip_rules(self, columns):
+        '''
+        Compiled skip rules for the columns of a frame, built once for each set of columns.
 
-            # case 2: column directly representing variable
-            if (key in self.compounds) or ((len(key) > 10) and (key[:-10] in self.compounds)):
-                # case 2.5: column representing control only/ compound not included in experiment.
-                if key in self.rng and self.rng[key]['hi'] <= 0 and value>0:
-                    print('Warning, ignoring point with ' + key + ' and value ' + str(value))
-                    return True
-                else:
-                    continue
-
-            # case 3: column representing variable but with different concentration for compound in list
-            skip = False;
-            for compound in self.compounds:
-                if compound in self.identical_compounds and \
-                        ((key in self.identical_compounds[compound].keys()) or (
-                                (len(key) > 10) and (key[:-10] in self.identical_compounds[compound].keys()))):
-                    # print('Found compound that is a variable, but with different concentration' + key)
-                    skip = True
-                    continue
-            if skip:
-                continue
+        Returns
+        ----------
+        list of (column, reason code, limit): rows with a value above limit in column are skipped, and the
+        first rule in column order gives the reason
+        '''
+        key = tuple(columns)
+        if key not in self._skip_rules:
+            rules = {'leak': (self.SKIP_LEAK, self.LEAK_LIMIT), 'control': (self.SKIP_CONTROL, 0)}
+            self._skip_rules[key] = [(column,) + rules[kind] for column in columns
+                                     for kind in [self.column_kind(column)] if kind in rules]
+        return self._skip_rules[key]
+
+    def skip_reasons(self, frame):
+        '''
+        Applies the skip rules to every row of a frame.
+        Rows are skipped if the sample is leaking or contains a control only compound.
 
-            # case 4: column is unclear, but value is 0
-            if value == 0:
-                continue
+        Returns
+        ----------
+        reasons: (n,) int array of reason codes (SKIP_NONE for the rows to keep)
+        columns: (n,) object array of the column that excluded each row (None for the rows to keep)
+        '''
+        reasons = np.full(len(frame), self.SKIP_NONE, dtype=np.int8)
+        columns = np.full(len(frame), None, dtype=object)
+        for column, reason, limit in self.skip_rules(frame.columns):
+            hit = (reasons == self.SKIP_NONE) & (_numeric(frame, column) > limit)
+            reasons[hit] = reason
+            columns[hit] = column
+        return reasons, columns
+
+    def skip_summary(self, counts):
+        '''One line summary of a Counter of skipped rows by (reason code, column)'''
+        return ', '.join('{} {}: {}'.format(self.SKIP_REASONS[reason], column, n)
+                         for (reason, column), n in sorted(counts.items()))
+
+    def extract_points(self, frame, completed=True):
+        '''
+        Points of every row of a frame, resolving the column of each compound once for the whole frame.
+
+        For completed files 'Name_dispensed' has preference over 'Name', and compounds missing from the frame
+        are read from their identical compounds (scaled by the concentration factor). Running files only
+        use the 'Name' columns. Compounds that cannot be found are 0.
+        Complementary compounds are mapped to their single optimizer variable (see complement_mapping).
 
-            # case 5: column not representing variable compound in list
-            # print('Warning, ignoring point with ' + key + ' and value ' + str(value))
-            #return True
+        Arguments
+        ----------
+        frame: pandas DataFrame of a completed or running file
+        completed: bool, whether the frame holds measured (dispensed) values
 
-        # no unexpected columns found
-        return False
+        Returns
+        ----------
+        (n, dim) array with columns as in self.point_keys
+        '''
+        n = len(frame)
+
+        columns = {}
+        for comp in self.compounds:
+            if self.rng[comp]['lo'] >= self.rng[comp]['hi']:
+                continue
+            if completed and comp + '_dispensed' in frame:
+                columns[comp] = _numeric(frame, comp + '_dispensed')
+            elif comp in frame:
+                columns[comp] = _numeric(frame, comp)
+            else:
+                column = np.zeros(n)
+                if completed:
+                    # there seem to be nan values if the batch has any comments => ignore them
+                    # later alternatives take precedence, as when matching row by row
+                    for alternative, factor in self.identical_compounds.get(comp, {}).items():
+                        source = alternative + '_dispensed' if alternative + '_dispensed' in frame else alternative
+                        if source not in frame:
+                            continue
+                        found = ~np.isnan(_numeric(frame, alternative if alternative in frame else source))
+                        column[found] = _numeric(frame, source)[found] * float(factor)
+                columns[comp] = column
+
+        for complement, dict in self.complements.items():
+            a_val = columns.pop(dict['A_name'])
+            b_val = columns.pop(dict['B_name'])
+            if np.any((a_val > 0) & (b_val > 0)): raise RuntimeError("Complementary values are both nonzero")
+            a_rng, b_rng = dict['A_range'], dict['B_range']
+            columns[complement] = np.where(a_val > 0,
+                                           0.5 - 0.5 * ((a_val - a_rng['lo']) / (a_rng['hi'] - a_rng['lo'])),
+                                           np.where(b_val > 0,
+                                                    0.5 + 0.5 * ((b_val - b_rng['lo']) / (b_rng['hi'] - b_rng['lo'])),
+                                                    0.5))
+
+        return np.column_stack([columns[key] for key in self.point_keys]) if self.point_keys else np.empty((n, 0))
+
+    def skip_point(self, point):
+        '''
+                    Exclude any points that contain compounds that are not under consideration:
+                    i.e. filter non-variable compounds that are != 0
+                    Returns True if the point should be skipped (see skip_reasons)
+        '''
+        return self.skip_reasons(pd.DataFrame([dict(point)]))[0][0] != self.SKIP_NONE
 
     def update_points_and_targets(self):
         '''
@@ -708,86 +899,76 @@ class Experiment:
             # print(filename, self.parser.processed_files[filename].tail())
             print(f"Adding data from {filename} to the list of points: {len(frame)} measurements.")
 
-            f_targets = list(self.optimisation_target(frame))
-            skipped = 0
-            for idx, row in frame.iterrows():
-                point = {}
-                skip_point = self.skip_point(row)
-                if skip_point:
-                    skipped = skipped + 1
-                else:
-                    for comp in self.compounds:
-                        if self.rng[comp]['lo'] < self.rng[comp]['hi']:
-                            if comp + '_dispensed' in frame:
-                                point[comp] = row[comp + '_dispensed']
-                                continue
-
-                            if comp in frame:
-                                point[comp] = row[comp]
-                                continue
-
-                            if comp in self.identical_compounds.keys():
-                                found_alternative = False
-                                for alternative in self.identical_compounds[comp].keys():
-                                    # there seem to be nan values if the batch has any comments => ignore them
-                                    if (alternative + '_dispensed') in frame and not math.isnan(row[alternative]):
-                                        # print(
-                                        #    'found_alternative ' + alternative + ' in ' + row['Name'] +
-                                        #    ' for compound' + comp + ' with final value ' +
-                                        #    str(float(row[alternative+'_dispensed'])
-                                        #        * float(self.identical_compounds[comp][alternative])))
-                                        found_alternative = True
-                                        point[comp] = float(row[alternative + '_dispensed']) * float(
-                                            self.identical_compounds[comp][alternative])
-                                        continue
-                                    elif alternative in frame and not math.isnan(row[alternative]):
-                                        # print(
-                                        #    'found_alternative ' + alternative + ' in ' + row['Name'] +
-                                        #    ' for compound' + comp +  ' with final value ' + str(
-                                        #        float(row[alternative]) * float(self.identical_compounds[comp][alternative])))
-                                        found_alternative = True
-                                        point[comp] = float(row[alternative]) * float(
-                                            self.identical_compounds[comp][alternative])
-                                        continue
-
-                                if not found_alternative:
-                                    point[comp] = 0
-                            else:
-                                point[comp] = 0
-                            # print(f"Warning! {comp} was not found in the file {filename}")
-                    self.complement_mapping(point)
-                    # ### TEST BLOCK ###
-                    # print("Using test block in update_points_and_targets. This should not be in deployment")
-                    # if np.random.uniform() < 1:
-                    #     self.points.append(point)
-                    #     self.targets.append(f_targets[idx])
-                    # ### TEST BLOCK ###
-                    ### REAL BLOCK ###
-                    self.points.append(point)
-                    self.targets.append(f_targets[idx])
-                    ### REAL BLOCK ###
-
-            if skipped != 0:
-                print('Warning: Ignored ' + str(skipped) + ' points.')
+            reasons, columns = self.skip_reasons(frame)
+            keep = reasons == self.SKIP_NONE
+            f_targets = pd.to_numeric(self.optimisation_target(frame), errors='coerce').to_numpy(dtype=float)
+            self.points = np.concatenate((self.points, self.extract_points(frame)[keep]))
+            self.targets = np.concatenate((self.targets, f_targets[keep]))
+
+            if not keep.all():
+                skipped = collections.Counter(zip(reasons[~keep], columns[~keep]))
+                self.skip_stats.update(skipped)
+                print('Warning: Ignored {} points ({}).'.format((~keep).sum(), self.skip_summary(skipped)))
+                if 'form_id' in frame and (reasons == self.SKIP_LEAK).any():
+                    print('Leaking form ids: ' + ', '.join(str(form_id) for form_id in
+                                                           frame['form_id'][reasons == self.SKIP_LEAK]))
             assert len(self.targets) == len(self.points), "Mismatch in points and targets. "\
                                                           "Error in Experiment.update_points_and_targets"
             print('Total number of points in model: ' + str(len(self.points)))
 
     def optimisation_target(self, frame):
-        return frame['calc_%_H2_umol'] # changed from kuka equiv
+        return frame[self.TARGET_COLUMN] # changed from kuka equiv
+
+    def output_columns(self):
+        '''
+        Columns of the completed files used by the experiment: the compounds and their identical compounds
+        (with their '_dispensed' values), the target, the leak check and the form id.
+        Other columns never affect the points, targets or skipped points.
+        '''
+        names = set(self.compounds)
+        for alternatives in self.identical_compounds.values():
+            names.update(alternatives)
+        columns = names | {name + '_dispensed' for name in names}
+        columns.update({'form_id', self.TARGET_COLUMN, self.LEAK_COLUMN})
+        return columns
 
     def new_model_available(self):
         new_uuid = self.get_saved_model_uuid()
         return not (self.model_uuid == new_uuid)
 
+    def saved_model_signature(self):
+        '''
+        Path, modification time, size and inode of the saved model file, or None if there is none.
+        Saving a model always replaces the file, so an unchanged signature means an unchanged model.
+        '''
+        for model_file in (self.MODEL_FILE, self.LEGACY_MODEL_FILE):
+            fname = os.path.join(self.directory_path, model_file)
+            try:
+                stat = os.stat(fname)
+            except OSError:
+                continue
+            return fname, stat.st_mtime_ns, stat.st_size, stat.st_ino
+        return None
+
     def get_saved_model_uuid(self):
-        fname = os.path.join(self.directory_path, 'optimizer.pickle')
-        if os.path.isfile(fname):
+        '''
+        Uuid of the saved model (a new random uuid if there is none).
+        The file is only read when its signature has changed since the last call, and then only the
+        snapshot header, so this is cheap enough to poll.
+        '''
+        signature = self.saved_model_signature()
+        if signature is None:
+            return uuid.uuid4()
+        if self._saved_model_stamp is not None and self._saved_model_stamp[0] == signature:
+            return self._saved_model_stamp[1]
+        fname = signature[0]
+        if fname.endswith(self.MODEL_FILE):
+            new_uuid = uuid.UUID(read_snapshot_header(fname)['uuid'])
+        else:
             with open(fname, 'rb') as handle:
-                data = pickle.load(handle)
-                new_uuid = data['uuid']
-                return new_uuid;
-        return uuid.uuid4()
+                new_uuid = pickle.load(handle)['uuid']
+        self._saved_model_stamp = (signature, new_uuid)
+        return new_uuid
 
 
 def clean_and_generate(exp, batches_to_generate, multiprocessing=1, perform_clean=False, sampler='greedy'):
@@ -859,9 +1040,9 @@ def watch_completed(lag_time=900):
             n_files = count
             sleep(lag_time)
 
-            exp.generate_model()
+            exp.generate_model(incremental=True)
             print(
-                "New model trained. Old model has been saved as ./models/state_{}.pickle".format(exp.batch_number - 1))
+                "New model trained. Old model has been saved as {}".format(exp.archived_model_path()))
         sleep(Experiment.SLEEP_DELAY)
 
 
@@ -872,6 +1053,8 @@ def watch_queue(multiprocessing=1, sampler='greedy'):
     '''
     exp = Experiment()
     exp.model_uuid = exp.get_saved_model_uuid()
+    if multiprocessing > 1:
+        exp.executor = AcquisitionExecutor(multiprocessing)
 
     while True:
         # case 1: not enough batches in queue
@@ -890,6 +1073,8 @@ def watch_queue(multiprocessing=1, sampler='greedy'):
         if exp.queue_size() >= exp.BATCH_FILES:
             break
         sleep(Experiment.SLEEP_DELAY)
+    if exp.executor is not None:
+        exp.executor.close()
 
 
 if __name__ == "__main__":
@@ -910,9 +1095,10 @@ if __name__ == "__main__":
     #     p2 = multiprocessing.Process(target=watch_queue, args=(4,'KMBBO',)) #CPUs used for batch generation
     #     p2.start()
     # ## IN SERIAL ###
-    try:
-        os.remove('optimizer.pickle')  # Clean start
-    except OSError:
-        pass
+    for model_file in (Experiment.MODEL_FILE, Experiment.LEGACY_MODEL_FILE):
+        try:
+            os.remove(model_file)  # Clean start
+        except OSError:
+            pass
     watch_queue(1, 'capitalist')
     ## DEBUGING LINES ###
@@ -16,12 +16,16 @@ Provides HOLLY exp files
 import collections
 import csv
 import datetime
+import hashlib
+import json
 import os
 import re
 
+import numpy as np
 import pandas
 import pandas as pd
 from openpyxl import load_workbook
+from openpyxl.cell.cell import ERROR_CODES
 from tkinter import messagebox
 
 
@@ -44,9 +48,201 @@ in_wash = []
 
 #delay_time = 10800
 
+OUTPUT_SHEET = "Output" # results sheet of completed workbooks
+
+
+def _number(value):
+    '''Cell value as an int or float, parsing numbers stored as text. Raises ValueError for anything else'''
+    if isinstance(value, bool):
+        raise ValueError(value)
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
+    raise ValueError(value)
+
+
+def _typed_column(values):
+    '''
+    NumPy array for a column of sheet values, typed as pandas.read_excel would: int64 if every cell is an integer,
+    float64 (empty cells and errors as nan) if every filled cell is a number (numbers stored as text included), otherwise object.
+    '''
+    # Blank text and Excel errors (#DIV/0!, #N/A, ...) count as empty cells
+    values = [None if isinstance(v, str) and (not v.strip() or v in ERROR_CODES) else v for v in values]
+    present = [v for v in values if v is not None]
+    if not present:
+        return np.full(len(values), np.nan)
+    try:
+        numbers = [None if v is None else _number(v) for v in values]
+    except ValueError:
+        return np.array(values, dtype=object)
+    if len(present) == len(values) and all(isinstance(v, int) for v in numbers):
+        return np.array(numbers, dtype=np.int64)
+    return np.array([np.nan if v is None else v for v in numbers], dtype=float)
+
+
+def read_output_sheet(path, columns=None, sheet_name=OUTPUT_SHEET):
+    '''
+    Reads the results sheet of a completed workbook in a single read-only pass.
+
+    Arguments
+    ----------
+    path: path of the .xlsx file
+    columns: optional collection of the column names to keep, None keeps every column
+    sheet_name: name of the results sheet
+
+    Returns
+    ----------
+    pandas DataFrame with one typed NumPy array per column (see _typed_column). Rows with no values are dropped.
+    '''
+    book = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = book[sheet_name].iter_rows(values_only=True)
+        header = next(rows, ())
+        names = [name if name is not None else 'Unnamed: {}'.format(i) for i, name in enumerate(header)]
+        keep = [i for i, name in enumerate(names) if columns is None or name in columns]
+        data = [[row[i] if i < len(row) else None for i in keep]
+                for row in rows if any(value is not None for value in row)]
+    finally:
+        book.close()
+    return pd.DataFrame({names[i]: _typed_column([row[j] for row in data]) for j, i in enumerate(keep)},
+                        columns=[names[i] for i in keep])
+
+
+def read_running_file(path, experiment_name=None):
+    '''
+    Reads the form ids and compound amounts of a running or queued input workbook in a single read-only pass.
+
+    The experiment name is read from cell B4 of the "Experiment Details" sheet. On the "Formulations" sheet
+    every compound takes three columns from column H on, marked "Flow ID" in row 2 with the compound name in
+    row 3, and its amounts in the next column. The form ids are in column B. Values are read from row 3 to the
+    last row before the first empty cell in column A.
+
+    Arguments
+    ----------
+    path: path of the .xlsx file
+    experiment_name: optional name the file must belong to
+
+    Returns
+    ----------
+    pandas DataFrame with a 'form_id' column and a column per compound, or None if the file belongs to another
+    experiment
+    '''
+    book = load_workbook(path, read_only=True)
+    try:
+        if experiment_name is not None:
+            name = next(book["Experiment Details"].iter_rows(min_row=4, max_row=4, min_col=2, max_col=2,
+                                                              values_only=True), (None,))[0]
+            if experiment_name not in str(name):
+                return None
+
+        rows = book["Formulations"].iter_rows(values_only=True)
+        head = [next(rows, ()) for _ in range(3)]
+        cell = lambda row, col: row[col - 1] if col <= len(row) else None  # 1-based, as ws.cell
+
+        headers = [("form_id", 1)]
+        col = 8
+        while cell(head[1], col) == "Flow ID":
+            headers.append((cell(head[2], col), col))
+            col += 3
+
+        # Rows from row 3 until the first empty cell in column 1
+        values = []
+        if all(cell(row, 1) is not None for row in head):
+            values.append(head[2])
+            for row in rows:
+                if cell(row, 1) is None:
+                    break
+                values.append(row)
+    finally:
+        book.close()
+
+    frame = {}
+    for name, col in headers:
+        frame[name] = [cell(row, col + 1) for row in values]
+    return pd.DataFrame.from_dict(frame)
+
+
+class ParsedResultsCache:
+    '''
+    On-disk cache of the columns read from completed workbooks, so a restarted experiment does not parse
+    every archived plate again.
+
+    Each plate is stored as one .npz file holding one array per column. A JSON manifest maps the
+    workbook file name to its size, modification time, SHA-1 of its content, the columns read and the
+    .npz file. An entry is used when the size and modification time match, or failing that when the
+    content hash matches (e.g. the workbook was copied); otherwise the workbook is parsed again and
+    the entry replaced.
+    '''
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.entries = {}
+        try:
+            with open(os.path.join(directory, self.MANIFEST), 'r') as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    @staticmethod
+    def content_hash(path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def columns_key(columns):
+        return None if columns is None else sorted(columns)
+
+    def get(self, filename, path, columns=None):
+        '''Cached frame of the workbook at path, or None if the workbook or the columns read have changed'''
+        entry = self.entries.get(filename)
+        if entry is None or entry['columns'] != self.columns_key(columns):
+            return None
+        stat = os.stat(path)
+        if (entry['size'], entry['mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+            if entry['sha1'] != self.content_hash(path):
+                return None
+            entry['size'], entry['mtime_ns'] = stat.st_size, stat.st_mtime_ns
+            self._write_manifest()
+        try:
+            with np.load(os.path.join(self.directory, entry['file']), allow_pickle=True) as block:
+                return pd.DataFrame({name: block['c{}'.format(i)] for i, name in enumerate(entry['names'])},
+                                    columns=entry['names'])
+        except (IOError, KeyError, ValueError):
+            return None
+
+    def put(self, filename, path, frame, columns=None):
+        '''Stores the frame read from the workbook at path'''
+        os.makedirs(self.directory, exist_ok=True)
+        stat = os.stat(path)
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': self.content_hash(path),
+                 'columns': self.columns_key(columns), 'names': [str(name) for name in frame.columns],
+                 'file': hashlib.sha1(filename.encode('utf-8')).hexdigest() + '.npz'}
+        target = os.path.join(self.directory, entry['file'])
+        with open(target + '.tmp', 'wb') as f:
+            np.savez(f, **{'c{}'.format(i): frame[name].to_numpy() for i, name in enumerate(frame.columns)})
+        os.replace(target + '.tmp', target)
+        self.entries[filename] = entry
+        self._write_manifest()
+
+    def _write_manifest(self):
+        path = os.path.join(self.directory, self.MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(path + '.tmp', path)
+
+
 ##############################################################
 class Parser:
     FLOAT_FORMAT = "{:.4f}"
+    CACHE_DIR = 'parsed_cache/' # on-disk cache of the completed files, see ParsedResultsCache
 
     def __init__(self, compounds, directory_path):
         '''
@@ -54,6 +250,9 @@ class Parser:
         '''
         self.directory_path = directory_path
         self.processed_files = {} # Dictonary of pandas frames. One for every processed file. If file from another batch_name, there will be None
+        self.output_columns = None # Columns of the Output sheet to read from completed files, None for all
+        self.cache = ParsedResultsCache(self.directory_path+self.CACHE_DIR) # Set to None to always parse the completed files
+        self.running_files = {} # Frames of the running and queued files, with the (size, mtime) they were read at
         self.patterns = {} # Patterns for quantities and sample number subsitutions
 
         for chem in compounds:
@@ -111,21 +310,18 @@ class Parser:
         try:
             path = self.directory_path+'completed/'+filename
 
-            book = load_workbook(
-                path)  # Basic intialisastion of worksheets into python so we can read off the exp name / #
-            worksheet_names = book.sheetnames
-            book.active = worksheet_names.index("Output")
-            ws = book.active
-
-
-
             #changes with robot due to format of input sheets
             # if experiment_name is not None:
             #     if experiment_name not in ws.cell(row=1, column=1).value:
             #         self.processed_files[filename] = None
             #         return False
 
-            frame = pd.read_excel(path, sheet_name="Output")
+            frame = None if self.cache is None else self.cache.get(filename, path, self.output_columns)
+            if frame is None:
+                # Single read-only pass over the Output sheet, keeping only the columns in use
+                frame = read_output_sheet(path, self.output_columns)
+                if self.cache is not None:
+                    self.cache.put(filename, path, frame, self.output_columns)
             #frame = pd.read_csv(path)
             self.processed_files[filename] = frame
 
@@ -198,74 +394,22 @@ class Parser:
             print("Cannot find the runqueue folder.\nChange the directory_path variable in the Parser class.")
 
         # I think this segment allows currently running but not complete files to be included in next model?
+        # Files are only read again when they change
+        self.running_files = {file: entry for file, entry in self.running_files.items() if file in running_files}
         for file in running_files:
-            measurements_line = 0
             path = os.path.join(self.directory_path,file)
             #print(path)
-            book = load_workbook(
-                path)  # Basic intialisastion of worksheets into python so we can read off the exp name / #
-            worksheet_names = book.sheetnames
-            book.active = worksheet_names.index("Experiment Details")
-            ws = book.active
+            stat = os.stat(path)
+            signature = (stat.st_size, stat.st_mtime_ns, experiment_name)
+            if file not in self.running_files or self.running_files[file][0] != signature:
+                self.running_files[file] = (signature, read_running_file(path, experiment_name))
+            frame = self.running_files[file][1]
 
             # changes with robot due to format of input sheets
-            if experiment_name is not None:
-                if experiment_name not in ws.cell(row=4, column=2).value:
-                    print("WARNING: runqueue contains files with different experiment name!")
-                    continue
-
-            # '''
-            # Should point to start of formulations
-            # Need the row to end at the cell containing orbital'''
-            #
-            #
-            book.active = worksheet_names.index("Formulations")
-            ws = book.active
-
-            data_pulled = False
-            headers_pulled = False
-            rows_counted = False
-            dict_made = False
-            overall_dict = {}
-            temp_dict = {}
-            header_list = ["form_id"]
-            header_pos_list = [1]
-            values_row = 2
-            total_rows = 1
-            value_list = []
-
-            while data_pulled == False:
-                if headers_pulled == False:
-                    col = 8
-                    while headers_pulled == False:
-
-                        if ws.cell(row=2, column=col).value == "Flow ID":
-                            header_list.append(ws.cell(row=3, column=col).value)
-                            header_pos_list.append(col)
-                            col += 3
-                        else:
-                            break
-
-                if rows_counted == False:
-                    while rows_counted == False:
-                        if ws.cell(row=total_rows, column=1).value is not None:
-                            total_rows += 1
-                        else:
-                            total_rows = total_rows
-                            break
-
-                for i in header_pos_list:
-                    value_list = []
-                    for row in range(total_rows):
-                        if row <= values_row: # should tick row to values
-                            continue
-                        value_list.append(ws.cell(row=row, column=i+1).value)
-                    temp_dict = {header_list[header_pos_list.index(i)] : value_list}
-                    #overall_dict = overall_dict | temp_dict
-                    overall_dict.update(temp_dict)
-                break
+            if frame is None:
+                print("WARNING: runqueue contains files with different experiment name!")
+                continue
 
-            frame = pd.DataFrame.from_dict(overall_dict)
             dfs.append(frame)
 
             #     for head in header_list: